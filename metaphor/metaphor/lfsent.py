@@ -6,19 +6,40 @@ import json
 from sear.index import Document
 from sear.index import IndexRecord
 from sear.utils import StreamParser
+from sear.storage import COMPRESSION
 from sear.index import DocumentIndexer
 
 from hugin.minlf import MinLFSParser
 from hugin.minlf import MinBoxerLFSParser
 
 
+LFS_LF_COLUMN = "lf"
+LFS_TERMS_COLUMN = "terms"
+LFS_TEXT_COLUMN = "text"
+LFS_TERMS_SEP = "\n"
+
+# Columns of sentence storage with (compression, compression block) of each: LF is read for every candidate
+# sentence, so it is stored as is, terms and raw text are read only for sentences which produce output.
+LFS_COLUMNS = [
+    (LFS_LF_COLUMN,     COMPRESSION.NONE, 0),
+    (LFS_TERMS_COLUMN,  COMPRESSION.ZLIB, 64),
+    (LFS_TEXT_COLUMN,   COMPRESSION.ZLIB, 64),
+]
+
+
+def utf8(string):
+    return string.encode("utf-8") if isinstance(string, unicode) else string
+
+
 class LFSentenceStream(object):
 
-    def __init__(self, sentences_fl_path, language):
+    def __init__(self, sentences_fl_path, language, sentences_fl=None):
+        if sentences_fl is None:
+            sentences_fl = open(sentences_fl_path, "rb")
         if language == "rus" or language == "spa":
-            self.parser = MinLFSParser(open(sentences_fl_path, "rb"))
+            self.parser = MinLFSParser(sentences_fl)
         elif language == "eng":
-            self.parser = MinBoxerLFSParser(open(sentences_fl_path, "rb"))
+            self.parser = MinBoxerLFSParser(sentences_fl)
         else:
             raise Exception("Unsupported language: %s" % language)
 
@@ -81,6 +102,30 @@ class LFSDocument(Document):
         })
         return lfs_json
 
+    def tocolumns(self, columns):
+        """
+
+        Raw text and LF are stored as utf-8 strings, terms are joined by LFS_TERMS_SEP.
+
+        """
+        values = {
+            LFS_LF_COLUMN: utf8(self.lf_sentence),
+            LFS_TERMS_COLUMN: LFS_TERMS_SEP.join(utf8(term) for term in self.idx_terms),
+            LFS_TEXT_COLUMN: utf8(self.raw_text),
+        }
+        return [values[column] for column in columns]
+
+    def fromcolumns(self, columns, values):
+        for column, value in zip(columns, values):
+            if column == LFS_LF_COLUMN:
+                self.lf_sentence = value
+            elif column == LFS_TERMS_COLUMN:
+                self.idx_terms = value.split(LFS_TERMS_SEP) if len(value) > 0 else []
+            elif column == LFS_TEXT_COLUMN:
+                self.raw_text = value
+            else:
+                raise Exception("Unknown column %r" % column)
+
     def terms(self):
         return self.idx_terms
 
@@ -35,6 +35,7 @@ class RuwacStream(object):
             elif line.startswith(self.DOC_CLOSING_TAG):
                 if len(self.line_buffer) > 0:
                     yield self.line_buffer
+                    self.line_buffer = []
                 else:
                     continue
             else:
@@ -22,6 +22,18 @@ from hugin.relsearch import REL_ID_NAME_MAP
 from hugin.minlf import MinLFSParser
 
 
+# Fields of triplet index postings, see TripletIndexRecord.property_vectors.
+TRIPLET_FIELD_PROPERTIES = [
+    ("triplet_id", np.int32),
+    ("arg_index", np.int32),
+    ("rel_type", np.int32),
+    ("pos", np.int32),
+    ("frequency", np.int32),
+]
+# Fields which get secondary partitions, so queries like ("rel_type", "==", <id>) read only matching postings.
+TRIPLET_PARTITION_FIELDS = ["rel_type", "pos"]
+
+
 class Triplet(Document):
     TRP_DELIMITER = chr(255)    # delimiter for triple tokens
     TRM_DELIMITER = chr(254)    # delimiter for pos-term tokens
@@ -4,11 +4,13 @@
 # Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
 
 import random
+import StringIO
 import unittest
 
 import hugin.pos
 import hugin.relsearch
-import metaphor.processing
+import metaphor.triplet
+import metaphor.lfsent
 
 TESTS_NUM = 1000
 
@@ -18,7 +20,7 @@ class TestTriplet(unittest.TestCase):
     def test_init(self):
         for rel in hugin.relsearch.RELATION_NAMES:
             for pos in hugin.pos.POS_NAMES:
-                triplet = metaphor.processing.Triplet(0, rel, [("term", pos)], 1)
+                triplet = metaphor.triplet.Triplet(0, rel, [("term", pos)], 1)
                 self.assertIsNotNone(triplet)
 
     def test_tostring(self):
@@ -31,11 +33,48 @@ class TestTriplet(unittest.TestCase):
             rel_type = random.choice(hugin.relsearch.RELATION_NAMES)
             triplet_id = random.randint(0, 0xFFFFFFFF)
             #print rel_type
-            triplet = metaphor.processing.Triplet(triplet_id, rel_type, arguments, frequency)
+            triplet = metaphor.triplet.Triplet(triplet_id, rel_type, arguments, frequency)
             tstring = triplet.tostring()
-            copy_triplet = metaphor.processing.Triplet(triplet_id)
+            copy_triplet = metaphor.triplet.Triplet(triplet_id, None, None, None)
             copy_triplet.fromstring(tstring)
             self.assertEqual(tstring, copy_triplet.tostring())
 
+
+class TestLFSDocument(unittest.TestCase):
+
+    def test_columns(self):
+        columns = [column for column, _, _ in metaphor.lfsent.LFS_COLUMNS]
+        for terms in ([], ["one"], [u"один", "two", ""]):
+            document = metaphor.lfsent.LFSDocument(0, u"Сырой текст", u"[0]:текст-nn(e1,x1)", terms)
+            values = document.tocolumns(columns)
+            self.assertTrue(all(isinstance(value, str) for value in values))
+            copy_document = metaphor.lfsent.LFSDocument(0, None, None, None)
+            copy_document.fromcolumns(columns, values)
+            self.assertEqual(copy_document.tocolumns(columns), values)
+            self.assertEqual(copy_document.raw_text.decode("utf-8"), document.raw_text)
+            self.assertEqual(copy_document.lf_sentence.decode("utf-8"), document.lf_sentence)
+            self.assertEqual([term.decode("utf-8") for term in copy_document.terms()], terms)
+            copy_document.fromcolumns(columns[:1], values[:1])
+            self.assertEqual(copy_document.tocolumns(columns), values)
+            self.assertRaises(Exception, copy_document.fromcolumns, ["unknown"], [""])
+
+    def test_stream_columns(self):
+        sentences_fl = StringIO.StringIO("% Мы видим комплексы .\n"
+                                         "id(1).\n"
+                                         "person(e1,x1) & [1002]:видеть-vb(e2,x1,e4,u1) & [1012]:комплекс-nn(e7,x4)\n"
+                                         "\n"
+                                         "% Пусто .\n"
+                                         "id(2).\n"
+                                         "thing(e1,x1)\n")
+        stream = metaphor.lfsent.LFSentenceStream(None, "rus", sentences_fl=sentences_fl)
+        parser = metaphor.lfsent.LFSentenceParser()
+        columns = [column for column, _, _ in metaphor.lfsent.LFS_COLUMNS]
+        documents = [parser.parse_raw(raw_document) for raw_document in stream]
+        self.assertEqual([document.terms() for document in documents], [["видеть", "комплекс"], []])
+        for document in documents:
+            copy_document = metaphor.lfsent.LFSDocument(document.id, None, None, None)
+            copy_document.fromcolumns(columns, document.tocolumns(columns))
+            self.assertEqual(copy_document.tostring(), document.tostring())
+
 if __name__ == "__main__":
         unittest.main()
@@ -4,16 +4,10 @@
 # Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
 
 import os
-import numpy
-import shutil
 import logging
 import argparse
 
-from sear.index import InvertedIndex                # The index itself.
-from sear.utils import IndexingPipeline             # Utility which will control indexing process.
-
-from sear.storage import LdbStorage                 # Storage for raw indexed documents.
-from sear.lexicon import DictLexicon                # Term lexicon backend.
+from sear.shard import ShardedIndexBuilder          # Driver of (parallel sharded) indexing.
 
 from metaphor.ruwac import RuwacParser
 from metaphor.ruwac import RuwacStream
@@ -33,9 +27,29 @@ arg_parser.add_argument("-l", "--language",     type=str, default=None)
 arg_parser.add_argument("-c", "--corpus",       type=str, choices=("ruwac", "gigaword"), default=None)
 arg_parser.add_argument("-i", "--input",        type=str)
 arg_parser.add_argument("-o", "--output",       type=str)
+arg_parser.add_argument("-f", "--index_format", type=str, choices=("ldb", "mmap"), default="ldb")
+arg_parser.add_argument("-b", "--bulk",         type=int, choices=(0, 1), default=0)
+arg_parser.add_argument("-z", "--codec",        type=str, choices=("raw", "delta_varint", "for", "elias_fano",
+                                                                   "bitmap"),
+                        default="raw")
+arg_parser.add_argument("-j", "--jobs",         type=int, default=1)
+arg_parser.add_argument("-m", "--merge",        type=str, choices=("single", "shards"), default="single")
+arg_parser.add_argument("-a", "--append",       type=int, choices=(0, 1), default=0)
+arg_parser.add_argument("-d", "--doc_block",    type=int, default=0)
+arg_parser.add_argument("-x", "--doc_compression", type=str, choices=("none", "zlib", "lzma", "lz4r", "lz4h"),
+                        default="zlib")
+arg_parser.add_argument("-y", "--doc_format",   type=str, choices=("ldb", "mmap"), default="ldb")
 arguments = arg_parser.parse_args()
 
 
+# Lines which start documents, input is split between workers only at them.
+RECORD_PREFIXES = {
+    "rus": (RuwacStream.DOC_OPENNING_TAG, ),
+    "spa": (GigawordStream.DOC_OPENNING_TAG_1, GigawordStream.DOC_OPENNING_TAG_2),
+    "eng": (GigawordStream.DOC_OPENNING_TAG_1, GigawordStream.DOC_OPENNING_TAG_2),
+}
+
+
 logging.info("Initializing output directory structure.")
 
 if arguments.test == 1:
@@ -63,65 +77,41 @@ logging.info("Input: %s" % input_path)
 logging.info("Output: %s" % output_path)
 
 
-if os.path.exists(output_path):
-    shutil.rmtree(output_path)
-os.makedirs(output_path)
-
-
-
-logging.info("Initializing lexicon.")
-lexicon = DictLexicon(output_path)
-lexicon.load()
-
-
-logging.info("Initializing storage.")
-storage = LdbStorage(output_path)
-storage.init_db()
-storage.open_db()
-
-
-logging.info("Initializing index.")
-index = InvertedIndex(output_path, field_properties=[
-    ("document_id", numpy.int32),
-])
-index.init_index()
-index.open()
-
-
-logging.info("Initializing ruwac stream and its parser.")
-
-if arguments.language == "spa" or arguments.language == "eng":
-    sentence_stream = GigawordStream(open(input_path, "rb"))
-    sentence_parser = GigawordParser(language=arguments.language)
-elif arguments.language == "rus":
-    sentence_stream = RuwacStream(open(input_path, "rb"))
-    sentence_parser = RuwacParser()
-else:
-    raise Exception("Unsupported language: %s" % arguments.language)
-
-sentence_indexer = RuwacIndexer(lexicon)
-
-
-logging.info("Initializing indexing pipeline.")
-indexing_pipeline = IndexingPipeline(lexicon, index, storage)
-
-
-logging.info("Start indexing file: %s" % input_path)
-input_mb_size = float(os.path.getsize(input_path)) / (1024 ** 2)
-logging.info("Input size: %.2fMB" % input_mb_size)
-indexing_pipeline.index_stream(sentence_stream, sentence_parser, sentence_indexer)
-
-
-logging.info("Closing index.")
-index.close()
-
-
-logging.info("Closing storage.")
-storage.close_db()
-
-
-logging.info("Dumping lexicon.")
-lexicon.dump()
+class DocumentIndexBuilder(ShardedIndexBuilder):
+
+    def __init__(self, output_path, language, **kwargs):
+        super(DocumentIndexBuilder, self).__init__(output_path, "document_id", **kwargs)
+        self.language = language
+        self.record_prefixes = RECORD_PREFIXES.get(language, ())
+
+    def make_stream(self, input_fl):
+        if self.language == "spa" or self.language == "eng":
+            return GigawordStream(input_fl)
+        elif self.language == "rus":
+            return RuwacStream(input_fl)
+        raise Exception("Unsupported language: %s" % self.language)
+
+    def make_parser(self):
+        if self.language == "spa" or self.language == "eng":
+            return GigawordParser(language=self.language)
+        return RuwacParser()
+
+    def make_indexer(self, lexicon):
+        return RuwacIndexer(lexicon)
+
+
+builder = DocumentIndexBuilder(output_path,
+                               arguments.language,
+                               index_format=arguments.index_format.upper(),
+                               codec=arguments.codec.upper(),
+                               bulk_mode=arguments.bulk == 1,
+                               doc_block=arguments.doc_block,
+                               doc_compression=arguments.doc_compression.upper(),
+                               doc_format=arguments.doc_format.upper(),
+                               jobs=arguments.jobs,
+                               single=arguments.merge == "single",
+                               append=arguments.append == 1)
+builder.build(input_path)
 
 
 logging.info("No way, it's done!")
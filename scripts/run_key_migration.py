@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+
+# Rewrites indexes and storages written with decimal text keys to fixed width binary keys. Every input is
+# an index directory (index.json, storage.json) or a directory of shards (shards.json). Inputs which
+# already have binary keys are left as they are.
+
+import os
+import logging
+import argparse
+
+from sear.shard import ShardManifest
+from sear.index import InvertedIndex
+from sear.storage import LdbStorage
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("-i", "--input", type=str, nargs="+")
+arguments = arg_parser.parse_args()
+
+
+def migrate(input_path):
+    if ShardManifest.exists(input_path):
+        manifest = ShardManifest(input_path)
+        manifest.load()
+        logging.info("Migrating %d shards of %s." % (len(manifest.shards), input_path))
+        for shard_path in manifest.shard_paths():
+            migrate(shard_path)
+        return
+    if os.path.exists(os.path.join(input_path, InvertedIndex.META_FILE)):
+        segments = InvertedIndex(input_path).migrate_keys()
+        logging.info("Index %s: rewrote %d segments." % (input_path, segments))
+    if os.path.exists(os.path.join(input_path, LdbStorage.META_FL)):
+        storage = LdbStorage(input_path)
+        storage.load_meta()
+        if storage.migrate_keys():
+            logging.info("Storage %s: rewrote documents and terms." % input_path)
+        else:
+            logging.info("Storage %s: already has binary keys." % input_path)
+
+
+for path in arguments.input:
+    migrate(path)
@@ -9,18 +9,29 @@ import sys
 import json
 import glob
 import nltk
-import leveldb
 import logging
 import hashlib
 import argparse
+import itertools
 import traceback
 
 from sear.searcher import Searcher
+from sear.searcher import join_sorted
+from sear.searcher import masked_terms
+from sear.searcher import ShardedSearcher
 from sear.storage import LdbStorage
+from sear.fetcher import DocumentFetcher
+from sear.shard import MANIFEST_FL
+from sear.shard import ShardManifest
+from sear.shard import ShardedStorage
 from sear.index import InvertedIndex
 from sear.lexicon import DictLexicon
 from hugin.metaphor import find_path
 from metaphor.ruwac import RuwacDocument
+from metaphor.lfsent import LFS_LF_COLUMN
+from metaphor.lfsent import LFS_TEXT_COLUMN
+from metaphor.lfsent import LFS_TERMS_COLUMN
+from metaphor.lfsent import LFS_TERMS_SEP
 from metaphor.gigaword import text_to_terms
 
 
@@ -41,6 +52,12 @@ arg_parser.add_argument("-e", "--extension",        type=str, default=".metaphor
 arg_parser.add_argument("-p", "--use_pos",          type=int, default=0, choices=(0, 1))
 arg_parser.add_argument("-t", "--test",             type=int, choices=(0, 1), default=0)
 arg_parser.add_argument("-s", "--test_size",        type=str, choices=("tiny", "medium", "large"), default="tiny")
+arg_parser.add_argument("-j", "--jobs",             type=int, default=None)
+arg_parser.add_argument("-r", "--result_cache",     type=int, default=64)    # query results cache size, MB
+arg_parser.add_argument("-k", "--context_cache",    type=int, default=256)   # context documents cache size, MB
+arg_parser.add_argument("-w", "--warm_up",          type=str, default=None)  # file with hot context document ids
+arg_parser.add_argument("-n", "--fetch_jobs",       type=int, default=2)     # sentence prefetching threads
+arg_parser.add_argument("-g", "--lookahead",        type=int, default=1024)  # sentences read ahead of checking
 arguments = arg_parser.parse_args()
 
 
@@ -57,6 +74,28 @@ def get_term_from_query(term_str, use_pos=False):
             return term_matches[0]
 
 
+def read_sentence(sent_document_id, sent_document):
+    """
+
+    Returns raw text and terms (None if there is no context index to search with them) of candidate
+    sentence. With columnar storage they are read from their own columns, only for sentences which produce
+    output.
+
+    """
+    if text_storage is not None:
+        sent_text = text_storage.get_document(sent_document_id)
+    else:
+        sent_text = sent_document["r"].encode("utf-8")
+    if context_input is None:
+        return sent_text, None
+    if arguments.language != "rus":
+        return sent_text, [t for t in text_to_terms(sent_text.decode("utf-8"), arguments.language)]
+    if terms_storage is not None:
+        terms_value = terms_storage.get_document(sent_document_id)
+        return sent_text, terms_value.split(LFS_TERMS_SEP) if len(terms_value) > 0 else []
+    return sent_text, [term.encode("utf-8") for term in sent_document["t"]]
+
+
 if arguments.test == 1:
     input_path = os.path.join(
         arguments.input,
@@ -91,6 +130,11 @@ else:
     query_paths = arguments.query
     context_input = arguments.context_input
 
+# Input may be a shards manifest (or a directory containing one) instead of a single index root
+if os.path.basename(input_path) == MANIFEST_FL:
+    input_path = os.path.dirname(input_path)
+manifest = ShardManifest(input_path).load() if ShardManifest.exists(input_path) else None
+
 logging.info("Input: %s" % input_path)
 logging.info("Context: %s" % context_input)
 logging.info("Query: %s" % query_paths)
@@ -102,17 +146,43 @@ lexicon = DictLexicon(input_path)
 lexicon.load()
 
 
-logging.info("Opening index.")
-index = InvertedIndex(input_path)
-index.open()
+if manifest is None:
 
+    logging.info("Opening index.")
+    index = InvertedIndex(input_path)
+    index.open()
 
-logging.info("Initializing searcher.")
-searcher = Searcher(index, "sentence_id")
+    logging.info("Initializing searcher.")
+    searcher = Searcher(index, "sentence_id", arguments.result_cache * 1024 * 1024)
 
-logging.info("Initializing storage.")
-storage = LdbStorage(input_path)
-storage.open_db()
+    logging.info("Initializing storage.")
+    storage = LdbStorage(input_path)
+    storage.load_meta()
+    storage.open_db()
+
+else:
+
+    logging.info("Initializing searcher over %d shards." % len(manifest.shards))
+    searcher = ShardedSearcher(manifest,
+                               "sentence_id",
+                               jobs=arguments.jobs,
+                               result_cache_bytes=arguments.result_cache * 1024 * 1024)
+
+    logging.info("Initializing sharded storage.")
+    storage = ShardedStorage(manifest)
+    storage.open_db()
+
+if len(storage.columns) > 0:
+    # Candidates are verified by their LF column only, raw text and terms are read for found sentences.
+    logging.info("Storage has columns: %s." % ", ".join(storage.columns))
+    text_storage = storage.column(LFS_TEXT_COLUMN)
+    terms_storage = storage.column(LFS_TERMS_COLUMN)
+    fetcher = DocumentFetcher(storage.column(LFS_LF_COLUMN), None, arguments.fetch_jobs, arguments.lookahead)
+else:
+    text_storage = None
+    terms_storage = None
+    # Sentences are decoded in fetcher threads as well.
+    fetcher = DocumentFetcher(storage, json.loads, arguments.fetch_jobs, arguments.lookahead)
 
 if context_input is not None:
 
@@ -132,7 +202,14 @@ if context_input is not None:
 
     logging.info("Initializing context storage.")
     c_storage = LdbStorage(context_input)
+    c_storage.load_meta()
     c_storage.open_db()
+    # Sentences of the same article bring the same context documents, so they are read through the cache.
+    hot_ids = None
+    if arguments.warm_up is not None:
+        with open(arguments.warm_up, "rb") as hot_ids_fl:
+            hot_ids = [int(line) for line in hot_ids_fl if line.strip()]
+    c_storage.cache_documents(arguments.context_cache * 1024 * 1024, hot_ids)
 
 for query_path in glob.glob(query_paths):
 
@@ -189,22 +266,24 @@ for query_path in glob.glob(query_paths):
     targets = [(term_id, []) for term_id in targets]
     sources = [(term_id, []) for term_id in sources]
     logging.info("Query has %d x %d terms" % (len(targets), len(sources)))
+    logging.info("Target terms docs: %d, source terms docs: %d (before union)" % (
+        sum(searcher.document_frequency(term_id) for term_id, _ in targets),
+        sum(searcher.document_frequency(term_id) for term_id, _ in sources),
+    ))
 
 
-    # This tables will contain : document_id -> <sources, targets>
-    candidates = dict()
-    target_candidates = searcher.find_or(targets)
-    source_candidates = searcher.find_or(sources)
+    # This arrays will contain : document_id, mask of found terms
+    target_ids = [term_id for term_id, _ in targets]
+    source_ids = [term_id for term_id, _ in sources]
+    target_docs, target_masks = searcher.find_or(targets)
+    source_docs, source_masks = searcher.find_or(sources)
 
-    # For every source document, check if it also has targets, then remeber its sources, otherwise
-    # remove that document from the hashmap
-    for document_id, found_sources in source_candidates.iteritems():
-        if document_id in target_candidates:
-            found_targets = target_candidates[document_id]
-            candidates[document_id] = [found_sources, found_targets]
+    # Keep only source documents which also have targets, together with their sources and targets masks
+    source_rows, target_rows = join_sorted(source_docs, target_docs)
+    candidates = zip(source_docs[source_rows], source_masks[source_rows], target_masks[target_rows])
 
-    logging.info("Found target docs: %d" % len(target_candidates))
-    logging.info("Found source docs: %d" % len(source_candidates))
+    logging.info("Found target docs: %d" % len(target_docs))
+    logging.info("Found source docs: %d" % len(source_docs))
     logging.info("After intersection: %d" % len(candidates))
 
 
@@ -216,33 +295,34 @@ for query_path in glob.glob(query_paths):
     if arguments.output_format == "json":
         o_file.write("[")
 
+    # Candidate sentences are read and decoded ahead of checking, but come in candidates order.
+    candidate_documents = fetcher.fetch(sent_document_id for sent_document_id, _, _ in candidates)
+
     iter = 0
-    for sent_document_id, (sources, targets) in candidates.iteritems():
+    for (sent_document_id, sources_mask, targets_mask), (_, sent_document) in itertools.izip(candidates,
+                                                                                             candidate_documents):
 
-        try:
-            sent_document = json.loads(storage.get_document(sent_document_id))
-        except leveldb.LevelDBError:
-            logging.error("Database error. Files are missed or corrupted: %s." % traceback.format_exc())
+        sources = masked_terms(sources_mask, source_ids)
+        targets = masked_terms(targets_mask, target_ids)
 
-        sent_text = sent_document["r"].encode("utf-8")
-        sent_lf_text = sent_document["s"].encode("utf-8")
-        sent_hash = str(hashlib.md5(sent_text).hexdigest())
+        if sent_document is None:
+            logging.error("Database error. Sentence %d is missed." % sent_document_id)
+            continue
 
-        if arguments.language == "rus":
-            sent_terms = [term.encode("utf-8") for term in sent_document["t"]]
+        if text_storage is not None:
+            sent_lf_text = sent_document
         else:
-            sent_text_u = sent_text.decode("utf-8")
-            sent_terms = [t for t in text_to_terms(sent_text_u, arguments.language)]
+            sent_lf_text = sent_document["s"].encode("utf-8")
 
-        if sent_hash in sent_hashes:
-            logging.info("Skipped sentence, because we've seen its hash before: %s" % sent_hash[:8])
-            continue
-        else:
-            logging.info("Added a new sentence digest to the duplicates hash set: %s" %  sent_hash[:8])
-            sent_hashes.add(sent_hash)
+        # Raw text is read and checked for duplicates when the first path is found: sentences with the same
+        # text have the same LF, so duplicates of sentences without paths have none as well.
+        sent_text = None
+        duplicate = False
 
         try:
             for target_term_id in targets:
+                if duplicate:
+                    break
                 for source_term_id in sources:
 
                     if target_term_id == source_term_id:
@@ -260,7 +340,18 @@ for query_path in glob.glob(query_paths):
                                                           max_path_length=q_max_path_length,
                                                           language=arguments.language)
                     if not found:
-                        logging.info("Path not found in %s" % sent_hash[:8])
+                        logging.info("Path not found in sentence %d" % sent_document_id)
+
+                    if found and sent_text is None:
+                        sent_text, sent_terms = read_sentence(sent_document_id, sent_document)
+                        sent_hash = str(hashlib.md5(sent_text).hexdigest())
+                        if sent_hash in sent_hashes:
+                            logging.info("Skipped sentence, because we've seen its hash before: %s" % sent_hash[:8])
+                            duplicate = True
+                            break
+                        else:
+                            logging.info("Added a new sentence digest to the duplicates hash set: %s" % sent_hash[:8])
+                            sent_hashes.add(sent_hash)
 
                     if found:
 
@@ -371,3 +462,11 @@ for query_path in glob.glob(query_paths):
         o_file.write("\n]")
 
     o_file.close()
+
+fetcher.close()
+searcher.log_stats()
+if context_input is not None:
+    c_searcher.log_stats()
+    c_storage.log_stats()
+if manifest is not None:
+    searcher.close()
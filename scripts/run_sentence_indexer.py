@@ -4,20 +4,16 @@
 # Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
 
 import os
-import numpy
-import shutil
 import logging
 import argparse
 
-from sear.index import InvertedIndex                # The index itself.
-from sear.utils import IndexingPipeline             # Utility which will control indexing process.
-
-from sear.storage import LdbStorage                 # Storage for raw indexed documents.
-from sear.lexicon import DictLexicon                # Term lexicon backend.
+from sear.storage import DOC_FORMAT                 # Storage format of documents.
+from sear.shard import ShardedIndexBuilder          # Driver of (parallel sharded) indexing.
 
 from metaphor.lfsent import LFSentenceParser        # High level LF sentences parser.
 from metaphor.lfsent import LFSentenceStream        # Class which does low-level LF sentences parsing.
 from metaphor.lfsent import LFSentenceIndexer       # Class which knows how to index parsed LF sentences.
+from metaphor.lfsent import LFS_COLUMNS             # Columns of sentence storage.
 
 
 logging.basicConfig(level=logging.INFO)
@@ -29,9 +25,36 @@ arg_parser.add_argument("-s", "--test_size",    type=str, choices=("tiny", "medi
 arg_parser.add_argument("-l", "--language",     type=str, choices=("rus", "spa", "eng"),        default=None)
 arg_parser.add_argument("-i", "--input",        type=str)
 arg_parser.add_argument("-o", "--output",       type=str)
+arg_parser.add_argument("-f", "--index_format", type=str, choices=("ldb", "mmap"),              default="ldb")
+arg_parser.add_argument("-b", "--bulk",         type=int, choices=(0, 1),                       default=0)
+arg_parser.add_argument("-z", "--codec",        type=str, choices=("raw", "delta_varint", "for", "elias_fano",
+                                                                   "bitmap"),
+                        default="raw")
+arg_parser.add_argument("-j", "--jobs",         type=int,                                       default=1)
+arg_parser.add_argument("-m", "--merge",        type=str, choices=("single", "shards"),         default="single")
+arg_parser.add_argument("-a", "--append",       type=int, choices=(0, 1),                       default=0)
+arg_parser.add_argument("-d", "--doc_block",    type=int,                                       default=0)
+arg_parser.add_argument("-x", "--doc_compression", type=str, choices=("none", "zlib", "lzma", "lz4r", "lz4h"),
+                        default="zlib")
+arg_parser.add_argument("-y", "--doc_format",   type=str, choices=("ldb", "mmap"),              default="ldb")
+arg_parser.add_argument("-c", "--columns",      type=int, choices=(0, 1),                       default=0)
 arguments = arg_parser.parse_args()
 
 
+# Lines which start sentence records, input is split between workers only at them.
+RECORD_PREFIXES = {
+    "rus": ("%",),
+    "spa": ("%",),
+    "eng": ("%%% ",),
+}
+# Number of header lines at the beginning of input file expected by the parser.
+HEADER_LINES = {
+    "rus": 0,
+    "spa": 0,
+    "eng": 2,
+}
+
+
 logging.info("Initializing output directory structure.")
 
 if arguments.test == 1:
@@ -60,56 +83,46 @@ logging.info("Input: %s" % input_path)
 logging.info("Output: %s" % output_path)
 
 
-if os.path.exists(output_path):
-    shutil.rmtree(output_path)
-os.makedirs(output_path)
-
-
-
-logging.info("Initializing lexicon.")
-lexicon = DictLexicon(output_path)
-
-
-logging.info("Initializing storage.")
-storage = LdbStorage(output_path)
-storage.init_db()
-storage.open_db()
-
-
-logging.info("Initializing index.")
-index = InvertedIndex(output_path, field_properties=[
-    ("sentence_id", numpy.int32),
-])
-index.init_index()
-index.open()
-
-
-logging.info("Initializing sentence stream and its parser.")
-sentence_stream = LFSentenceStream(input_path, language=arguments.language)
-sentence_parser = LFSentenceParser()
-sentence_indexer = LFSentenceIndexer(lexicon)
-
-
-logging.info("Initializing indexing pipeline.")
-indexing_pipeline = IndexingPipeline(lexicon, index, storage)
-
-
-logging.info("Start indexing file: %s" % input_path)
-input_mb_size = float(os.path.getsize(input_path)) / (1024 ** 2)
-logging.info("Input size: %.2fMB" % input_mb_size)
-indexing_pipeline.index_stream(sentence_stream, sentence_parser, sentence_indexer)
-
-
-logging.info("Closing index.")
-index.close()
-
-
-logging.info("Closing storage.")
-storage.close_db()
-
-
-logging.info("Dumping lexicon.")
-lexicon.dump()
+class SentenceIndexBuilder(ShardedIndexBuilder):
+
+    def __init__(self, output_path, language, columns=False, **kwargs):
+        super(SentenceIndexBuilder, self).__init__(output_path, "sentence_id", **kwargs)
+        self.language = language
+        self.columns = columns
+        self.record_prefixes = RECORD_PREFIXES.get(language, ())
+        self.header_lines = HEADER_LINES.get(language, 0)
+
+    def make_stream(self, input_fl):
+        return LFSentenceStream(None, self.language, sentences_fl=input_fl)
+
+    def make_parser(self):
+        return LFSentenceParser()
+
+    def make_indexer(self, lexicon):
+        return LFSentenceIndexer(lexicon)
+
+    def init_storage(self, storage):
+        super(SentenceIndexBuilder, self).init_storage(storage)
+        # Sentences are stored in separate LF, terms and raw text columns, if it is given.
+        if self.columns:
+            for name, compression, block in LFS_COLUMNS:
+                doc_format = storage.doc_format if block == 0 else DOC_FORMAT.LDB
+                storage.add_column(name, compression, block, doc_format)
+
+
+builder = SentenceIndexBuilder(output_path,
+                               arguments.language,
+                               columns=arguments.columns == 1,
+                               index_format=arguments.index_format.upper(),
+                               codec=arguments.codec.upper(),
+                               bulk_mode=arguments.bulk == 1,
+                               doc_block=arguments.doc_block,
+                               doc_compression=arguments.doc_compression.upper(),
+                               doc_format=arguments.doc_format.upper(),
+                               jobs=arguments.jobs,
+                               single=arguments.merge == "single",
+                               append=arguments.append == 1)
+builder.build(input_path)
 
 
 logging.info("No way, it's done!")
@@ -0,0 +1,87 @@
+# coding: utf-8
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+
+import logging
+import threading
+import collections
+
+
+class LruCache(object):
+
+    def __init__(self, max_bytes, name="cache"):
+        """
+
+        Least recently used cache bounded by total size of stored values. Size of every value is given
+        by the caller on put(). Values larger than the whole budget are not cached. Safe to use from
+        several threads.
+
+        """
+        self.max_bytes = max_bytes
+        self.name = name
+        self.items = collections.OrderedDict()          # key -> (value, size), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            self.items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            old_item = self.items.pop(key, None)
+            if old_item is not None:
+                self.bytes -= old_item[1]
+            if size > self.max_bytes:
+                return
+            self.items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "items": len(self.items),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": float(self.hits) / requests if requests > 0 else 0.0,
+            }
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info("%s: %d items, %d MB, %d hits, %d misses (%.2f), %d evictions." % (
+            self.name,
+            stats["items"],
+            stats["bytes"] / (1024 * 1024),
+            stats["hits"],
+            stats["misses"],
+            stats["hit_rate"],
+            stats["evictions"],
+        ))
@@ -0,0 +1,529 @@
+# coding: utf-8
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+
+import abc
+import numpy as np
+
+from sear.segment import gather_ranges
+
+
+class CODEC:
+
+    RAW = "RAW"
+    DELTA_VARINT = "DELTA_VARINT"
+    FOR = "FOR"
+    ELIAS_FANO = "ELIAS_FANO"
+    BITMAP = "BITMAP"
+
+
+VARINT_THRESHOLDS = np.array([1 << (7 * k) for k in xrange(1, 10)], dtype=np.uint64)
+BIT_THRESHOLDS = np.array([1 << k for k in xrange(64)], dtype=np.uint64)
+
+
+def as_bytes(data):
+    if isinstance(data, np.ndarray):
+        return data
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def varint_sizes(values):
+    """
+
+    Returns number of bytes taken by every value encoded as varint.
+
+    """
+    return np.searchsorted(VARINT_THRESHOLDS, np.asarray(values, dtype=np.uint64), side="right") + 1
+
+
+def varint_encode(values):
+    """
+
+    Encodes array of unsigned integers as LEB128 varints: 7 bits per byte, high bit marks continuation.
+
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = varint_sizes(values)
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    encoded = np.empty(ends[-1] if len(ends) > 0 else 0, dtype=np.uint8)
+    for k in xrange(sizes.max() if len(sizes) > 0 else 0):
+        mask = sizes > k
+        chunk = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        chunk |= np.where(sizes[mask] > k + 1, np.uint64(0x80), np.uint64(0))
+        encoded[starts[mask] + k] = chunk
+    return encoded
+
+
+def varint_decode(encoded):
+    encoded = np.asarray(encoded, dtype=np.uint8)
+    last_bytes = np.flatnonzero(encoded < 0x80)
+    values = np.zeros(len(last_bytes), dtype=np.uint64)
+    if len(last_bytes) == 0:
+        return values
+    value_index = np.zeros(len(encoded), dtype=np.int64)
+    value_index[last_bytes[:-1] + 1] = 1
+    value_index = np.cumsum(value_index)
+    starts = np.concatenate(([0], last_bytes[:-1] + 1))
+    byte_index = np.arange(len(encoded)) - starts[value_index]
+    payload = (encoded & 0x7F).astype(np.uint64)
+    for k in xrange(byte_index.max() + 1):
+        mask = byte_index == k
+        values[value_index[mask]] |= payload[mask] << np.uint64(7 * k)
+    return values
+
+
+def zigzag_encode(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def zigzag_decode(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def bit_lengths(values):
+    """
+
+    Returns number of significant bits of every unsigned value (0 for 0).
+
+    """
+    return np.searchsorted(BIT_THRESHOLDS, np.asarray(values, dtype=np.uint64), side="right")
+
+
+def pack_bits(values, widths):
+    """
+
+    Packs every value into its own number of bits (most significant first), values follow each other
+    without padding.
+
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    ends = np.cumsum(widths)
+    starts = ends - widths
+    bits = np.zeros(ends[-1] if len(ends) > 0 else 0, dtype=np.uint8)
+    for k in xrange(widths.max() if len(widths) > 0 else 0):
+        mask = widths > k
+        shift = (widths[mask] - 1 - k).astype(np.uint64)
+        bits[starts[mask] + k] = (values[mask] >> shift) & np.uint64(1)
+    return np.packbits(bits)
+
+
+def extract_bits(bits, starts, widths):
+    """
+
+    Reads values of given widths starting at given positions of unpacked bit array.
+
+    """
+    values = np.zeros(len(widths), dtype=np.uint64)
+    for k in xrange(widths.max() if len(widths) > 0 else 0):
+        mask = widths > k
+        shift = (widths[mask] - 1 - k).astype(np.uint64)
+        values[mask] |= bits[starts[mask] + k].astype(np.uint64) << shift
+    return values
+
+
+def read_bits(data, bit_starts, widths):
+    """
+
+    Reads values of given widths (up to 64 bits) starting at given bit positions of packed byte array.
+    Every value is read from the 9 bytes starting at its first byte, so only these bytes are touched.
+
+    """
+    bit_starts = np.asarray(bit_starts, dtype=np.int64)
+    widths = np.asarray(widths, dtype=np.int64)
+    values = np.zeros(len(widths), dtype=np.uint64)
+    if len(widths) == 0 or widths.max() == 0:
+        return values
+    # Bytes past the end of data may hold only bits below the value, which are shifted out anyway.
+    first_bytes = bit_starts >> 3
+    for k in xrange(8):
+        values |= data.take(first_bytes + k, mode="clip").astype(np.uint64) << np.uint64(56 - 8 * k)
+    shifts = (bit_starts & 7).astype(np.uint64)
+    next_byte = data.take(first_bytes + 8, mode="clip").astype(np.uint64)
+    values = (values << shifts) | (next_byte >> (np.uint64(8) - shifts))
+    values >>= (64 - np.maximum(widths, 1)).astype(np.uint64)
+    values[widths == 0] = 0
+    return values
+
+
+def unpack_bits(packed, widths):
+    ends = np.cumsum(widths)
+    return extract_bits(np.unpackbits(np.asarray(packed, dtype=np.uint8)), ends - widths, widths)
+
+
+def gather_words(data, starts, dtype):
+    """
+
+    Reads one <dtype> word at every given byte position.
+
+    """
+    word_size = np.dtype(dtype).itemsize
+    return data[starts[:, None] + np.arange(word_size)].copy().view(dtype).ravel()
+
+
+class Codec(object):
+    name = None
+
+    @abc.abstractmethod
+    def encode(self, array):
+        """
+
+        Returns string with encoded array.
+
+        """
+        raise NotImplementedError("Codec is abstract class")
+
+    @abc.abstractmethod
+    def decode(self, data, dtype):
+        """
+
+        Decodes array of <dtype> from string or uint8 array.
+
+        """
+        raise NotImplementedError("Codec is abstract class")
+
+    def encode_blocks(self, array, block_size):
+        """
+
+        Encodes array split into blocks of <block_size> values, every block can be decoded on its own.
+        Returns encoded string and array of encoded block sizes in bytes.
+
+        """
+        blobs = [self.encode(array[i:(i + block_size)]) for i in xrange(0, len(array), block_size)]
+        return "".join(blobs), np.array([len(blob) for blob in blobs], dtype=np.int64)
+
+    def decode_blocks(self, data, dtype, block_offsets, block_rows):
+        """
+
+        Decodes concatenated blocks. Block <i> takes bytes block_offsets[i]..block_offsets[i + 1] of data
+        and holds block_rows[i] values.
+
+        """
+        data = as_bytes(data)
+        decoded = [self.decode(data[block_offsets[i]:block_offsets[i + 1]], dtype)
+                   for i in xrange(len(block_rows))]
+        if len(decoded) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate(decoded)
+
+
+class RawCodec(Codec):
+    name = CODEC.RAW
+
+    def encode(self, array):
+        return np.ascontiguousarray(array).tostring()
+
+    def decode(self, data, dtype):
+        """
+
+        Returns view over given bytes, nothing is copied.
+
+        """
+        return as_bytes(data).view(dtype)
+
+    def encode_blocks(self, array, block_size):
+        array = np.ascontiguousarray(array)
+        block_rows = np.diff(np.append(np.arange(0, len(array), block_size), len(array)))
+        return array.tostring(), block_rows * array.itemsize
+
+    def decode_blocks(self, data, dtype, block_offsets, block_rows):
+        return self.decode(as_bytes(data)[block_offsets[0]:block_offsets[-1]], dtype)
+
+
+class DeltaVarintCodec(Codec):
+    name = CODEC.DELTA_VARINT
+
+    def encode(self, array):
+        """
+
+        Differences of neighbour values (the first value is kept as is) zigzag mapped to unsigned and
+        written as varints. Sorted document ids take one or two bytes per posting.
+
+        """
+        array = np.asarray(array, dtype=np.int64)
+        if len(array) == 0:
+            return ""
+        deltas = np.diff(array)
+        return varint_encode(zigzag_encode(np.concatenate((array[:1], deltas)))).tostring()
+
+    def decode(self, data, dtype):
+        return np.cumsum(zigzag_decode(varint_decode(as_bytes(data)))).astype(dtype)
+
+    def encode_blocks(self, array, block_size):
+        array = np.asarray(array, dtype=np.int64)
+        if len(array) == 0:
+            return "", np.zeros(0, dtype=np.int64)
+        block_starts = np.arange(0, len(array), block_size)
+        deltas = np.concatenate((array[:1], np.diff(array)))
+        deltas[block_starts] = array[block_starts]
+        values = zigzag_encode(deltas)
+        return varint_encode(values).tostring(), np.add.reduceat(varint_sizes(values), block_starts)
+
+    def decode_blocks(self, data, dtype, block_offsets, block_rows):
+        sums = np.cumsum(zigzag_decode(varint_decode(as_bytes(data)[block_offsets[0]:block_offsets[-1]])))
+        if len(sums) == 0:
+            return sums.astype(dtype)
+        row_starts = np.cumsum(block_rows) - block_rows
+        block_bases = np.concatenate(([0], sums[row_starts[1:] - 1]))
+        return (sums - np.repeat(block_bases, block_rows)).astype(dtype)
+
+
+class ForCodec(Codec):
+    name = CODEC.FOR
+    BLOCK_SZ = 128
+    HEADER_SZ = 17
+
+    def encode(self, array):
+        """
+
+        Frame of reference: values are split into frames of BLOCK_SZ, every frame stores its minimum and
+        bit width of the largest offset from it, offsets are bit packed.
+
+            count   uint64
+            bases   int64 [frames]
+            widths  uint8 [frames]
+            packed  offsets bits
+
+        """
+        array = np.asarray(array, dtype=np.int64)
+        frames_number = (len(array) + self.BLOCK_SZ - 1) // self.BLOCK_SZ
+        frame_starts = np.arange(frames_number) * self.BLOCK_SZ
+        if len(array) > 0:
+            bases = np.minimum.reduceat(array, frame_starts)
+            frame_index = np.arange(len(array)) // self.BLOCK_SZ
+            offsets = (array - bases[frame_index]).astype(np.uint64)
+            widths = bit_lengths(np.maximum.reduceat(offsets, frame_starts)).astype(np.uint8)
+            packed = pack_bits(offsets, widths[frame_index].astype(np.int64))
+        else:
+            bases = np.zeros(0, dtype=np.int64)
+            widths = np.zeros(0, dtype=np.uint8)
+            packed = np.zeros(0, dtype=np.uint8)
+        return "".join((
+            np.array([len(array)], dtype=np.uint64).tostring(),
+            bases.astype(np.int64).tostring(),
+            widths.tostring(),
+            packed.tostring(),
+        ))
+
+    def decode(self, data, dtype):
+        data = as_bytes(data)
+        count = int(data[:8].copy().view(np.uint64)[0])
+        frames_number = (count + self.BLOCK_SZ - 1) // self.BLOCK_SZ
+        bases_end = 8 + 8 * frames_number
+        bases = data[8:bases_end].copy().view(np.int64)
+        widths = data[bases_end:(bases_end + frames_number)]
+        frame_index = np.arange(count) // self.BLOCK_SZ
+        offsets = unpack_bits(data[(bases_end + frames_number):], widths[frame_index].astype(np.int64))
+        return (bases[frame_index] + offsets.astype(np.int64)).astype(dtype)
+
+    def decode_blocks(self, data, dtype, block_offsets, block_rows):
+        """
+
+        Blocks of up to BLOCK_SZ values are single frames with fixed size header, so headers and offsets
+        of all blocks are read at once.
+
+        """
+        block_rows = np.asarray(block_rows, dtype=np.int64)
+        if len(block_rows) == 0 or block_rows.max() > self.BLOCK_SZ:
+            return super(ForCodec, self).decode_blocks(data, dtype, block_offsets, block_rows)
+        data = as_bytes(data)
+        block_starts = np.asarray(block_offsets[:-1], dtype=np.int64)
+        bases = gather_words(data, block_starts + 8, np.int64)
+        widths = data[block_starts + 16].astype(np.int64)
+        row_block = np.repeat(np.arange(len(block_rows)), block_rows)
+        row_in_block = np.arange(len(row_block)) - np.repeat(np.cumsum(block_rows) - block_rows, block_rows)
+        bit_starts = (block_starts[row_block] + self.HEADER_SZ) * 8 + row_in_block * widths[row_block]
+        offsets = read_bits(data, bit_starts, widths[row_block])
+        return (bases[row_block] + offsets.astype(np.int64)).astype(dtype)
+
+
+class EliasFanoCodec(Codec):
+    name = CODEC.ELIAS_FANO
+    HEADER_SZ = 17
+
+    def encode(self, array):
+        """
+
+        Elias-Fano code of non-decreasing sequence (e.g. document ids column) relative to its first value.
+        Lower <l> bits of every value are bit packed, upper bits are stored in unary as a bit vector where
+        value <i> sets bit (value >> l) + i.
+
+            count   uint64
+            base    int64
+            l       uint8
+            lower   packed lower bits
+            upper   packed upper bits
+
+        """
+        array = np.asarray(array, dtype=np.int64)
+        count = len(array)
+        if count > 0 and np.any(np.diff(array) < 0):
+            raise Exception("Elias-Fano codec requires non-decreasing values.")
+        base = int(array[0]) if count > 0 else 0
+        values = (array - base).astype(np.uint64)
+        universe = int(values[-1]) + 1 if count > 0 else 0
+        low_bits = max(0, int(np.floor(np.log2(float(universe) / count)))) if count > 0 else 0
+        lower = pack_bits(values & np.uint64((1 << low_bits) - 1), np.repeat(low_bits, count))
+        upper_bits = np.zeros(count + (universe >> low_bits) + 1, dtype=np.uint8)
+        upper_bits[(values >> np.uint64(low_bits)).astype(np.int64) + np.arange(count)] = 1
+        return "".join((
+            np.array([count], dtype=np.uint64).tostring(),
+            np.array([base], dtype=np.int64).tostring(),
+            np.array([low_bits], dtype=np.uint8).tostring(),
+            lower.tostring(),
+            np.packbits(upper_bits).tostring(),
+        ))
+
+    def decode(self, data, dtype):
+        data = as_bytes(data)
+        count = int(data[:8].copy().view(np.uint64)[0])
+        base = int(data[8:16].copy().view(np.int64)[0])
+        low_bits = int(data[16])
+        lower_size = (count * low_bits + 7) // 8
+        lower = unpack_bits(data[17:(17 + lower_size)], np.repeat(low_bits, count))
+        upper = np.flatnonzero(np.unpackbits(data[(17 + lower_size):]))[:count] - np.arange(count)
+        values = (upper.astype(np.uint64) << np.uint64(low_bits)) | lower
+        return (values.astype(np.int64) + base).astype(dtype)
+
+    def encode_blocks(self, array, block_size):
+        """
+
+        Encodes all blocks at once, every block is the same as encode() of its values.
+
+        """
+        array = np.asarray(array, dtype=np.int64)
+        if len(array) == 0:
+            return "", np.zeros(0, dtype=np.int64)
+        block_starts = np.arange(0, len(array), block_size)
+        counts = np.diff(np.append(block_starts, len(array)))
+        decreasing = np.flatnonzero(np.diff(array) < 0) + 1
+        if np.any(decreasing % block_size != 0):
+            raise Exception("Elias-Fano codec requires non-decreasing values.")
+        row_block = np.repeat(np.arange(len(counts)), counts)
+        row_in_block = np.arange(len(array)) - block_starts[row_block]
+        bases = array[block_starts]
+        values = (array - bases[row_block]).astype(np.uint64)
+        universes = values[block_starts + counts - 1] + np.uint64(1)
+        low_bits = np.maximum(0, np.floor(np.log2(universes.astype(np.float64) / counts))).astype(np.int64)
+        lower_sizes = (counts * low_bits + 7) // 8
+        upper_sizes = (counts + (universes >> low_bits.astype(np.uint64)).astype(np.int64) + 1 + 7) // 8
+        block_sizes = self.HEADER_SZ + lower_sizes + upper_sizes
+        offsets = np.cumsum(block_sizes) - block_sizes
+        bits = np.zeros(block_sizes.sum() * 8, dtype=np.uint8)
+        row_bits = low_bits[row_block]
+        lower_starts = (offsets[row_block] + self.HEADER_SZ) * 8 + row_in_block * row_bits
+        for k in xrange(low_bits.max()):
+            mask = row_bits > k
+            shift = (row_bits[mask] - 1 - k).astype(np.uint64)
+            bits[lower_starts[mask] + k] = (values[mask] >> shift) & np.uint64(1)
+        upper_starts = (offsets + self.HEADER_SZ + lower_sizes) * 8
+        bits[upper_starts[row_block] + (values >> row_bits.astype(np.uint64)).astype(np.int64) + row_in_block] = 1
+        encoded = np.packbits(bits)
+        header_bytes = offsets[:, None] + np.arange(self.HEADER_SZ)
+        encoded[header_bytes[:, 0:8]] = counts.astype("<u8").view(np.uint8).reshape((-1, 8))
+        encoded[header_bytes[:, 8:16]] = bases.astype("<i8").view(np.uint8).reshape((-1, 8))
+        encoded[header_bytes[:, 16]] = low_bits
+        return encoded.tostring(), block_sizes
+
+    def decode_blocks(self, data, dtype, block_offsets, block_rows):
+        """
+
+        Decodes all blocks at once: lower bits are read in place and only upper bit vectors are unpacked,
+        they take about two bits per value.
+
+        """
+        block_rows = np.asarray(block_rows, dtype=np.int64)
+        if len(block_rows) == 0:
+            return np.zeros(0, dtype=dtype)
+        data = as_bytes(data)
+        block_offsets = np.asarray(block_offsets, dtype=np.int64)
+        block_starts = block_offsets[:-1]
+        bases = gather_words(data, block_starts + 8, np.int64)
+        low_bits = data[block_starts + 16].astype(np.int64)
+        lower_sizes = (block_rows * low_bits + 7) // 8
+        row_block = np.repeat(np.arange(len(block_rows)), block_rows)
+        row_in_block = np.arange(len(row_block)) - np.repeat(np.cumsum(block_rows) - block_rows, block_rows)
+        row_bits = low_bits[row_block]
+        lower = read_bits(data, (block_starts[row_block] + self.HEADER_SZ) * 8 + row_in_block * row_bits, row_bits)
+        # Every block sets exactly one upper bit per value, so set bits of all blocks come in row order.
+        upper, upper_offsets = gather_ranges(data, block_starts + self.HEADER_SZ + lower_sizes, block_offsets[1:])
+        upper = np.flatnonzero(np.unpackbits(upper)) - upper_offsets[row_block] * 8 - row_in_block
+        values = (upper.astype(np.uint64) << row_bits.astype(np.uint64)) | lower
+        return (values.astype(np.int64) + bases[row_block]).astype(dtype)
+
+
+class BitmapCodec(Codec):
+    name = CODEC.BITMAP
+    ARRAY_CONTAINER = 0
+    BITMAP_CONTAINER = 1
+    DENSITY_THRESHOLD = 1.0 / 8
+    HEADER_SZ = 13
+
+    def __init__(self):
+        self.array_codec = DeltaVarintCodec()
+
+    def encode(self, array):
+        """
+
+        Roaring-style containers: every encoded array (a block of posting list) is stored either as delta
+        varint array container or, when values are non-decreasing and dense enough, as bitmap container.
+        Bitmap takes one bit for every value in [min, max] range, so it is chosen when share of distinct
+        values in the range is at least DENSITY_THRESHOLD, where it is never larger than one varint byte
+        per value. Repeated values are stored after the bitmap as delta varints.
+
+            type    uint8               ARRAY_CONTAINER
+            values  delta varints
+
+            type    uint8               BITMAP_CONTAINER
+            base    int64
+            range   uint32
+            bitmap  packed bits [range]
+            repeats delta varints
+
+        """
+        array = np.asarray(array, dtype=np.int64)
+        if len(array) > 0 and np.all(np.diff(array) >= 0):
+            base = int(array[0])
+            value_range = int(array[-1]) - base + 1
+            first = np.concatenate(([True], np.diff(array) > 0))
+            if value_range < (1 << 32) and np.count_nonzero(first) >= value_range * self.DENSITY_THRESHOLD:
+                bits = np.zeros(value_range, dtype=np.uint8)
+                bits[array - base] = 1
+                return "".join((
+                    np.array([self.BITMAP_CONTAINER], dtype=np.uint8).tostring(),
+                    np.array([base], dtype=np.int64).tostring(),
+                    np.array([value_range], dtype=np.uint32).tostring(),
+                    np.packbits(bits).tostring(),
+                    self.array_codec.encode(array[~first]),
+                ))
+        return np.array([self.ARRAY_CONTAINER], dtype=np.uint8).tostring() + self.array_codec.encode(array)
+
+    def decode(self, data, dtype):
+        data = as_bytes(data)
+        if len(data) == 0:
+            return np.zeros(0, dtype=dtype)
+        if data[0] == self.ARRAY_CONTAINER:
+            return self.array_codec.decode(data[1:], dtype)
+        base = int(data[1:9].copy().view(np.int64)[0])
+        value_range = int(data[9:self.HEADER_SZ].copy().view(np.uint32)[0])
+        bitmap_end = self.HEADER_SZ + (value_range + 7) // 8
+        values = np.flatnonzero(np.unpackbits(data[self.HEADER_SZ:bitmap_end])[:value_range]) + base
+        if bitmap_end < len(data):
+            values = np.sort(np.concatenate((values, self.array_codec.decode(data[bitmap_end:], np.int64))))
+        return values.astype(dtype)
+
+
+CODECS = {
+    CODEC.RAW: RawCodec,
+    CODEC.DELTA_VARINT: DeltaVarintCodec,
+    CODEC.FOR: ForCodec,
+    CODEC.ELIAS_FANO: EliasFanoCodec,
+    CODEC.BITMAP: BitmapCodec,
+}
+
+
+def get_codec(codec_name):
+    if codec_name not in CODECS:
+        raise Exception("Wrong codec %r" % codec_name)
+    return CODECS[codec_name]()
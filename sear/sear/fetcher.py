@@ -0,0 +1,78 @@
+# coding: utf-8
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+
+import logging
+import itertools
+import collections
+
+from multiprocessing.pool import ThreadPool
+
+
+def iter_batches(items, batch_size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+class DocumentFetcher(object):
+    LOOKAHEAD = 1024
+    BATCH_SZ = 64
+
+    def __init__(self, storage, decode=None, jobs=2, lookahead=None, batch_size=None):
+        """
+
+        Reads and decodes documents ahead of the consumer on a pool of <jobs> threads, so reading overlaps
+        with processing of already fetched documents. Ids are read by batches of <batch_size> with
+        storage.get_documents and <decode> is applied to every read document in the same thread. At most
+        <lookahead> documents are read but not consumed yet. With <jobs> = 0 documents are read when
+        they are consumed.
+
+        """
+        self.storage = storage
+        self.decode = decode
+        self.batch_size = batch_size if batch_size is not None else self.BATCH_SZ
+        lookahead = lookahead if lookahead is not None else self.LOOKAHEAD
+        self.max_pending = max(1, lookahead // self.batch_size)
+        self.jobs = jobs
+        self.pool = ThreadPool(jobs) if jobs > 0 else None
+
+    def read_batch(self, document_ids):
+        documents = []
+        for document_id, document in self.storage.get_documents(document_ids):
+            if document is not None and self.decode is not None:
+                document = self.decode(document)
+            documents.append((document_id, document))
+        return documents
+
+    def fetch(self, document_ids):
+        """
+
+        Iterates over (document_id, document) pairs in order of <document_ids>, document is None if it is
+        not in storage. Errors of reading or decoding are raised when the failed batch is consumed.
+
+        """
+        batches = iter_batches(document_ids, self.batch_size)
+        if self.pool is None:
+            for batch in batches:
+                for document_id, document in self.read_batch(batch):
+                    yield document_id, document
+            return
+        pending = collections.deque()
+        for batch in itertools.islice(batches, self.max_pending):
+            pending.append(self.pool.apply_async(self.read_batch, (batch,)))
+        while len(pending) > 0:
+            documents = pending.popleft().get()
+            for batch in itertools.islice(batches, 1):
+                pending.append(self.pool.apply_async(self.read_batch, (batch,)))
+            for document_id, document in documents:
+                yield document_id, document
+
+    def close(self):
+        if self.pool is not None:
+            logging.info("Fetcher: stopping %d threads." % self.jobs)
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
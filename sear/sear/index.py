@@ -5,10 +5,31 @@ import os
 import gc
 import abc
 import json
+import math
+import shutil
 import leveldb
 import logging
+import threading
 import numpy as np
 
+from sear.codec import CODEC
+from sear.cache import LruCache
+from sear.codec import get_codec
+from sear.segment import LdbSegment
+from sear.segment import gather_ranges
+from sear.segment import map_array
+from sear.segment import merge_stats
+from sear.segment import TermStats
+from sear.segment import TERM_STATS_DTYPE
+from sear.segment import MmapSegment
+from sear.partition import PartitionTable
+
+
+class INDEX_FORMAT:
+
+    LDB = "LDB"
+    MMAP = "MMAP"
+
 
 class Document(object):
     """
@@ -44,6 +65,22 @@ class Document(object):
         """
         return NotImplementedError("Document is abstract class")
 
+    def tocolumns(self, columns):
+        """
+
+        Returns list of string representations of given columns of document, used by storage with columns.
+
+        """
+        raise NotImplementedError("%s has no columns" % self.__class__.__name__)
+
+    def fromcolumns(self, columns, values):
+        """
+
+        Loads given columns of document from their string representations.
+
+        """
+        raise NotImplementedError("%s has no columns" % self.__class__.__name__)
+
     @abc.abstractmethod
     def terms(self):
         """
@@ -123,8 +160,21 @@ class PostingList(object):
         plist.fields = [None] * fields_number
         return plist
 
+    @staticmethod
+    def create_from_fields(fields):
+        plist = PostingList()
+        plist.fields = fields
+        plist.size = len(fields[0])
+        plist.capacity = plist.size
+        return plist
+
+    @staticmethod
+    def create_blank(field_properties):
+        return PostingList.create_from_fields([np.zeros(0, dtype=p[1]) for p in field_properties])
+
     def set_field(self, field_index, raw_field, property_type):
         self.fields[field_index] = np.fromstring(raw_field, property_type)
+        self.size = len(self.fields[field_index])
 
     def add(self, vector):
         if self.size == self.capacity:
@@ -150,6 +200,79 @@ class PostingList(object):
         return self.size
 
 
+class PostingBuffer(object):
+    INIT_SZ = 1024 * 1024
+
+    def __init__(self, field_properties):
+        """
+
+        Append-only column buffer of (term_id, field_1, ..., field_n) rows used for bulk inversion.
+        Rows are appended in document order and turned into posting lists at once when flushed.
+
+        """
+        self.size = 0
+        self.capacity = self.INIT_SZ
+        self.term_ids = np.empty(self.capacity, dtype=np.int64)
+        self.fields = [np.empty(self.capacity, dtype=p[1]) for p in field_properties]
+
+    def reserve(self, rows_number):
+        if self.size + rows_number <= self.capacity:
+            return
+        while self.capacity < self.size + rows_number:
+            self.capacity *= 2
+        new_term_ids = np.empty(self.capacity, dtype=self.term_ids.dtype)
+        new_term_ids[:self.size] = self.term_ids[:self.size]
+        self.term_ids = new_term_ids
+        for i in xrange(len(self.fields)):
+            new_data = np.empty(self.capacity, dtype=self.fields[i].dtype)
+            new_data[:self.size] = self.fields[i][:self.size]
+            self.fields[i] = new_data
+
+    def append(self, document_id, vectors):
+        """
+
+        Appends property vectors of the document. First element of every vector is term id, it is
+        replaced by document id in the first field as in PostingList. Returns number of added rows.
+
+        """
+        if len(vectors) == 0:
+            return 0
+        vectors = np.asarray(vectors)
+        rows_number = len(vectors)
+        self.reserve(rows_number)
+        start, end = self.size, self.size + rows_number
+        self.term_ids[start:end] = vectors[:, 0]
+        self.fields[0][start:end] = document_id
+        for i in xrange(1, len(self.fields)):
+            self.fields[i][start:end] = vectors[:, i]
+        self.size = end
+        return rows_number
+
+    def invert(self):
+        """
+
+        Iterates over (term_id, [field arrays]) posting lists built from buffered rows in term id order.
+        Stable sort keeps postings of every term in the order they were appended.
+
+        """
+        if self.size == 0:
+            return
+        order = np.argsort(self.term_ids[:self.size], kind="mergesort")
+        term_ids = self.term_ids[:self.size][order]
+        fields = [field[:self.size][order] for field in self.fields]
+        unique_term_ids = term_ids[np.concatenate(([0], np.flatnonzero(np.diff(term_ids)) + 1))]
+        starts = np.searchsorted(term_ids, unique_term_ids, side="left")
+        ends = np.searchsorted(term_ids, unique_term_ids, side="right")
+        for i in xrange(len(unique_term_ids)):
+            yield int(unique_term_ids[i]), [field[starts[i]:ends[i]] for field in fields]
+
+    def clear(self):
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+
 def dtype_to_name(dt):
     if dt == np.int8:
         return "i1"
@@ -175,36 +298,97 @@ def name_to_dtype(dt):
 class InvertedIndex(object):
     INDEX_KEY_SEP = chr(255)
     BARRELS_DIR = "barrels.ldb"
+    SEGMENT_DIRS = {
+        INDEX_FORMAT.LDB: "barrels.%d.ldb",
+        INDEX_FORMAT.MMAP: "barrels.%d.seg",
+    }
+    SEGMENT_TYPES = {
+        INDEX_FORMAT.LDB: LdbSegment,
+        INDEX_FORMAT.MMAP: MmapSegment,
+    }
     META_FILE = "index.json"
+    STATS_FILE = "index.stats"
+    SEGMENT_STATS_FILE = "%s.stats"
+    PARTITION_DIR = "partitions.%s"
     BATCH_SZ = 4096 * 1024
     CACHE_SZ = 32000 * 4096
+    PLIST_CACHE_SZ = 256 * 1024 * 1024
+    COMPACTION_FANOUT = 4
 
-    def __init__(self, root_directory, field_properties=None):
+    def __init__(self, root_directory, field_properties=None, index_format=INDEX_FORMAT.LDB,
+                 background_compaction=True, bulk_mode=False, field_codecs=None, plist_cache_bytes=None,
+                 partition_fields=None):
         self.root = root_directory
         self.term_plists = dict()
         self.field_keys = dict()
         self.field_properties = field_properties
+        self.field_codecs = None                        # codec instance per field
+        self.index_format = index_format
         self.documents_number = 0
+        self.next_document = 0                          # id greater than ids of all added documents
         self.terms_number = 0
-        self.barrels_ldb = None
+        self.segments_meta = []                         # [{"name": <dir name>, "postings": <int>}] oldest first
+        self.segments = dict()                          # segment dir name -> opened segment
+        self.next_segment = 0                           # number of the next segment to be written
+        self.segments_lock = threading.RLock()
+        self.background_compaction = background_compaction
+        self.compaction_thread = None
+        self.compaction_lock = threading.Lock()         # compaction runs one at a time
+        self.bulk_mode = bulk_mode
+        self.posting_buffer = None                      # column buffer used in bulk mode instead of term_plists
+        self.opened = False
         self.cache_size = 0
+        self.generation = 0                             # changes when indexed postings change
+        self.term_stats = None                          # TERM_STATS_DTYPE table indexed by term id
+        self.arena_offsets = None                       # term id -> first posting in arena, set by load()
+        self.arena_fields = None                        # one contiguous array per field, set by load()
+        self.plist_cache = LruCache(plist_cache_bytes if plist_cache_bytes is not None else self.PLIST_CACHE_SZ,
+                                    name="Posting lists cache")
+        self.partition_fields = list(partition_fields) if partition_fields is not None else []
+        self.partitions = dict()                        # field name -> (PartitionTable, secondary index)
         if field_properties is not None:
             i = 0
             for field_name, _ in self.field_properties:
                 self.field_keys[field_name] = i
                 i += 1
+            if field_codecs is None:
+                field_codecs = dict()
+            self.field_codecs = [get_codec(field_codecs.get(p[0], CODEC.RAW)) for p in field_properties]
 
     def init_index(self):
         if not os.path.exists(self.root):
             os.mkdir(self.root)
-        if not os.path.exists(os.path.join(self.root, self.BARRELS_DIR)):
-            os.mkdir(os.path.join(self.root, self.BARRELS_DIR))
+        if self.index_format not in self.SEGMENT_TYPES:
+            raise Exception("Wrong index format %r" % self.index_format)
+        for field_name in self.partition_fields:
+            if field_name not in self.field_keys:
+                raise Exception("Unknown partition field %r" % field_name)
+            if self.field_keys[field_name] == 0:
+                raise Exception("Document id field %r can not be partitioned." % field_name)
+            self.partition_index(field_name).init_index()
         self.dump_meta()
 
+    def partition_index(self, field_name):
+        """
+
+        Returns secondary index of <field_name> partitions. It has the same fields as this index, but its
+        term ids are ids of (term id, field value) pairs from the partitions table, so postings of a term
+        with a given field value form their own posting list.
+
+        """
+        return InvertedIndex(os.path.join(self.root, self.PARTITION_DIR % field_name),
+                             field_properties=self.field_properties,
+                             index_format=self.index_format,
+                             background_compaction=self.background_compaction,
+                             bulk_mode=self.bulk_mode,
+                             field_codecs=dict((p[0], c.name) for p, c in zip(self.field_properties,
+                                                                            self.field_codecs)))
+
     def dump_meta(self):
-        meta_file = open(os.path.join(self.root, self.META_FILE), "w")
-        meta_file.write(self.dumps_meta())
-        meta_file.close()
+        with self.segments_lock:
+            meta_file = open(os.path.join(self.root, self.META_FILE), "w")
+            meta_file.write(self.dumps_meta())
+            meta_file.close()
 
     def load_meta(self):
         meta_file = open(os.path.join(self.root, self.META_FILE), "r")
@@ -215,150 +399,646 @@ class InvertedIndex(object):
     def dumps_meta(self):
         return json.dumps({
             "documents_number": self.documents_number,
+            "next_document": self.next_document,
             "terms_number": self.terms_number,
-            "fields": [{"name": p[0], "type": dtype_to_name(p[1])} for p in self.field_properties]
+            "format": self.index_format,
+            "segments": self.segments_meta,
+            "next_segment": self.next_segment,
+            "partitions": self.partition_fields,
+            "fields": [{"name": p[0], "type": dtype_to_name(p[1]), "codec": c.name}
+                       for p, c in zip(self.field_properties, self.field_codecs)]
         }, indent=8)
 
     def loads_meta(self, meta_str):
         meta = json.loads(meta_str)
         self.documents_number = meta["documents_number"]
+        self.next_document = meta.get("next_document", self.documents_number)
         self.terms_number = meta["terms_number"]
+        self.index_format = meta.get("format", INDEX_FORMAT.LDB)
+        if "segments" in meta:
+            self.segments_meta = meta["segments"]
+            self.next_segment = meta["next_segment"]
+        elif os.path.exists(os.path.join(self.root, self.BARRELS_DIR)):
+            # Index written before segments were introduced, all postings are in a single leveldb.
+            self.segments_meta = [{"name": self.BARRELS_DIR, "postings": self.terms_number}]
+            self.next_segment = 0
         self.field_properties = [(p["name"], name_to_dtype(p["type"])) for p in meta["fields"]]
+        self.field_codecs = [get_codec(p.get("codec", CODEC.RAW)) for p in meta["fields"]]
+        self.partition_fields = meta.get("partitions", [])
         i = 0
         for field_name, _ in self.field_properties:
             self.field_keys[field_name] = i
             i += 1
 
+    def open_segment(self, segment_name):
+        segment_type = self.SEGMENT_TYPES[self.index_format]
+        return segment_type(os.path.join(self.root, segment_name), self.field_properties, self.field_codecs).open()
+
     def open(self):
-        if self.barrels_ldb is not None:
+        if self.opened:
             raise Exception("Index is already opened.")
         self.load_meta()
-        self.barrels_ldb = leveldb.LevelDB(os.path.join(self.root, self.BARRELS_DIR))
+        if self.index_format not in self.SEGMENT_TYPES:
+            raise Exception("Wrong index format %r" % self.index_format)
+        for segment_meta in self.segments_meta:
+            self.segments[segment_meta["name"]] = self.open_segment(segment_meta["name"])
+        stats_path = os.path.join(self.root, self.STATS_FILE)
+        if os.path.exists(stats_path):
+            self.term_stats = map_array(stats_path, TERM_STATS_DTYPE)
+        if self.bulk_mode:
+            self.posting_buffer = PostingBuffer(self.field_properties)
+        for field_name in self.partition_fields:
+            partition_index = self.partition_index(field_name)
+            partition_index.open()
+            self.partitions[field_name] = (PartitionTable(partition_index.root).load(), partition_index)
+        self.opened = True
+
+    def list_segments(self):
+        """
+
+        Returns opened segments ordered from the oldest to the newest.
+
+        """
+        with self.segments_lock:
+            return [self.segments[segment_meta["name"]] for segment_meta in self.segments_meta]
+
+    def term_ids(self, segments=None):
+        """
+
+        Returns sorted array of ids of terms which have postings in any of given (or all) segments.
+
+        """
+        if segments is None:
+            segments = self.list_segments()
+        if len(segments) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate([segment.term_ids() for segment in segments]))
+
+    def merge_fields(self, term_id, segments, doc_ids=None):
+        """
+
+        Returns fields of the term posting list merged across given segments or None if there are no
+        postings. Segments hold consecutive document ranges, so merging is concatenation in segment order.
+        If sorted <doc_ids> are given, segments may skip blocks which can not contain them.
+
+        """
+        segment_fields = []
+        for segment in segments:
+            fields = segment.get_fields(term_id, doc_ids)
+            if fields is not None:
+                segment_fields.append(fields)
+        if len(segment_fields) == 0:
+            return None
+        if len(segment_fields) == 1:
+            return segment_fields[0]
+        return [np.concatenate([fields[i] for fields in segment_fields])
+                for i in xrange(len(self.field_properties))]
+
+    def update_stats(self):
+        """
+
+        Rebuilds terms statistics table from statistics of current segments and saves it. Indexes written
+        before statistics were introduced have segments without them and get no table.
+
+        """
+        with self.segments_lock:
+            tables = []
+            for segment_meta in self.segments_meta:
+                segment_stats_path = os.path.join(self.root, self.SEGMENT_STATS_FILE % segment_meta["name"])
+                if not os.path.exists(segment_stats_path):
+                    self.term_stats = None
+                    return
+                tables.append(np.fromfile(segment_stats_path, dtype=TERM_STATS_DTYPE))
+            self.term_stats = merge_stats(tables)
+            stats_path = os.path.join(self.root, self.STATS_FILE)
+            self.term_stats.tofile(stats_path + ".tmp")
+            os.rename(stats_path + ".tmp", stats_path)
+
+    def get_term_stats(self, term_id):
+        """
+
+        Returns statistics record of the term (see TERM_STATS_DTYPE) or None if index has no statistics.
+
+        """
+        if self.term_stats is None:
+            return None
+        if term_id < 0 or term_id >= len(self.term_stats):
+            return np.array((0, 0, 0, -1, -1), dtype=TERM_STATS_DTYPE)
+        return self.term_stats[term_id]
+
+    def postings_number(self, term_id):
+        """
+
+        Returns number of postings of the term across all segments. It is read from terms statistics table
+        or from segment tables, posting lists are not decoded, so it is cheap enough to be used for query
+        planning.
+
+        """
+        term_stats = self.get_term_stats(term_id)
+        if term_stats is not None:
+            return int(term_stats["postings"])
+        with self.segments_lock:
+            return sum(segment.postings_number(term_id) for segment in self.list_segments())
+
+    def document_frequency(self, term_id):
+        """
+
+        Returns number of distinct documents of the term, or number of its postings as an upper bound if
+        index has no statistics.
+
+        """
+        term_stats = self.get_term_stats(term_id)
+        if term_stats is not None:
+            return int(term_stats["df"])
+        return self.postings_number(term_id)
+
+    def next_document_id(self):
+        """
+
+        Returns id greater than ids of all indexed documents, so new documents can be appended to the index
+        as a new segment. Parsers may skip ids of broken documents, so it is not a number of documents.
+        Indexes which do not keep it in meta use statistics table to check actual maximum id.
+
+        """
+        next_id = max(self.documents_number, self.next_document)
+        if self.term_stats is not None and len(self.term_stats) > 0:
+            next_id = max(next_id, int(self.term_stats["max_doc"].max()) + 1)
+        return next_id
+
+    def find_partition(self, term_id, constraints):
+        """
+
+        Looks for a secondary partition which holds postings of the term satisfying one of <constraints>:
+        equality constraint on a partitioned field. Returns (secondary index, partition id, remaining
+        constraints) or None. Partition id is -1 if the term has no postings with such field value.
+
+        """
+        for i, constraint in enumerate(constraints):
+            if len(constraint) == 3 and constraint[1] == "==" and constraint[0] in self.partitions:
+                table, partition_index = self.partitions[constraint[0]]
+                remaining = list(constraints[:i]) + list(constraints[(i + 1):])
+                return partition_index, table.get_id(term_id, constraint[2]), remaining
+        return None
 
     def load(self):
+        """
+
+        Preloads all posting lists to memory as arena: one contiguous array per field and offsets array
+        indexed by term id. Posting lists are then served as slices of the arena arrays.
+
+        """
         logging.info("Loading posting lists to memory.")
-        total_plists = 0
-        total_bytes = 0
-        term_plists = dict()
-        properties_number = len(self.field_properties)
-        for field_key, field_value in self.barrels_ldb.RangeIter():
-            term_id, field_name = field_key.split(self.INDEX_KEY_SEP)
-            term_id = int(term_id)
-            if term_id in term_plists:
-                plist = term_plists[term_id]
+        segments = self.list_segments()
+        if len(segments) == 1 and hasattr(segments[0], "load_arena"):
+            offsets, fields = segments[0].load_arena()
+        else:
+            term_ids = self.term_ids(segments)
+            rows_number = sum(segment_meta["postings"] for segment_meta in self.segments_meta)
+            fields = [np.empty(rows_number, dtype=p[1]) for p in self.field_properties]
+            offsets = np.zeros(term_ids[-1] + 2 if len(term_ids) > 0 else 1, dtype=np.int64)
+            if len(segments) == 1:
+                term_fields = segments[0].iter_terms()
             else:
-                plist = PostingList.create_empty(properties_number)
-                term_plists[term_id] = plist
-            field_index = self.field_keys[field_name]
-            plist.set_field(field_index, field_value, self.field_properties[field_index][1])
-            total_bytes += len(field_value)
-            total_plists += 1
-        self.term_plists = [None] * len(term_plists)
-        for plist_index, plist in term_plists.iteritems():
-            self.term_plists[plist_index] = plist
-        logging.info("Loaded %d (%d) posting lists." % (total_plists, len(self.term_plists)))
-        logging.info("Loaded %d MB." % (total_bytes / (1024 * 1024)))
-        gc.collect()
+                term_fields = ((term_id, self.merge_fields(term_id, segments)) for term_id in term_ids)
+            rows = 0
+            written_terms = []
+            for term_id, plist_fields in term_fields:
+                term_rows = len(plist_fields[0])
+                for field, term_field in zip(fields, plist_fields):
+                    field[rows:(rows + term_rows)] = term_field
+                rows += term_rows
+                offsets[term_id + 1] = term_rows
+                written_terms.append(term_id)
+            fields = [field[:rows] for field in fields]
+            # Leveldb segments are iterated in key order, which is not the term id order.
+            written_terms = np.array(written_terms, dtype=np.int64)
+            if np.any(np.diff(written_terms) < 0):
+                term_rows = offsets[written_terms + 1]
+                term_starts = np.cumsum(term_rows) - term_rows
+                order = np.argsort(written_terms)
+                index, _ = gather_ranges(np.arange(rows),
+                                         term_starts[order],
+                                         term_starts[order] + term_rows[order])
+                fields = [field[index] for field in fields]
+            offsets = np.cumsum(offsets)
+        self.arena_offsets = offsets
+        self.arena_fields = fields
+        logging.info("Loaded %d postings of %d terms." % (offsets[-1], np.count_nonzero(np.diff(offsets))))
+        logging.info("Loaded %d MB." % (sum(field.nbytes for field in fields) / (1024 * 1024)))
+        for _, partition_index in self.partitions.itervalues():
+            partition_index.load()
+
+    def arena_fields_of(self, term_id):
+        if term_id < 0 or term_id + 1 >= len(self.arena_offsets):
+            return None
+        start, end = self.arena_offsets[term_id], self.arena_offsets[term_id + 1]
+        if start == end:
+            return None
+        return [field[start:end] for field in self.arena_fields]
+
+    def read_fields(self, term_id, doc_ids=None):
+        """
+
+        Returns fields of the term posting list from the arena, if index is preloaded, or from segments.
+
+        """
+        if self.arena_offsets is not None:
+            return self.arena_fields_of(term_id)
+        with self.segments_lock:
+            return self.merge_fields(term_id, self.list_segments(), doc_ids)
 
-    def load_plist(self, term_id):
-        plist = PostingList.create_empty(len(self.field_properties))
-        for i in xrange(len(self.field_properties)):
-            key = str(term_id) + self.INDEX_KEY_SEP + str(i)
-            field_blob = self.barrels_ldb.Get(key)
-            plist.set_field(i, field_blob, self.field_properties[i][1])
-            logging.debug("Loaded %d field for %d term (%d bytes)" % (i, term_id, len(field_blob)))
+    def load_plist(self, term_id, doc_ids=None):
+        """
+
+        Loads posting list of the term. If sorted array of <doc_ids> is given, returned posting list
+        contains all postings with these document ids, but may skip (some of) the others.
+
+        Complete posting lists are kept in LRU cache shared by all readers of the index, so returned
+        posting lists should not be modified. Lists read partially for given <doc_ids> are not cached,
+        but are still served from the cache when a complete one is there.
+
+        """
+        if self.arena_offsets is not None:
+            fields = self.arena_fields_of(term_id)
+            if fields is None:
+                return PostingList.create_blank(self.field_properties)
+            return PostingList.create_from_fields(fields)
+        plist = self.plist_cache.get(term_id)
+        if plist is not None:
+            return plist
+        with self.segments_lock:
+            fields = self.merge_fields(term_id, self.list_segments(), doc_ids)
+        if fields is None:
+            plist = PostingList.create_blank(self.field_properties)
+        else:
+            plist = PostingList.create_from_fields(fields)
+        if doc_ids is None:
+            self.plist_cache.put(term_id, plist, sum(field.nbytes for field in plist.fields))
         return plist
 
-    def load_plists(self, term_ids, old_plists=None, max_cache_size=1024):
+    def load_bitmap(self, term_id):
+        """
+
+        Returns documents of the term as a packed bit array (np.packbits order), bit <d> is set when
+        document <d> has the term. Bitmaps are kept in posting lists cache, where a dense term takes
+        documents_number / 8 bytes instead of several bytes per posting.
+
+        """
+        cache_key = ("bitmap", term_id)
+        bitmap = self.plist_cache.get(cache_key)
+        if bitmap is not None:
+            return bitmap
+        fields = self.read_fields(term_id)
+        doc_ids = fields[0].astype(np.int64) if fields is not None else np.zeros(0, dtype=np.int64)
+        bits_number = max(self.documents_number, doc_ids.max() + 1 if len(doc_ids) > 0 else 0)
+        bitmap = np.zeros((bits_number + 7) // 8, dtype=np.uint8)
+        np.bitwise_or.at(bitmap, doc_ids >> 3, np.left_shift(1, 7 - (doc_ids & 7)).astype(np.uint8))
+        self.plist_cache.put(cache_key, bitmap, bitmap.nbytes)
+        return bitmap
+
+    def impact_blocks(self, term_id, field_index, first_batch=1):
+        """
+
+        Iterates over (bound, [field arrays]) batches of posting list blocks in decreasing order of maximal
+        value of the field in a block, so a reader looking for postings with the highest field values can
+        stop early. <bound> is the maximal field value in the batch and in all following batches. Batches
+        start from <first_batch> blocks and double in size. If posting list is in memory already or some
+        segment has no block table, the whole list is returned as a single batch.
+
+        Segments are locked only while a batch is read, never between batches. If segments are compacted
+        meanwhile, the rest of postings comes as the whole posting list in the last batch.
+
+        """
+        with self.segments_lock:
+            segments = [segment for segment in self.list_segments() if segment.postings_number(term_id) > 0]
+            maxima = None
+            if self.arena_offsets is None and term_id not in self.plist_cache:
+                maxima = [segment.block_maxima(term_id, field_index) for segment in segments]
+        if maxima is None or any(segment_maxima is None for segment_maxima in maxima):
+            plist = self.load_plist(term_id)
+            if len(plist) > 0:
+                yield int(plist.fields[field_index].max()), plist.fields
+            return
+        if len(segments) == 0:
+            return
+        block_segments = np.concatenate([np.repeat(i, len(m)) for i, m in enumerate(maxima)])
+        block_numbers = np.concatenate([np.arange(len(m)) for m in maxima])
+        maxima = np.concatenate(maxima)
+        order = np.argsort(-maxima, kind="mergesort")
+        start, batch_size = 0, max(first_batch, 1)
+        while start < len(order):
+            batch = order[start:(start + batch_size)]
+            batch_fields = None
+            with self.segments_lock:
+                current_segments = self.list_segments()
+                if all(segment in current_segments for segment in segments):
+                    batch_fields = []
+                    for i, segment in enumerate(segments):
+                        blocks = np.sort(block_numbers[batch[block_segments[batch] == i]])
+                        if len(blocks) > 0:
+                            batch_fields.append(segment.get_fields(term_id, blocks=blocks))
+            if batch_fields is None:
+                plist = self.load_plist(term_id)
+                if len(plist) > 0:
+                    yield int(plist.fields[field_index].max()), plist.fields
+                return
+            fields = [np.concatenate([fields[i] for fields in batch_fields])
+                      for i in xrange(len(self.field_properties))]
+            yield int(maxima[batch[0]]), fields
+            start += batch_size
+            batch_size *= 2
+
+    def load_plists(self, term_ids):
         plists = dict()
-        if old_plists is None:
-            old_plists = dict()
-        not_loaded = []
         for term_id in term_ids:
-            if term_id in old_plists:
-                plists[term_id] = old_plists[term_id]
-                del old_plists[term_id]
-            else:
-                not_loaded.append(term_id)
-        for key in old_plists.keys():
-            if len(old_plists) <= max_cache_size:
-                break
-            del old_plists[key]
-        gc.collect()
-        for term_id in not_loaded:
             plists[term_id] = self.load_plist(term_id)
         return plists
 
     def get_plists(self, term_ids):
+        """
+
+        Returns posting lists of preloaded index as slices of the arena arrays, nothing is copied.
+
+        """
+        if self.arena_offsets is None:
+            raise Exception("Index should be loaded in order to get posting lists.")
         barrels = dict()
         for term_id in term_ids:
-            barrels[term_id] = self.term_plists[term_id]
+            fields = self.arena_fields_of(term_id)
+            if fields is None:
+                barrels[term_id] = PostingList.create_blank(self.field_properties)
+            else:
+                barrels[term_id] = PostingList.create_from_fields(fields)
         return barrels
 
+    def new_segment_name(self):
+        with self.segments_lock:
+            segment_name = self.SEGMENT_DIRS[self.index_format] % self.next_segment
+            self.next_segment += 1
+            return segment_name
+
+    def write_segment(self, segment_name, term_fields, root_directory=None):
+        """
+
+        Writes segment and its terms statistics to index directory or to <root_directory> of another index
+        with the same fields. Returns number of written postings.
+
+        """
+        if root_directory is None:
+            root_directory = self.root
+        segment_type = self.SEGMENT_TYPES[self.index_format]
+        term_stats = TermStats()
+        postings = segment_type.write(os.path.join(root_directory, segment_name),
+                                      self.field_properties,
+                                      self.field_codecs,
+                                      term_fields,
+                                      term_stats)
+        term_stats.table().tofile(os.path.join(root_directory, self.SEGMENT_STATS_FILE % segment_name))
+        return postings
+
     def dump_and_merge(self):
-        if self.barrels_ldb is None:
+        """
+
+        Flushes in-memory posting lists as a new immutable delta segment. Postings already on disk are
+        never read or rewritten here, merging of segments is left to compaction.
+
+        """
+        if not self.opened:
             raise Exception("Index is not opened.")
 
-        m = len(self.field_properties)
-        batch = leveldb.WriteBatch()
-        logging.info("Storage: merging index with new batch [%d x %d posting lists]." % (
-            len(self.term_plists),
-            len(self.field_properties),
-        ))
-
-        for plist_key, plist in self.term_plists.iteritems():
-
-            prime_key = str(plist_key) + self.INDEX_KEY_SEP + "0"
-
-            try:
-                prime_key_val = self.barrels_ldb.Get(prime_key)
-                key_exist = prime_key_val is not None
-            except KeyError:
-                key_exist = False
-
-            for j in xrange(m):
-                key = str(plist_key) + self.INDEX_KEY_SEP + str(j)
-                if key_exist:
-                    old_value = np.fromstring(self.barrels_ldb.Get(prime_key), self.field_properties[j][1])
-                    add_value = plist.fields[j][:plist.size]
-                    new_value = np.concatenate((old_value, add_value))
-                else:
-                    #old_value = np.array([], self.field_properties[j][1])
-                    #add_value = plist.fields[j][:plist.size]
-                    #new_value = add_value
-                    new_value = plist.fields[j][:plist.size]
-                batch.Put(key, new_value.tostring())
-
-            #if i % self.BATCH_SZ == 0:
-            #    self.barrels_ldb.Write(batch, sync=False)
-            #    batch = leveldb.WriteBatch()
-
-            #i += 1
-
-        self.barrels_ldb.Write(batch, sync=False)
+        if self.cache_size > 0:
+            if self.posting_buffer is not None:
+                term_fields = self.posting_buffer.invert()
+            else:
+                term_fields = ((term_id, [field[:plist.size] for field in plist.fields])
+                               for term_id, plist in sorted(self.term_plists.iteritems()))
+            logging.info("Storage: writing new segment [%d postings x %d fields]." % (
+                self.cache_size,
+                len(self.field_properties),
+            ))
+            segment_name = self.new_segment_name()
+            postings = self.write_segment(segment_name, term_fields)
+            with self.segments_lock:
+                self.segments[segment_name] = self.open_segment(segment_name)
+                self.segments_meta.append({"name": segment_name, "postings": postings})
+                self.dump_meta()
+                self.update_stats()
+                self.plist_cache.clear()
+                self.generation += 1
+                self.arena_offsets = None
+                self.arena_fields = None
+
         self.cache_size = 0
         self.term_plists = dict()
+        if self.posting_buffer is not None:
+            self.posting_buffer.clear()
         gc.collect()
 
         logging.info("Cache has been dump")
 
+        for table, partition_index in self.partitions.itervalues():
+            table.dump()
+            partition_index.dump_and_merge()
+
+        # Flush waits for nothing unless some tier has a full run of segments, and even then merging goes to
+        # background thread unless background compaction is turned off.
+        if self.pick_compaction_run() is not None:
+            if self.background_compaction:
+                self.compact_async()
+            else:
+                self.compact()
+
+    def segment_tier(self, segment_meta):
+        return int(math.log(max(segment_meta["postings"], 1), self.COMPACTION_FANOUT))
+
+    def pick_compaction_run(self, full=False):
+        """
+
+        Returns names of adjacent segments to be merged or None. Tiered policy merges a run of
+        COMPACTION_FANOUT adjacent segments of the same size tier, full compaction merges everything.
+
+        """
+        with self.segments_lock:
+            names = [segment_meta["name"] for segment_meta in self.segments_meta]
+            if full:
+                return names if len(names) > 1 else None
+            tiers = [self.segment_tier(segment_meta) for segment_meta in self.segments_meta]
+            run_start = 0
+            for i in xrange(1, len(tiers) + 1):
+                if i == len(tiers) or tiers[i] != tiers[run_start]:
+                    if i - run_start >= self.COMPACTION_FANOUT:
+                        return names[run_start:i]
+                    run_start = i
+            return None
+
+    def iter_remapped(self, term_map, doc_id_base=0, segments=None):
+        """
+
+        Iterates over (new_term_id, [field arrays]) pairs of all (or given) segments in new term id order.
+        Term <t> gets id term_map[t], <doc_id_base> is added to document ids.
+
+        """
+        if segments is None:
+            segments = self.list_segments()
+        term_ids = self.term_ids(segments)
+        new_term_ids = term_map[term_ids]
+        for i in np.argsort(new_term_ids, kind="mergesort"):
+            fields = self.merge_fields(term_ids[i], segments)
+            if doc_id_base != 0:
+                fields = [(fields[0] + doc_id_base).astype(fields[0].dtype)] + fields[1:]
+            yield int(new_term_ids[i]), fields
+
+    def rewrite(self, term_map, doc_id_base=0):
+        """
+
+        Rewrites all segments into a single one with term ids changed by <term_map> and document ids
+        shifted by <doc_id_base>, e.g. to put index shard built with its own lexicon into a shared one.
+
+        """
+        if len(self.partition_fields) > 0:
+            raise Exception("Index with partitions can not be rewritten.")
+        self.wait_compaction()
+        with self.segments_lock:
+            segment_names = [segment_meta["name"] for segment_meta in self.segments_meta]
+        if len(segment_names) > 0:
+            self.merge_segments(segment_names, lambda segments: self.iter_remapped(term_map, doc_id_base, segments))
+        self.plist_cache.clear()
+        self.generation += 1
+        self.arena_offsets = None
+        self.arena_fields = None
+
+    def migrate_keys(self):
+        """
+
+        Rewrites LDB segments of closed index and of its partitions which have text keys to binary keys,
+        posting lists are copied as they are. Returns number of rewritten segments.
+
+        """
+        if self.opened:
+            raise Exception("Index should be closed in order to migrate keys.")
+        self.load_meta()
+        migrated = 0
+        if self.index_format == INDEX_FORMAT.LDB:
+            for segment_meta in self.segments_meta:
+                if LdbSegment.migrate_keys(os.path.join(self.root, segment_meta["name"])):
+                    migrated += 1
+        for field_name in self.partition_fields:
+            migrated += self.partition_index(field_name).migrate_keys()
+        return migrated
+
+    def merge_segments(self, segment_names, term_fields=None):
+        """
+
+        Replaces run of segments with a single one. If <term_fields> is given, it is called with list of
+        merged segments and should return (term_id, [field arrays]) pairs to be written instead of them.
+
+        """
+        with self.segments_lock:
+            segments = [self.segments[segment_name] for segment_name in segment_names]
+        logging.info("Index: compacting %d segments." % len(segments))
+        merged_name = self.new_segment_name()
+        if term_fields is None:
+            term_fields = lambda merged: ((term_id, self.merge_fields(term_id, merged))
+                                          for term_id in self.term_ids(merged))
+        postings = self.write_segment(merged_name, term_fields(segments))
+        merged_segment = self.open_segment(merged_name)
+        with self.segments_lock:
+            names = [segment_meta["name"] for segment_meta in self.segments_meta]
+            start = names.index(segment_names[0])
+            self.segments_meta[start:(start + len(segment_names))] = [{"name": merged_name, "postings": postings}]
+            self.segments[merged_name] = merged_segment
+            for segment_name in segment_names:
+                del self.segments[segment_name]
+            self.dump_meta()
+            self.update_stats()
+            for segment in segments:
+                segment.close()
+                shutil.rmtree(segment.root)
+            for segment_name in segment_names:
+                segment_stats_path = os.path.join(self.root, self.SEGMENT_STATS_FILE % segment_name)
+                if os.path.exists(segment_stats_path):
+                    os.remove(segment_stats_path)
+
+    def compact(self, full=False):
+        """
+
+        Merges segments until compaction policy is satisfied. If <full> is True, all segments are merged
+        into a single one. Waits for compaction which is already running, e.g. in background thread.
+
+        """
+        with self.compaction_lock:
+            segment_names = self.pick_compaction_run(full)
+            while segment_names is not None:
+                self.merge_segments(segment_names)
+                segment_names = self.pick_compaction_run(full)
+
+    def compact_async(self, full=False):
+        """
+
+        Starts compaction in background thread unless it is already running.
+
+        """
+        if self.compaction_thread is not None and self.compaction_thread.is_alive():
+            return
+        self.compaction_thread = threading.Thread(target=self.compact, kwargs={"full": full})
+        self.compaction_thread.daemon = True
+        self.compaction_thread.start()
+
+    def wait_compaction(self):
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+            self.compaction_thread = None
+
     def close(self):
-        if self.barrels_ldb is None:
+        if not self.opened:
             raise Exception("Index is not opened.")
-        self.barrels_ldb = None
+        self.wait_compaction()
+        for segment in self.list_segments():
+            segment.close()
+        for table, partition_index in self.partitions.itervalues():
+            table.dump()
+            partition_index.close()
+        self.segments = dict()
+        self.partitions = dict()
+        self.posting_buffer = None
+        self.opened = False
         self.dump_meta()
 
+    def partition_vectors(self, table, field_name, vectors):
+        """
+
+        Returns copy of property vectors with term ids replaced by ids of their <field_name> partitions.
+
+        """
+        if len(vectors) == 0:
+            return []
+        vectors = np.array(vectors, dtype=np.int64)
+        vectors[:, 0] = table.add(vectors[:, 0], vectors[:, self.field_keys[field_name]])
+        return list(vectors)
+
     def add_to_index(self, document_id, index_entry):
-        for vector in index_entry.property_vectors():
-            term_id = vector[0]
-            vector[0] = document_id
-            plist = self.term_plists.get(term_id)
-            if plist is None:
-                plist = PostingList.create_and_init(self.field_properties)
-                self.term_plists[term_id] = plist
-            self.terms_number += 1
-            self.cache_size += 1
-            plist.add(vector)
+        vectors = index_entry.property_vectors()
+        for field_name, (table, partition_index) in self.partitions.iteritems():
+            partition_index.add_vectors(document_id, self.partition_vectors(table, field_name, vectors))
+        self.add_vectors(document_id, vectors)
+
+    def add_vectors(self, document_id, vectors):
+        if self.posting_buffer is not None:
+            added = self.posting_buffer.append(document_id, vectors)
+            self.terms_number += added
+            self.cache_size += added
+        else:
+            for vector in vectors:
+                term_id = vector[0]
+                vector[0] = document_id
+                plist = self.term_plists.get(term_id)
+                if plist is None:
+                    plist = PostingList.create_and_init(self.field_properties)
+                    self.term_plists[term_id] = plist
+                self.terms_number += 1
+                self.cache_size += 1
+                plist.add(vector)
         if self.cache_size >= self.CACHE_SZ:
             self.dump_and_merge()
         self.documents_number += 1
+        self.next_document = max(self.next_document, int(document_id) + 1)
@@ -0,0 +1,65 @@
+# coding: utf-8
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+
+import os
+import struct
+import shutil
+import leveldb
+import logging
+
+
+class KEY_FORMAT:
+
+    TEXT = "TEXT"                                       # decimal ids, "10" < "9" in leveldb order
+    BINARY = "BINARY"                                   # fixed width big-endian ids, key order is id order
+
+
+ID_STRUCT = struct.Struct(">Q")
+ID_KEY_SZ = ID_STRUCT.size
+REKEY_BATCH_SZ = 65536
+
+
+def encode_id(number):
+    """
+
+    Returns fixed width big-endian key of non-negative id, keys compare bytewise as numbers do.
+
+    """
+    return ID_STRUCT.pack(number)
+
+
+def decode_id(key):
+    return ID_STRUCT.unpack_from(key)[0]
+
+
+def rekey_ldb(ldb_path, rekey):
+    """
+
+    Rewrites leveldb putting every value under the key returned by <rekey> for its old key, records for
+    which it returns None are dropped. Database is written next to the old one and replaces it when
+    complete. Returns number of written records.
+
+    """
+    tmp_path = ldb_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    source_ldb = leveldb.LevelDB(ldb_path)
+    target_ldb = leveldb.LevelDB(tmp_path)
+    batch = leveldb.WriteBatch()
+    records = 0
+    for key, value in source_ldb.RangeIter():
+        new_key = rekey(key)
+        if new_key is None:
+            continue
+        batch.Put(new_key, value)
+        records += 1
+        if records % REKEY_BATCH_SZ == 0:
+            target_ldb.Write(batch, sync=False)
+            batch = leveldb.WriteBatch()
+    target_ldb.Write(batch, sync=True)
+    source_ldb = None
+    target_ldb = None
+    shutil.rmtree(ldb_path)
+    os.rename(tmp_path, ldb_path)
+    logging.info("Rewrote %d records of %s." % (records, ldb_path))
+    return records
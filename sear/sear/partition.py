@@ -0,0 +1,96 @@
+# coding: utf-8
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+
+import os
+import numpy as np
+
+
+VALUE_OFFSET = 2 ** 31
+
+
+def partition_keys(term_ids, values):
+    """
+
+    Packs (term id, int32 field value) pairs into sortable int64 keys.
+
+    """
+    term_ids = np.asarray(term_ids, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    return (term_ids << 32) | (values + VALUE_OFFSET)
+
+
+class PartitionTable(object):
+    KEYS_FILE = "partitions.keys"
+
+    def __init__(self, root_dir):
+        """
+
+        Dictionary of partitions of a secondary index: every distinct (term id, field value) pair gets its
+        own partition id, which is used as a term id in the secondary index. Keys are stored in partition
+        id order, lookups are done by binary search over sorted keys. Keys added since the last dump are
+        kept in a dict.
+
+        """
+        self.root = root_dir
+        self.keys_fl = os.path.join(self.root, self.KEYS_FILE)
+        self.keys = np.zeros(0, dtype=np.int64)         # keys in partition id order
+        self.sorted_keys = np.zeros(0, dtype=np.int64)
+        self.sorted_ids = np.zeros(0, dtype=np.int64)
+        self.new_keys = dict()                          # key -> partition id, not dumped yet
+
+    def load(self):
+        if os.path.exists(self.keys_fl):
+            self.keys = np.fromfile(self.keys_fl, dtype=np.int64)
+        self.sorted_ids = np.argsort(self.keys, kind="mergesort")
+        self.sorted_keys = self.keys[self.sorted_ids]
+        self.new_keys = dict()
+        return self
+
+    def dump(self):
+        if len(self.new_keys) == 0 and os.path.exists(self.keys_fl):
+            return
+        new_keys = np.zeros(len(self.new_keys), dtype=np.int64)
+        for key, partition_id in self.new_keys.iteritems():
+            new_keys[partition_id - len(self.keys)] = key
+        self.keys = np.concatenate((self.keys, new_keys))
+        self.keys.tofile(self.keys_fl + ".tmp")
+        os.rename(self.keys_fl + ".tmp", self.keys_fl)
+        self.sorted_ids = np.argsort(self.keys, kind="mergesort")
+        self.sorted_keys = self.keys[self.sorted_ids]
+        self.new_keys = dict()
+
+    def find(self, keys):
+        """
+
+        Returns partition ids of given keys, -1 for keys which are not in the table.
+
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        partition_ids = np.empty(len(keys), dtype=np.int64)
+        partition_ids.fill(-1)
+        if len(self.sorted_keys) > 0:
+            positions = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.sorted_keys) - 1)
+            found = self.sorted_keys[positions] == keys
+            partition_ids[found] = self.sorted_ids[positions[found]]
+        for i in np.flatnonzero(partition_ids == -1):
+            partition_ids[i] = self.new_keys.get(int(keys[i]), -1)
+        return partition_ids
+
+    def get_id(self, term_id, value):
+        return int(self.find(partition_keys([term_id], [value]))[0])
+
+    def add(self, term_ids, values):
+        """
+
+        Returns partition ids of (term id, value) pairs, pairs which are not in the table get new ids.
+
+        """
+        keys = partition_keys(term_ids, values)
+        partition_ids = self.find(keys)
+        for i in np.flatnonzero(partition_ids == -1):
+            partition_id = len(self.keys) + len(self.new_keys)
+            partition_ids[i] = self.new_keys.setdefault(int(keys[i]), partition_id)
+        return partition_ids
+
+    def __len__(self):
+        return len(self.keys) + len(self.new_keys)
@@ -1,63 +1,584 @@
 # coding: utf-8
 # Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
 
+import os
+import Queue
+import logging
+import traceback
+import multiprocessing
+import numpy as np
+
+from sear.cache import LruCache
+from sear.index import PostingList
+from sear.index import InvertedIndex
+from sear.segment import BLOCK_SZ
+from sear.segment import map_array
+from sear.segment import TERM_STATS_DTYPE
+
+
+CONSTRAINT_OPS = {
+    "==": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "in": lambda column, values: np.in1d(column, np.asarray(values)),
+    "not in": lambda column, values: np.in1d(column, np.asarray(values), invert=True),
+}
+
+
+def intersect_sorted(left, right):
+    """
+
+    Intersects two sorted arrays of unique values. Every value of the shorter array is looked up in
+    the longer one by binary search, so the cost is O(m log n) instead of O(m + n) for a linear merge
+    when list lengths differ a lot, which is the common case for rare and frequent terms.
+
+    """
+    if len(left) > len(right):
+        left, right = right, left
+    if len(left) == 0:
+        return left
+    positions = np.searchsorted(right, left)
+    positions[positions == len(right)] = 0
+    return left[right[positions] == left]
+
+
+def sorted_contains(sorted_values, values):
+    """
+
+    Returns mask of values which are present in sorted array, one binary search per value.
+
+    """
+    if len(sorted_values) == 0:
+        return np.zeros(len(values), dtype=np.bool_)
+    positions = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[positions] == values
+
+
+def best_scores(values, scores):
+    """
+
+    Returns unique values and the highest score of each of them.
+
+    """
+    order = np.lexsort((-scores.astype(np.int64), values))
+    values, scores = values[order], scores[order]
+    first = np.concatenate(([True], values[1:] != values[:-1])) if len(values) > 0 else np.zeros(0, np.bool_)
+    return values[first], scores[first]
+
+
+def bitmap_contains(bitmap, values):
+    """
+
+    Returns mask of values whose bits are set in packed bitmap, one lookup per value.
+
+    """
+    values = np.asarray(values, dtype=np.int64)
+    inside = (values >> 3) < len(bitmap)
+    found = np.zeros(len(values), dtype=np.bool_)
+    inside_values = values[inside]
+    found[inside] = (bitmap[inside_values >> 3] >> (7 - (inside_values & 7))) & 1 == 1
+    return found
+
+
+def intersect_bitmaps(left, right):
+    size = min(len(left), len(right))
+    return np.bitwise_and(left[:size], right[:size])
+
+
+def bitmap_values(bitmap):
+    return np.flatnonzero(np.unpackbits(bitmap))
+
+
+def join_sorted(left, right):
+    """
+
+    Joins two sorted arrays of unique values. Returns positions of common values in the left array and
+    positions of the same values in the right one.
+
+    """
+    if len(left) == 0 or len(right) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    positions = np.searchsorted(right, left)
+    positions[positions == len(right)] = 0
+    found = right[positions] == left
+    return np.flatnonzero(found), positions[found]
+
+
+def normalize_query(query):
+    """
+
+    Returns hashable form of conjunctive query which does not depend on order of terms and constraints,
+    or None if query has legacy callable constraints.
+
+    """
+    terms = []
+    for term_id, constraints in query:
+        normalized = []
+        for constraint in constraints:
+            if len(constraint) != 3:
+                return None
+            c_name, c_op, c_value = constraint
+            if isinstance(c_value, (list, tuple, set, np.ndarray)):
+                c_value = tuple(sorted(c_value))
+            normalized.append((c_name, c_op, c_value))
+        terms.append((int(term_id), tuple(sorted(normalized))))
+    return tuple(sorted(terms))
+
+
+def masked_terms(term_mask, term_ids):
+    """
+
+    Returns ids of query terms which are set in a row of term masks returned by Searcher.find_or.
+
+    """
+    term_ids = np.asarray(term_ids)
+    return term_ids[np.flatnonzero(np.unpackbits(term_mask)[:len(term_ids)])]
+
 
 class Searcher(object):
+    DENSE_TERM_RATIO = 1.0 / 32
+    RESULT_CACHE_SZ = 64 * 1024 * 1024
+
+    def __init__(self, index, ret_field, result_cache_bytes=None):
+        """
 
-    def __init__(self, index, ret_field):
+        Evaluates queries over the index. Results of find() and top_k() are memoized in LRU cache bounded
+        by <result_cache_bytes> and keyed by normalized query and index generation, so they are dropped as
+        soon as new postings are flushed to the index. Cached arrays are read-only.
+
+        """
         self.index = index
         self.ret_field = ret_field
+        self.result_cache = LruCache(result_cache_bytes if result_cache_bytes is not None else self.RESULT_CACHE_SZ,
+                                     name="Query results cache")
+
+    def cached(self, method, query, args, compute):
+        """
+
+        Returns result of <compute>() memoized under (<method>, normalized query, <args>, index generation).
+        Result is a tuple of arrays or a single array.
+
+        """
+        normalized = normalize_query(query)
+        if normalized is None:
+            return compute()
+        key = (method, normalized, args, self.index.generation)
+        result = self.result_cache.get(key)
+        if result is not None:
+            return result
+        result = compute()
+        arrays = result if isinstance(result, tuple) else (result, )
+        for array in arrays:
+            array.flags.writeable = False
+        self.result_cache.put(key, result, sum(array.nbytes for array in arrays) + 256)
+        return result
+
+    def constraints_mask(self, plist, constraints):
+        """
+
+        Evaluates constraints over the whole posting list at once and returns boolean mask of rows which
+        satisfy all of them. Constraint is a (field, op, value) triple, e.g. ("rel_type", "==", 3), where
+        op is one of CONSTRAINT_OPS. Legacy (field, callable) pairs are still accepted, but are evaluated
+        row by row.
+
+        """
+        mask = np.ones(len(plist.fields[0]), dtype=np.bool_)
+        for constraint in constraints:
+            column = plist.fields[self.index.field_keys[constraint[0]]]
+            if len(constraint) == 3:
+                c_name, c_op, c_value = constraint
+                if c_op not in CONSTRAINT_OPS:
+                    raise Exception("Unknown constraint operation: %r" % c_op)
+                mask &= CONSTRAINT_OPS[c_op](column, c_value)
+            else:
+                c_name, c_func = constraint
+                mask &= np.fromiter((c_func(value) for value in column), dtype=np.bool_, count=len(column))
+        return mask
+
+    def document_frequency(self, term_id):
+        return self.index.document_frequency(term_id)
+
+    def log_stats(self):
+        self.index.plist_cache.log_stats()
+        self.result_cache.log_stats()
+
+    def plan(self, query):
+        """
+
+        Orders conjunctive query terms by increasing number of postings, so intersection starts from the
+        rarest term and running candidates set is as small as possible from the very beginning. Terms with
+        equality constraint on a partitioned field are read from the secondary partition index instead
+        (see InvertedIndex.find_partition). Returns list of (postings_number, term_id, constraints, index)
+        tuples, where term_id is an id of posting list in the index it should be read from.
+
+        """
+        plan = []
+        for term_id, constraints in query:
+            index = self.index
+            partition = self.index.find_partition(term_id, constraints)
+            if partition is not None:
+                index, term_id, constraints = partition
+            postings_number = index.postings_number(term_id) if term_id >= 0 else 0
+            plan.append((postings_number, term_id, constraints, index))
+        plan.sort(key=lambda step: step[0])
+        return plan
+
+    def is_dense(self, postings_number):
+        """
+
+        Term is dense when its documents bitmap is smaller than its posting list of int32 ids.
+
+        """
+        return postings_number >= self.index.documents_number * self.DENSE_TERM_RATIO > 0
 
     def find(self, query, ret_field=None):
+        """
+
+        Returns sorted array of unique <ret_field> values of postings which match every term of the
+        query. Query is a list of (term_id, constraints) pairs. Terms are intersected in order given by
+        plan() and search stops as soon as there are no candidates left, remaining posting lists are not
+        loaded at all.
+
+        Unconstrained dense terms are read as document bitmaps (see InvertedIndex.load_bitmap), so array
+        candidates are checked against them with a single lookup per candidate and two dense terms are
+        intersected with bitwise and.
 
-        intersect_lists = []
+        """
+        ret_field = ret_field if ret_field is not None else self.ret_field
+        return self.cached("find", query, (ret_field, ), lambda: self.find_planned(self.plan(query), ret_field))
+
+    def find_planned(self, plan, ret_field=None):
+        """
+
+        Executes conjunctive query plan given by plan(), see find().
+
+        """
+        last_candidates = None
+        last_bitmap = None
         ret_field = ret_field if ret_field is not None else self.ret_field
         ret_field_id = self.index.field_keys[ret_field]
+        ret_dtype = self.index.field_properties[ret_field_id][1]
 
-        for term_id, constraints in query:
+        for step, (postings_number, term_id, constraints, index) in enumerate(plan):
 
-            plist = self.index.load_plist(term_id)
+            if postings_number == 0 or (last_candidates is not None and len(last_candidates) == 0):
+                logging.debug("Searcher: stopped after %d of %d terms." % (step, len(plan)))
+                return np.zeros(0, dtype=ret_dtype)
 
-            if len(constraints) == 0:
-                intersect_lists.append(plist.fields[ret_field_id])
+            if ret_field_id == 0 and len(constraints) == 0 and self.is_dense(postings_number):
+                bitmap = index.load_bitmap(term_id)
+                if last_candidates is not None:
+                    last_candidates = last_candidates[bitmap_contains(bitmap, last_candidates)]
+                elif last_bitmap is not None:
+                    last_bitmap = intersect_bitmaps(last_bitmap, bitmap)
+                else:
+                    last_bitmap = bitmap
                 continue
 
-            candidates = []
-            for i in xrange(0, len(plist.fields[0])):
-                candidate_is_ok = True
-
-                for c_name, constraint in constraints:
-                    c_field_id = self.index.field_keys[c_name]
-                    if not constraint(plist.fields[c_field_id][i]):
-                        candidate_is_ok = False
-                        break
+            # Document ids are the first field and posting lists skip table is built over it, so once
+            # there are candidates, only posting list blocks which can contain them are decoded.
+            doc_ids = None
+            if last_candidates is not None and ret_field_id == 0:
+                doc_ids = last_candidates
 
-                candidate = plist.fields[ret_field_id][i]
+            plist = index.load_plist(term_id, doc_ids)
+            candidates = plist.fields[ret_field_id]
 
-                if candidate_is_ok:
-                    candidates.append(candidate)
+            if len(constraints) > 0:
+                candidates = candidates[self.constraints_mask(plist, constraints)]
+                if len(candidates) == 0:
+                    return np.zeros(0, dtype=ret_dtype)
 
-            if len(candidates) == 0:
-                return []
-            intersect_lists.append(candidates)
+            candidates = np.unique(candidates)
 
-        last_candidates = set(intersect_lists[0])
+            if last_bitmap is not None:
+                last_candidates = candidates[bitmap_contains(last_bitmap, candidates)]
+                last_bitmap = None
+            elif last_candidates is None:
+                last_candidates = candidates
+            else:
+                last_candidates = intersect_sorted(last_candidates, candidates)
 
-        for i in xrange(1, len(intersect_lists)):
-            new_candidates = set()
-            for j in xrange(len(intersect_lists[i])):
-                if intersect_lists[i][j] in last_candidates:
-                    new_candidates.add(intersect_lists[i][j])
-            last_candidates = new_candidates
+        if last_bitmap is not None:
+            return bitmap_values(last_bitmap).astype(ret_dtype)
+        if last_candidates is None:
+            return np.zeros(0, dtype=ret_dtype)
         return last_candidates
 
-    def find_or(self, query):
-        results = dict()
-        for term_id, constraints in query:
-            found_documents = self.find([(term_id, constraints)])
-            for doc_id in found_documents:
-                if doc_id in results:
-                    results[doc_id].append(term_id)
-                else:
-                    results[doc_id] = [term_id]
-        return results
\ No newline at end of file
+    def top_k(self, query, k, score_field, ret_field=None):
+        """
+
+        Returns <k> documents matching every term of the query with the highest <score_field> values as two
+        arrays: <ret_field> values and their scores, ordered by decreasing score. Score of a document is the
+        highest score field value among its postings of the rarest query term (in triplet index frequency is
+        the same in all postings of a triplet).
+
+        Blocks of the rarest term posting list are read in decreasing order of their maximal score (see
+        InvertedIndex.impact_blocks) and reading stops as soon as no remaining block can beat the current
+        k-th result. Other terms of the query are evaluated with find() and used as a filter.
+
+        """
+        ret_field = ret_field if ret_field is not None else self.ret_field
+        return self.cached("top_k", query, (k, score_field, ret_field),
+                           lambda: self.find_top_k(query, k, score_field, ret_field))
+
+    def find_top_k(self, query, k, score_field, ret_field):
+        ret_field_id = self.index.field_keys[ret_field]
+        score_field_id = self.index.field_keys[score_field]
+        found_values = np.zeros(0, dtype=self.index.field_properties[ret_field_id][1])
+        found_scores = np.zeros(0, dtype=self.index.field_properties[score_field_id][1])
+
+        plan = self.plan(query)
+        if k <= 0 or len(plan) == 0 or plan[0][0] == 0:
+            return found_values, found_scores
+        _, term_id, constraints, index = plan[0]
+        others = None
+        if len(plan) > 1:
+            others = self.find_planned(plan[1:], ret_field)
+            if len(others) == 0:
+                return found_values, found_scores
+
+        threshold = None
+        batches = index.impact_blocks(term_id, score_field_id, first_batch=(k + BLOCK_SZ - 1) // BLOCK_SZ)
+        try:
+            for bound, fields in batches:
+                # Postings with score equal to threshold may still win by lower id, see final ordering.
+                if threshold is not None and bound < threshold:
+                    logging.debug("Searcher: top %d found, score bound %d." % (k, bound))
+                    break
+                values, scores = fields[ret_field_id], fields[score_field_id]
+                mask = np.ones(len(values), dtype=np.bool_)
+                if len(constraints) > 0:
+                    mask &= self.constraints_mask(PostingList.create_from_fields(fields), constraints)
+                if others is not None:
+                    mask &= sorted_contains(others, values)
+                found_values, found_scores = best_scores(np.concatenate((found_values, values[mask])),
+                                                         np.concatenate((found_scores, scores[mask])))
+                if len(found_scores) >= k:
+                    threshold = np.partition(found_scores, len(found_scores) - k)[len(found_scores) - k]
+        finally:
+            batches.close()
+
+        order = np.lexsort((found_values, -found_scores.astype(np.int64)))[:k]
+        return found_values[order], found_scores[order]
+
+    def find_or(self, query, ret_field=None):
+        """
+
+        Returns union of documents matching any of query terms as two parallel arrays: sorted unique
+        <ret_field> values and packed bit masks of query terms matched by each of them. Row <i> of masks
+        has bit <j> set (in np.packbits order) when document <i> matches j-th term of the query, use
+        masked_terms() to unpack it. All lists are merged in a single pass, no per document objects are
+        created.
+
+        """
+        ret_field = ret_field if ret_field is not None else self.ret_field
+        ret_field_id = self.index.field_keys[ret_field]
+        ret_dtype = self.index.field_properties[ret_field_id][1]
+        mask_width = (len(query) + 7) // 8
+
+        term_docs = []
+        term_indexes = []
+        for term_index, (term_id, constraints) in enumerate(query):
+            found_documents = self.find([(term_id, constraints)], ret_field)
+            term_docs.append(found_documents)
+            term_indexes.append(np.empty(len(found_documents), dtype=np.int64))
+            term_indexes[-1].fill(term_index)
+
+        postings_number = sum(len(docs) for docs in term_docs)
+        if postings_number == 0:
+            return np.zeros(0, dtype=ret_dtype), np.zeros((0, mask_width), dtype=np.uint8)
+
+        term_docs = np.concatenate(term_docs)
+        if ret_field_id == 0 and self.is_dense(postings_number):
+            # Union is dense, so documents are marked in a bitmap over all document ids and numbered by
+            # their rank in it instead of sorting all postings.
+            present = np.zeros(max(self.index.documents_number, term_docs.max() + 1), dtype=np.bool_)
+            present[term_docs] = True
+            doc_ids = np.flatnonzero(present).astype(ret_dtype)
+            doc_rows = (np.cumsum(present) - 1)[term_docs]
+        else:
+            doc_ids, doc_rows = np.unique(term_docs, return_inverse=True)
+
+        # Every term contributes each document at most once, so (document, term) pairs are unique and bits
+        # of the same mask byte can be combined by summation.
+        term_indexes = np.concatenate(term_indexes)
+        mask_bytes = doc_rows * mask_width + term_indexes // 8
+        mask_bits = np.left_shift(1, 7 - term_indexes % 8)
+        masks = np.bincount(mask_bytes, weights=mask_bits, minlength=len(doc_ids) * mask_width)
+        return doc_ids, masks.astype(np.uint8).reshape((len(doc_ids), mask_width))
+
+
+def shard_worker(shards, ret_field, result_cache_bytes, tasks, results):
+    """
+
+    Worker process of ShardedSearcher. Opens its (shard_number, shard_path) shards and runs Searcher
+    methods for them until None task is received. If shards can not be opened, the error is returned as
+    result of every task.
+
+    """
+    searchers = dict()
+    open_error = None
+    try:
+        for shard_number, shard_path in shards:
+            index = InvertedIndex(shard_path)
+            index.open()
+            searchers[shard_number] = Searcher(index, ret_field, result_cache_bytes)
+    except Exception:
+        open_error = traceback.format_exc()
+    for shard_number, method, args in iter(tasks.get, None):
+        if open_error is not None:
+            results.put((shard_number, None, open_error))
+            continue
+        try:
+            results.put((shard_number, getattr(searchers[shard_number], method)(*args), None))
+        except Exception:
+            results.put((shard_number, None, traceback.format_exc()))
+    for searcher in searchers.values():
+        searcher.index.close()
+
+
+class ShardedSearcher(object):
+    POLL_TIMEOUT = 1.0
+
+    def __init__(self, manifest, ret_field, jobs=None, result_cache_bytes=None):
+        """
+
+        Runs queries over index shards described by ShardManifest in parallel and merges their results.
+        Every shard is opened by exactly one of <jobs> worker processes (leveldb segments can not be
+        opened twice), shards are assigned to workers round robin. Returned document ids are global:
+        shard document ids shifted by shard doc_id_base. Every shard searcher has its own query results
+        cache of <result_cache_bytes>.
+
+        """
+        self.manifest = manifest
+        self.ret_field = ret_field
+        self.shard_paths = manifest.shard_paths()
+        self.doc_id_bases = manifest.doc_id_bases()
+        self.shard_meta = InvertedIndex(self.shard_paths[0])
+        self.shard_meta.load_meta()
+        self.term_stats = None
+        jobs = min(jobs if jobs is not None else multiprocessing.cpu_count(), len(self.shard_paths))
+        self.results = multiprocessing.Queue()
+        self.tasks = []
+        self.workers = []
+        for worker_number in xrange(jobs):
+            shards = [(i, self.shard_paths[i]) for i in xrange(worker_number, len(self.shard_paths), jobs)]
+            tasks = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=shard_worker,
+                                             args=(shards, ret_field, result_cache_bytes, tasks, self.results))
+            worker.daemon = True
+            worker.start()
+            self.tasks.append(tasks)
+            self.workers.append(worker)
+
+    def scatter(self, method, *args):
+        """
+
+        Calls Searcher method with given arguments on every shard, returns list of results in shard order.
+
+        """
+        for shard_number in xrange(len(self.shard_paths)):
+            self.tasks[shard_number % len(self.tasks)].put((shard_number, method, args))
+        results = [None] * len(self.shard_paths)
+        errors = []
+        for _ in xrange(len(self.shard_paths)):
+            shard_number, result, error = self.get_result()
+            if error is not None:
+                errors.append("Shard %d: %s" % (shard_number, error))
+            results[shard_number] = result
+        if len(errors) > 0:
+            raise Exception("Search in shards failed.\n%s" % "\n".join(errors))
+        return results
+
+    def get_result(self):
+        """
+
+        Waits for the next result of workers, fails if some worker is dead instead of waiting forever.
+
+        """
+        while True:
+            try:
+                return self.results.get(timeout=self.POLL_TIMEOUT)
+            except Queue.Empty:
+                dead = [worker.pid for worker in self.workers if not worker.is_alive()]
+                if len(dead) > 0:
+                    raise Exception("Search workers %r are dead." % dead)
+
+    def global_ids(self, shard_results, ret_field):
+        """
+
+        Concatenates sorted shard results. Shards hold consecutive document ranges, so document ids shifted
+        by their shard base stay sorted. Values of other fields are merged as they are.
+
+        """
+        ret_field = ret_field if ret_field is not None else self.ret_field
+        if self.shard_meta.field_keys[ret_field] != 0:
+            return np.unique(np.concatenate(shard_results))
+        return np.concatenate([(result + base).astype(result.dtype)
+                               for result, base in zip(shard_results, self.doc_id_bases)])
+
+    def find(self, query, ret_field=None):
+        return self.global_ids(self.scatter("find", query, ret_field), ret_field)
+
+    def find_or(self, query, ret_field=None):
+        """
+
+        Merges unions of shards, see Searcher.find_or. Values of fields other than document id may be
+        found in several shards, their masks are combined with bitwise or.
+
+        """
+        shard_results = self.scatter("find_or", query, ret_field)
+        ret_field = ret_field if ret_field is not None else self.ret_field
+        masks = np.concatenate([masks for _, masks in shard_results])
+        if self.shard_meta.field_keys[ret_field] == 0:
+            return self.global_ids([values for values, _ in shard_results], ret_field), masks
+        values = np.concatenate([values for values, _ in shard_results])
+        if len(values) == 0:
+            return values, masks
+        values, rows = np.unique(values, return_inverse=True)
+        order = np.argsort(rows, kind="mergesort")
+        row_starts = np.flatnonzero(np.concatenate(([True], np.diff(rows[order]) != 0)))
+        return values, np.bitwise_or.reduceat(masks[order], row_starts, axis=0)
+
+    def top_k(self, query, k, score_field, ret_field=None):
+        shard_results = self.scatter("top_k", query, k, score_field, ret_field)
+        ret_field = ret_field if ret_field is not None else self.ret_field
+        values = [values for values, _ in shard_results]
+        if self.shard_meta.field_keys[ret_field] == 0:
+            values = [(shard_values + base).astype(shard_values.dtype)
+                      for shard_values, base in zip(values, self.doc_id_bases)]
+        values, scores = best_scores(np.concatenate(values), np.concatenate([scores for _, scores in shard_results]))
+        order = np.lexsort((values, -scores.astype(np.int64)))[:k]
+        return values[order], scores[order]
+
+    def document_frequency(self, term_id):
+        """
+
+        Sums document frequency from statistics tables of shards, which are mapped in this process. If some
+        shard has no statistics, frequencies are asked from shard searchers.
+
+        """
+        if self.term_stats is None:
+            stats_paths = [os.path.join(shard_path, InvertedIndex.STATS_FILE) for shard_path in self.shard_paths]
+            if all(os.path.exists(stats_path) for stats_path in stats_paths):
+                self.term_stats = [map_array(stats_path, TERM_STATS_DTYPE) for stats_path in stats_paths]
+            else:
+                self.term_stats = []
+        if len(self.term_stats) == 0:
+            return sum(self.scatter("document_frequency", term_id))
+        return sum(int(term_stats["df"][term_id]) for term_stats in self.term_stats if term_id < len(term_stats))
+
+    def log_stats(self):
+        self.scatter("log_stats")
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.tasks = []
+        self.workers = []
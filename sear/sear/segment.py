@@ -0,0 +1,608 @@
+# coding: utf-8
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+
+import os
+import mmap
+import shutil
+import leveldb
+import logging
+import numpy as np
+
+from sear.keys import KEY_FORMAT
+from sear.keys import ID_KEY_SZ
+from sear.keys import encode_id
+from sear.keys import decode_id
+from sear.keys import rekey_ldb
+
+
+BLOCK_SZ = 128
+TERM_STATS_DTYPE = np.dtype([
+    ("df", np.int64),                                   # number of distinct documents
+    ("postings", np.int64),                             # number of postings
+    ("bytes", np.int64),                                # encoded size of posting list
+    ("min_doc", np.int64),                              # -1 if term has no postings
+    ("max_doc", np.int64),                              # -1 if term has no postings
+])
+
+
+def block_rows(rows_number, block_size=BLOCK_SZ):
+    """
+
+    Returns numbers of postings in blocks of posting list of given length.
+
+    """
+    starts = np.arange(0, rows_number, block_size)
+    return np.minimum(starts + block_size, rows_number) - starts
+
+
+def select_blocks(block_max, doc_ids):
+    """
+
+    Returns mask of blocks which can contain any of given sorted document ids. Block <b> holds ids up to
+    block_max[b], the same id can continue in the following block.
+
+    """
+    blocks_number = len(block_max)
+    first = np.searchsorted(block_max, doc_ids, side="left")
+    last = np.minimum(np.searchsorted(block_max, doc_ids, side="right"), blocks_number - 1)
+    inside = first < blocks_number
+    marks = np.bincount(first[inside], minlength=blocks_number + 1) - \
+        np.bincount(last[inside] + 1, minlength=blocks_number + 1)
+    return np.cumsum(marks[:blocks_number]) > 0
+
+
+def gather_ranges(array, starts, ends):
+    """
+
+    Returns concatenation of array[starts[i]:ends[i]] slices and offsets of the slices in it.
+
+    """
+    sizes = ends - starts
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    index = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], sizes)
+    return array[index], offsets
+
+
+def map_array(file_path, dtype):
+    """
+
+    Returns read-only array over memory mapped file. Mapping is released when the array is collected.
+
+    """
+    if os.path.getsize(file_path) == 0:
+        return np.zeros(0, dtype=dtype)
+    with open(file_path, "rb") as array_file:
+        array_mmap = mmap.mmap(array_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.frombuffer(array_mmap, dtype=dtype)
+
+
+class TermStats(object):
+
+    def __init__(self):
+        """
+
+        Collects statistics of posting lists while they are written to a segment. Table is indexed by
+        term id, see TERM_STATS_DTYPE.
+
+        """
+        self.term_ids = []
+        self.rows = []
+
+    def add(self, term_id, fields, nbytes):
+        doc_ids = fields[0]
+        if len(doc_ids) > 0:
+            df = np.count_nonzero(np.diff(doc_ids)) + 1
+            self.rows.append((df, len(doc_ids), nbytes, doc_ids[0], doc_ids[-1]))
+        else:
+            self.rows.append((0, 0, nbytes, -1, -1))
+        self.term_ids.append(term_id)
+
+    def table(self):
+        table = empty_stats(max(self.term_ids) + 1 if len(self.term_ids) > 0 else 0)
+        table[np.array(self.term_ids, dtype=np.int64)] = np.array(self.rows, dtype=TERM_STATS_DTYPE)
+        return table
+
+
+def empty_stats(terms_number):
+    table = np.zeros(terms_number, dtype=TERM_STATS_DTYPE)
+    table["min_doc"] = -1
+    table["max_doc"] = -1
+    return table
+
+
+def merge_stats(tables):
+    """
+
+    Combines statistics tables of segments. Segments hold disjoint document ranges, so counts add up.
+
+    """
+    merged = empty_stats(max(len(table) for table in tables) if len(tables) > 0 else 0)
+    for table in tables:
+        part = merged[:len(table)]
+        has_postings = table["postings"] > 0
+        first = has_postings & (part["postings"] == 0)
+        part["min_doc"] = np.where(first, table["min_doc"], np.where(has_postings,
+                                                                      np.minimum(part["min_doc"], table["min_doc"]),
+                                                                      part["min_doc"]))
+        part["max_doc"] = np.where(has_postings, np.maximum(part["max_doc"], table["max_doc"]), part["max_doc"])
+        for column in ("df", "postings", "bytes"):
+            part[column] += table[column]
+    return merged
+
+
+def encode_blocks(field_properties, field_codecs, fields):
+    """
+
+    Splits posting list into blocks of BLOCK_SZ postings and encodes every field block by block.
+    Returns maximum of every field in every block as [fields x blocks] array, its first row is max document
+    id of every block, and (encoded field, encoded block sizes) for every field.
+
+    """
+    rows_number = len(fields[0])
+    block_starts = np.arange(0, rows_number, BLOCK_SZ)
+    block_max = np.array([np.maximum.reduceat(np.asarray(field, dtype=np.int64), block_starts) for field in fields])
+    encoded = [field_codecs[i].encode_blocks(np.asarray(fields[i], dtype=field_properties[i][1]), BLOCK_SZ)
+               for i in xrange(len(field_properties))]
+    return block_max, encoded
+
+
+class LdbSegment(object):
+    INDEX_KEY_SEP = chr(255)
+    BLOCKS_KEY = "b"
+    BINARY_BLOCKS_KEY = chr(255)
+    FORMAT_KEY = ""
+
+    def __init__(self, segment_dir, field_properties, field_codecs):
+        """
+
+        Posting lists stored in leveldb, one value per field under "<term_id><field_index>" key, where
+        term id is 8 bytes big-endian and field index is one byte, so posting lists are stored in term id
+        order. Values are concatenated encoded blocks, block table of the term is stored under
+        "<term_id>\xff":
+
+            int64 [rows, blocks, max doc id of every block, block byte offsets of every field...,
+                   max value of every block of every field except the first one...]
+
+        Segments written before blocks were introduced have no block table and hold raw fields.
+        Key format is stored under empty key, segments without it have text keys "<term_id>\xff<field_index>"
+        and "<term_id>\xffb" (see migrate_keys).
+
+        """
+        self.root = segment_dir
+        self.field_properties = field_properties
+        self.field_codecs = field_codecs
+        self.barrels_ldb = None
+        self.key_format = None
+
+    @staticmethod
+    def make_key(key_format, term_id, field_index=None):
+        """
+
+        Returns key of field <field_index> of term posting list, or key of its block table if it is None.
+
+        """
+        if key_format == KEY_FORMAT.BINARY:
+            return encode_id(term_id) + (LdbSegment.BINARY_BLOCKS_KEY if field_index is None else chr(field_index))
+        suffix = LdbSegment.BLOCKS_KEY if field_index is None else str(field_index)
+        return str(term_id) + LdbSegment.INDEX_KEY_SEP + suffix
+
+    @staticmethod
+    def parse_key(key_format, key):
+        """
+
+        Returns (term_id, field_index) of the key, field index is None for block table key.
+
+        """
+        if key_format == KEY_FORMAT.BINARY:
+            suffix = key[ID_KEY_SZ:]
+            return decode_id(key), None if suffix == LdbSegment.BINARY_BLOCKS_KEY else ord(suffix)
+        term_id, suffix = key.split(LdbSegment.INDEX_KEY_SEP)
+        return int(term_id), None if suffix == LdbSegment.BLOCKS_KEY else int(suffix)
+
+    @staticmethod
+    def migrate_keys(segment_dir):
+        """
+
+        Rewrites segment with text keys to binary keys. Returns False if segment already has binary keys.
+
+        """
+        barrels_ldb = leveldb.LevelDB(segment_dir)
+        try:
+            barrels_ldb.Get(LdbSegment.FORMAT_KEY)
+            return False
+        except KeyError:
+            pass
+        finally:
+            barrels_ldb = None
+        rekey_ldb(segment_dir, lambda key: LdbSegment.make_key(KEY_FORMAT.BINARY,
+                                                               *LdbSegment.parse_key(KEY_FORMAT.TEXT, key)))
+        leveldb.LevelDB(segment_dir).Put(LdbSegment.FORMAT_KEY, KEY_FORMAT.BINARY, sync=True)
+        return True
+
+    def key(self, term_id, field_index=None):
+        return self.make_key(self.key_format, term_id, field_index)
+
+    @staticmethod
+    def write(segment_dir, field_properties, field_codecs, term_fields, term_stats=None):
+        """
+
+        Writes new segment from (term_id, [field arrays]) pairs. Returns number of written postings.
+        Statistics of written posting lists are added to <term_stats> if it is given.
+
+        """
+        if os.path.exists(segment_dir):
+            shutil.rmtree(segment_dir)
+        barrels_ldb = leveldb.LevelDB(segment_dir)
+        batch = leveldb.WriteBatch()
+        batch.Put(LdbSegment.FORMAT_KEY, KEY_FORMAT.BINARY)
+        rows = 0
+        terms = 0
+        for term_id, fields in term_fields:
+            block_max, encoded = encode_blocks(field_properties, field_codecs, fields)
+            block_table = [np.array([len(fields[0]), block_max.shape[1]], dtype=np.int64), block_max[0]]
+            for i in xrange(len(field_properties)):
+                field_blob, block_sizes = encoded[i]
+                batch.Put(LdbSegment.make_key(KEY_FORMAT.BINARY, term_id, i), field_blob)
+                block_table.append(np.concatenate(([0], np.cumsum(block_sizes))))
+            block_table.append(block_max[1:].ravel())
+            block_table = np.concatenate(block_table).astype(np.int64)
+            batch.Put(LdbSegment.make_key(KEY_FORMAT.BINARY, term_id), block_table.tostring())
+            if term_stats is not None:
+                term_stats.add(term_id, fields, sum(len(blob) for blob, _ in encoded) + block_table.nbytes)
+            rows += len(fields[0])
+            terms += 1
+        barrels_ldb.Write(batch, sync=False)
+        logging.info("Segment: wrote %d postings of %d terms to %s." % (rows, terms, segment_dir))
+        return rows
+
+    def open(self):
+        self.barrels_ldb = leveldb.LevelDB(self.root)
+        try:
+            self.key_format = self.barrels_ldb.Get(self.FORMAT_KEY)
+        except KeyError:
+            self.key_format = KEY_FORMAT.TEXT
+        return self
+
+    def term_ids(self):
+        """
+
+        Returns sorted array of ids of terms which have postings in segment.
+
+        """
+        prime_sfx = chr(0) if self.key_format == KEY_FORMAT.BINARY else self.INDEX_KEY_SEP + "0"
+        term_ids = [self.parse_key(self.key_format, key)[0]
+                    for key in self.barrels_ldb.RangeIter(include_value=False)
+                    if key != self.FORMAT_KEY and key.endswith(prime_sfx)]
+        return np.sort(np.array(term_ids, dtype=np.int64))
+
+    def postings_number(self, term_id):
+        """
+
+        Returns number of postings of the term in segment without decoding them.
+
+        """
+        try:
+            table_blob = self.barrels_ldb.Get(self.key(term_id))
+            return int(np.frombuffer(table_blob[:8], dtype=np.int64)[0])
+        except KeyError:
+            pass
+        try:
+            field_blob = self.barrels_ldb.Get(self.key(term_id, 0))
+        except KeyError:
+            return 0
+        return len(field_blob) // np.dtype(self.field_properties[0][1]).itemsize
+
+    def decode_fields(self, field_blobs, table_blob, doc_ids=None, blocks=None):
+        fields_number = len(self.field_properties)
+        if table_blob is None:
+            return [self.field_codecs[i].decode(field_blobs[i], self.field_properties[i][1])
+                    for i in xrange(fields_number)]
+        block_table = np.frombuffer(table_blob, dtype=np.int64)
+        blocks_number = block_table[1]
+        block_max = block_table[2:(2 + blocks_number)]
+        rows = block_rows(block_table[0])
+        selected = blocks
+        if doc_ids is not None:
+            selected = np.flatnonzero(select_blocks(block_max, doc_ids))
+        fields = []
+        for i in xrange(fields_number):
+            table_start = 2 + blocks_number + i * (blocks_number + 1)
+            block_offsets = block_table[table_start:(table_start + blocks_number + 1)]
+            data = np.frombuffer(field_blobs[i], dtype=np.uint8)
+            field_rows = rows
+            if selected is not None:
+                data, block_offsets = gather_ranges(data, block_offsets[selected], block_offsets[selected + 1])
+                field_rows = rows[selected]
+            fields.append(self.field_codecs[i].decode_blocks(data,
+                                                             self.field_properties[i][1],
+                                                             block_offsets,
+                                                             field_rows))
+        return fields
+
+    def block_maxima(self, term_id, field_index):
+        """
+
+        Returns maximum value of the field in every block of the term posting list or None if the term has
+        no block table (it has no postings in segment or segment was written before blocks were introduced).
+
+        """
+        try:
+            block_table = np.frombuffer(self.barrels_ldb.Get(self.key(term_id)), dtype=np.int64)
+        except KeyError:
+            return None
+        blocks_number = block_table[1]
+        if field_index == 0:
+            return block_table[2:(2 + blocks_number)]
+        start = 2 + blocks_number + len(self.field_properties) * (blocks_number + 1) + \
+            (field_index - 1) * blocks_number
+        if start + blocks_number > len(block_table):
+            raise Exception("Block table of term %d has no maxima of field %d." % (term_id, field_index))
+        return block_table[start:(start + blocks_number)]
+
+    def get_fields(self, term_id, doc_ids=None, blocks=None):
+        """
+
+        Returns list of field arrays of the posting list or None if term has no postings in segment.
+        If sorted <doc_ids> are given, only blocks which can contain them are decoded. If sorted block
+        numbers <blocks> are given, only these blocks are decoded.
+
+        """
+        field_blobs = []
+        for i in xrange(len(self.field_properties)):
+            try:
+                field_blobs.append(self.barrels_ldb.Get(self.key(term_id, i)))
+            except KeyError:
+                return None
+            logging.debug("Loaded %d field for %d term (%d bytes)" % (i, term_id, len(field_blobs[-1])))
+        try:
+            table_blob = self.barrels_ldb.Get(self.key(term_id))
+        except KeyError:
+            table_blob = None
+        if blocks is not None and table_blob is None:
+            raise Exception("Segment %s has no blocks." % self.root)
+        return self.decode_fields(field_blobs, table_blob, doc_ids, blocks)
+
+    def iter_terms(self):
+        """
+
+        Iterates over (term_id, [field arrays]) pairs in key order.
+
+        """
+        term_id = None
+        term_values = None
+        for field_key, field_value in self.barrels_ldb.RangeIter():
+            if field_key == self.FORMAT_KEY:
+                continue
+            key_term_id, field_index = self.parse_key(self.key_format, field_key)
+            if key_term_id != term_id:
+                if term_values is not None:
+                    yield term_id, self.decode_fields(term_values[:-1], term_values[-1])
+                term_id = key_term_id
+                term_values = [None] * (len(self.field_properties) + 1)
+            if field_index is None:
+                term_values[-1] = field_value
+            else:
+                term_values[field_index] = field_value
+        if term_values is not None:
+            yield term_id, self.decode_fields(term_values[:-1], term_values[-1])
+
+    def close(self):
+        self.barrels_ldb = None
+
+
+class MmapSegment(object):
+    OFFSETS_FL = "offsets.bin"
+    BLOCKS_FL = "blocks.bin"
+    SKIPS_FL = "skips.bin"
+    FIELD_FL = "field.%d.bin"
+    FIELD_OFFSETS_FL = "field.%d.off"
+    FIELD_MAX_FL = "field.%d.max"
+    OFFSET_TYPE = np.int64
+
+    def __init__(self, segment_dir, field_properties, field_codecs):
+        """
+
+        Immutable posting lists segment. Posting lists are split into blocks of BLOCK_SZ postings. Every
+        field is stored in a flat file with encoded blocks of all terms placed one after another in term id
+        order. Offsets tables map term id to its postings and blocks:
+
+            offsets.bin     int64 [terms + 1]   postings of term <t> are rows offsets[t]..offsets[t + 1]
+            blocks.bin      int64 [terms + 1]   blocks of term <t> are blocks[t]..blocks[t + 1]
+            skips.bin       int64 [blocks]      max document id of every block
+            field.<i>.off   int64 [blocks + 1]  encoded field block <b> is bytes off[b]..off[b + 1]
+            field.<i>.max   int64 [blocks]      max value of field in every block (except the first field)
+            field.<i>.bin   encoded field data
+
+        Files are memory mapped and posting lists are decoded straight from the mapped pages. Fields
+        stored with RAW codec are returned as read-only views, nothing is copied.
+
+        """
+        self.root = segment_dir
+        self.field_properties = field_properties
+        self.field_codecs = field_codecs
+        self.offsets = None
+        self.blocks = None
+        self.skips = None
+        self.field_offsets = None
+        self.field_max = None
+        self.fields = None
+
+    @staticmethod
+    def write(segment_dir, field_properties, field_codecs, term_fields, term_stats=None):
+        """
+
+        Writes new segment from (term_id, [field arrays]) pairs given in increasing term id order.
+        Returns number of written postings. Statistics of written posting lists are added to
+        <term_stats> if it is given.
+
+        """
+        if os.path.exists(segment_dir):
+            shutil.rmtree(segment_dir)
+        os.mkdir(segment_dir)
+        fields_number = len(field_properties)
+        offsets = [0]
+        blocks = [0]
+        skips = []
+        field_max = [[] for _ in xrange(fields_number)]
+        block_sizes = [[] for _ in xrange(fields_number)]
+        field_files = [open(os.path.join(segment_dir, MmapSegment.FIELD_FL % i), "wb")
+                       for i in xrange(fields_number)]
+        rows = 0
+        for term_id, fields in term_fields:
+            if term_id < len(offsets) - 1:
+                raise Exception("Terms should be written in increasing id order.")
+            while len(offsets) <= term_id:
+                offsets.append(rows)
+                blocks.append(blocks[-1])
+            block_max, encoded = encode_blocks(field_properties, field_codecs, fields)
+            for i in xrange(fields_number):
+                field_blob, field_block_sizes = encoded[i]
+                field_files[i].write(field_blob)
+                block_sizes[i].append(field_block_sizes)
+                field_max[i].append(block_max[i])
+            skips.append(block_max[0])
+            if term_stats is not None:
+                term_stats.add(term_id, fields, sum(len(blob) for blob, _ in encoded) + block_max.nbytes)
+            rows += len(fields[0])
+            offsets.append(rows)
+            blocks.append(blocks[-1] + block_max.shape[1])
+        for field_file in field_files:
+            field_file.close()
+
+        def write_array(file_name, array):
+            np.asarray(array, dtype=MmapSegment.OFFSET_TYPE).tofile(os.path.join(segment_dir, file_name))
+
+        write_array(MmapSegment.OFFSETS_FL, offsets)
+        write_array(MmapSegment.BLOCKS_FL, blocks)
+        write_array(MmapSegment.SKIPS_FL, np.concatenate(skips) if len(skips) > 0 else [])
+        for i in xrange(fields_number):
+            sizes = np.concatenate(block_sizes[i]) if len(block_sizes[i]) > 0 else np.zeros(0)
+            write_array(MmapSegment.FIELD_OFFSETS_FL % i, np.concatenate(([0], np.cumsum(sizes))))
+            if i > 0:
+                write_array(MmapSegment.FIELD_MAX_FL % i,
+                            np.concatenate(field_max[i]) if len(field_max[i]) > 0 else [])
+        logging.info("Segment: wrote %d postings of %d terms to %s." % (rows, len(offsets) - 1, segment_dir))
+        return rows
+
+    def map_array(self, file_name, dtype):
+        return map_array(os.path.join(self.root, file_name), dtype)
+
+    def open(self):
+        fields_number = len(self.field_properties)
+        self.offsets = self.map_array(self.OFFSETS_FL, self.OFFSET_TYPE)
+        self.blocks = self.map_array(self.BLOCKS_FL, self.OFFSET_TYPE)
+        self.skips = self.map_array(self.SKIPS_FL, self.OFFSET_TYPE)
+        self.field_offsets = [self.map_array(self.FIELD_OFFSETS_FL % i, self.OFFSET_TYPE)
+                              for i in xrange(fields_number)]
+        self.field_max = [self.skips] + [self.map_array(self.FIELD_MAX_FL % i, self.OFFSET_TYPE)
+                                         for i in xrange(1, fields_number)]
+        self.fields = [self.map_array(self.FIELD_FL % i, np.uint8) for i in xrange(fields_number)]
+        return self
+
+    @property
+    def terms_number(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def term_ids(self):
+        """
+
+        Returns sorted array of ids of terms which have postings in segment.
+
+        """
+        return np.flatnonzero(np.diff(self.offsets))
+
+    def postings_number(self, term_id):
+        """
+
+        Returns number of postings of the term in segment without decoding them.
+
+        """
+        if term_id < 0 or term_id >= self.terms_number:
+            return 0
+        return int(self.offsets[term_id + 1] - self.offsets[term_id])
+
+    def get_field(self, field_index, first_block, rows, selected=None):
+        block_offsets = self.field_offsets[field_index][first_block:(first_block + len(rows) + 1)]
+        if selected is None:
+            data = self.fields[field_index][block_offsets[0]:block_offsets[-1]]
+            block_offsets = block_offsets - block_offsets[0]
+        else:
+            data, block_offsets = gather_ranges(self.fields[field_index],
+                                                block_offsets[selected],
+                                                block_offsets[selected + 1])
+            rows = rows[selected]
+        return self.field_codecs[field_index].decode_blocks(data,
+                                                            self.field_properties[field_index][1],
+                                                            block_offsets,
+                                                            rows)
+
+    def block_maxima(self, term_id, field_index):
+        """
+
+        Returns maximum value of the field in every block of the term posting list or None if the term has
+        no postings in segment.
+
+        """
+        if self.postings_number(term_id) == 0:
+            return None
+        return self.field_max[field_index][self.blocks[term_id]:self.blocks[term_id + 1]]
+
+    def get_fields(self, term_id, doc_ids=None, blocks=None):
+        """
+
+        Returns list of field arrays of the posting list or None if term has no postings in segment.
+        If sorted <doc_ids> are given, only blocks which can contain them are decoded. If sorted block
+        numbers <blocks> are given, only these blocks are decoded.
+
+        """
+        if term_id < 0 or term_id >= self.terms_number:
+            return None
+        if self.offsets[term_id] == self.offsets[term_id + 1]:
+            return None
+        first_block, last_block = self.blocks[term_id], self.blocks[term_id + 1]
+        rows = block_rows(self.offsets[term_id + 1] - self.offsets[term_id])
+        selected = blocks
+        if doc_ids is not None:
+            selected = np.flatnonzero(select_blocks(self.skips[first_block:last_block], doc_ids))
+        return [self.get_field(i, first_block, rows, selected) for i in xrange(len(self.field_properties))]
+
+    def load_arena(self):
+        """
+
+        Decodes all posting lists at once. Returns offsets array (postings of term <t> are rows
+        offsets[t]..offsets[t + 1]) and one contiguous in-memory array per field.
+
+        """
+        term_rows = np.diff(self.offsets)
+        term_blocks = np.diff(self.blocks)
+        block_term = np.repeat(np.arange(self.terms_number), term_blocks)
+        block_in_term = np.arange(len(block_term)) - np.repeat(self.blocks[:-1], term_blocks)
+        rows = np.minimum(BLOCK_SZ, term_rows[block_term] - block_in_term * BLOCK_SZ)
+        fields = []
+        for i in xrange(len(self.field_properties)):
+            field = self.field_codecs[i].decode_blocks(self.fields[i],
+                                                       self.field_properties[i][1],
+                                                       self.field_offsets[i],
+                                                       rows)
+            # Raw fields are views of mapped pages, copy them to have the whole index resident in memory.
+            fields.append(np.array(field, dtype=self.field_properties[i][1]))
+        return np.array(self.offsets if len(self.offsets) > 0 else [0], dtype=self.OFFSET_TYPE), fields
+
+    def iter_terms(self):
+        """
+
+        Iterates over (term_id, [field arrays]) pairs of non-empty posting lists in term id order.
+
+        """
+        for term_id in self.term_ids():
+            yield int(term_id), self.get_fields(term_id)
+
+    def close(self):
+        # Mapped views can still be referenced by posting lists given away to the caller, so pages
+        # are unmapped when the last view is collected rather than here.
+        self.offsets = None
+        self.blocks = None
+        self.skips = None
+        self.field_offsets = None
+        self.field_max = None
+        self.fields = None
@@ -0,0 +1,587 @@
+# coding: utf-8
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+
+import os
+import abc
+import json
+import glob
+import shutil
+import leveldb
+import logging
+import multiprocessing
+import numpy as np
+
+from sear.codec import CODEC
+from sear.index import INDEX_FORMAT
+from sear.index import InvertedIndex
+from sear.utils import IndexingPipeline
+from sear.storage import DOC_FORMAT
+from sear.storage import COMPRESSION
+from sear.storage import LdbStorage
+from sear.lexicon import DictLexicon
+
+
+MANIFEST_FL = "shards.json"
+SHARD_DIR = "shard.%d"
+
+
+def split_file(file_path, parts_number, record_prefixes):
+    """
+
+    Splits file into at most <parts_number> byte ranges of about the same size. Every range except the
+    first one starts at a line beginning with one of <record_prefixes>, so no record is split between
+    ranges. Returns list of (start, end) pairs.
+
+    """
+    file_size = os.path.getsize(file_path)
+    bounds = [0]
+    with open(file_path, "rb") as i_file:
+        for k in xrange(1, parts_number):
+            position = file_size * k // parts_number
+            if position <= bounds[-1]:
+                continue
+            i_file.seek(position)
+            i_file.readline()
+            while True:
+                position = i_file.tell()
+                line = i_file.readline()
+                if not line or line.startswith(record_prefixes):
+                    break
+            if bounds[-1] < position < file_size:
+                bounds.append(position)
+    bounds.append(file_size)
+    return [(bounds[i], bounds[i + 1]) for i in xrange(len(bounds) - 1)]
+
+
+def read_header(file_path, lines_number):
+    with open(file_path, "rb") as i_file:
+        return [i_file.readline() for _ in xrange(lines_number)]
+
+
+def plan_parts(file_paths, parts_number, record_prefixes):
+    """
+
+    Partitions input files between <parts_number> workers: by file when there are enough files, otherwise
+    every file is split into byte ranges. Returns list of (file_path, start, end) triples.
+
+    """
+    if len(file_paths) >= parts_number:
+        return [(file_path, 0, os.path.getsize(file_path)) for file_path in file_paths]
+    file_parts = (parts_number + len(file_paths) - 1) // len(file_paths)
+    return [(file_path, start, end)
+            for file_path in file_paths
+            for start, end in split_file(file_path, file_parts, record_prefixes)]
+
+
+class FileRange(object):
+
+    def __init__(self, file_path, start, end, header=None):
+        """
+
+        Read-only file object over lines of [start, end) byte range of file. Lines of <header> (e.g.
+        file header expected by parser) are returned first if range does not start at the beginning.
+
+        """
+        self.i_file = open(file_path, "rb")
+        self.i_file.seek(start)
+        self.end = end
+        self.header = list(header) if header is not None and start > 0 else []
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if len(self.header) > 0:
+            return self.header.pop(0)
+        if self.i_file.tell() >= self.end:
+            raise StopIteration()
+        line = self.i_file.readline()
+        if not line:
+            raise StopIteration()
+        return line
+
+    def close(self):
+        self.i_file.close()
+
+
+def next_shard_number(root_dir):
+    """
+
+    Returns number of the first shard directory which does not exist in <root_dir>.
+
+    """
+    shard_number = 0
+    while os.path.exists(os.path.join(root_dir, SHARD_DIR % shard_number)):
+        shard_number += 1
+    return shard_number
+
+
+def merge_lexicons(shard_dirs, output_dir, append=False):
+    """
+
+    Builds lexicon of all shards in <output_dir>. Terms of the first shard keep their ids, new terms of
+    the following shards get next ids in order of their local ids. If <append> is True, shards are merged
+    into existing lexicon of <output_dir> whose terms keep their ids. Returns lexicon and array mapping
+    local term ids to global ones for every shard.
+
+    """
+    lexicon = DictLexicon(output_dir)
+    if append:
+        lexicon.load()
+    term_maps = []
+    for shard_dir in shard_dirs:
+        shard_lexicon = DictLexicon(shard_dir)
+        shard_lexicon.load()
+        term_map = np.zeros(len(shard_lexicon), dtype=np.int64)
+        for term, (term_id, term_freq) in sorted(shard_lexicon.term_dict.iteritems(), key=lambda item: item[1][0]):
+            term_and_freq = lexicon.term_dict.get(term)
+            if term_and_freq is None:
+                term_and_freq = [len(lexicon.term_dict), 0]
+                lexicon.term_dict[term] = term_and_freq
+            term_and_freq[1] += term_freq
+            term_map[term_id] = term_and_freq[0]
+        shard_lexicon.ldb = None
+        term_maps.append(term_map)
+    lexicon.dump()
+    logging.info("Merged %d shard lexicons into %d terms." % (len(shard_dirs), len(lexicon)))
+    return lexicon, term_maps
+
+
+def remap_storage_terms(storage_dir, term_map):
+    storage = LdbStorage(storage_dir)
+    storage.load_meta()
+    remapped_fl = storage.terms_fl + ".tmp"
+    if os.path.exists(remapped_fl):
+        shutil.rmtree(remapped_fl)
+    terms_ldb = leveldb.LevelDB(storage.terms_fl)
+    remapped_ldb = leveldb.LevelDB(remapped_fl)
+    batch = leveldb.WriteBatch()
+    for term_id, term in terms_ldb.RangeIter():
+        batch.Put(storage.id_key(term_map[storage.key_id(term_id)]), term)
+    remapped_ldb.Write(batch, sync=False)
+    terms_ldb = None
+    remapped_ldb = None
+    shutil.rmtree(storage.terms_fl)
+    os.rename(remapped_fl, storage.terms_fl)
+
+
+def remap_shard(task):
+    """
+
+    Puts shard into global term ids space in place. Runs in worker process.
+
+    """
+    shard_dir, term_map = task
+    if not np.array_equal(term_map, np.arange(len(term_map))):
+        index = InvertedIndex(shard_dir)
+        index.open()
+        index.rewrite(term_map)
+        index.close()
+        remap_storage_terms(shard_dir, term_map)
+    shutil.rmtree(os.path.join(shard_dir, DictLexicon.LEX_DIR_NAME))
+    return shard_dir
+
+
+def export_shard(task):
+    """
+
+    Writes postings of shard as a segment of merged index with global term and document ids. Runs in
+    worker process, returns number of written postings.
+
+    """
+    shard_dir, output_dir, segment_name, term_map, doc_id_base = task
+    index = InvertedIndex(shard_dir)
+    index.open()
+    postings = index.write_segment(segment_name, index.iter_remapped(term_map, doc_id_base), output_dir)
+    index.close()
+    return postings
+
+
+def load_shard_meta(shard_dir):
+    index = InvertedIndex(shard_dir)
+    index.load_meta()
+    return index
+
+
+class ShardManifest(object):
+
+    def __init__(self, root_dir):
+        """
+
+        Description of index shards set: shard directories (relative to root) with their document id
+        ranges. Shard <i> holds documents doc_id_base[i]..doc_id_base[i] + documents_number[i] - 1 under
+        local ids starting from 0, ids of documents skipped by parser are in the range as well, so
+        documents_number[i] is next document id of shard index. All shards share lexicon stored in the root
+        directory.
+
+        """
+        self.root = root_dir
+        self.shards = []                                # [{"path", "doc_id_base", "documents_number"}]
+        self.documents_number = 0
+
+    @staticmethod
+    def exists(root_dir):
+        return os.path.exists(os.path.join(root_dir, MANIFEST_FL))
+
+    def shard_paths(self):
+        return [os.path.join(self.root, shard["path"]) for shard in self.shards]
+
+    def doc_id_bases(self):
+        return np.array([shard["doc_id_base"] for shard in self.shards], dtype=np.int64)
+
+    def add_shard(self, shard_path, documents_number):
+        self.shards.append({
+            "path": os.path.relpath(shard_path, self.root),
+            "doc_id_base": self.documents_number,
+            "documents_number": documents_number,
+        })
+        self.documents_number += documents_number
+
+    def dump(self):
+        manifest_file = open(os.path.join(self.root, MANIFEST_FL), "w")
+        manifest_file.write(json.dumps({
+            "shards": self.shards,
+            "documents_number": self.documents_number,
+        }, indent=8))
+        manifest_file.close()
+
+    def load(self):
+        manifest_file = open(os.path.join(self.root, MANIFEST_FL), "r")
+        manifest = json.loads(manifest_file.read())
+        manifest_file.close()
+        self.shards = manifest["shards"]
+        self.documents_number = manifest["documents_number"]
+        return self
+
+
+def merge_shards(output_dir, shard_dirs, single=True, jobs=1, append=False):
+    """
+
+    Merges lexicons of independently built shards and puts their postings into global term id space.
+    If <single> is True, shards are merged into one index, storage and lexicon in <output_dir> and removed.
+    Otherwise shards are kept as they are and shards manifest is written to <output_dir>. If <append> is
+    True, shards are added to the index (or shards manifest) which already exists in <output_dir>: its
+    terms and documents keep their ids, postings of shards are written as new segments.
+
+    """
+    shard_indexes = [load_shard_meta(shard_dir) for shard_dir in shard_dirs]
+    if len(shard_indexes[0].partition_fields) > 0:
+        raise Exception("Shards of index with partitions can not be merged.")
+    # Documents are copied or kept as they are, so all shards should split them into the same columns.
+    if append and not single:
+        target_storage = LdbStorage(ShardManifest(output_dir).load().shard_paths()[0])
+    elif append:
+        target_storage = LdbStorage(output_dir)
+    else:
+        target_storage = LdbStorage(shard_dirs[0])
+    target_storage.load_meta()
+    for shard_dir in shard_dirs:
+        shard_storage = LdbStorage(shard_dir)
+        shard_storage.load_meta()
+        if shard_storage.columns != target_storage.columns:
+            raise Exception("Storage of shard %s has columns %r, expected %r." % (shard_dir,
+                                                                                 shard_storage.columns,
+                                                                                 target_storage.columns))
+    lexicon, term_maps = merge_lexicons(shard_dirs, output_dir, append)
+    pool = multiprocessing.Pool(jobs)
+
+    if not single:
+        pool.map(remap_shard, zip(shard_dirs, term_maps))
+        pool.close()
+        pool.join()
+        manifest = ShardManifest(output_dir)
+        if append:
+            manifest.load()
+        for shard_dir, shard_index in zip(shard_dirs, shard_indexes):
+            manifest.add_shard(shard_dir, shard_index.next_document_id())
+        manifest.dump()
+        logging.info("Wrote manifest of %d shards with %d documents." % (len(shard_dirs), manifest.documents_number))
+        return manifest
+
+    storage = LdbStorage(output_dir)
+    if append:
+        index = InvertedIndex(output_dir)
+        index.open()
+        index.close()
+        storage.load_meta()
+        first_id = max(index.next_document_id(), storage.documents_number)
+        terms_number = storage.terms_number
+    else:
+        first_index = shard_indexes[0]
+        index = InvertedIndex(output_dir,
+                              field_properties=first_index.field_properties,
+                              index_format=first_index.index_format,
+                              field_codecs=dict((p[0], c.name) for p, c in zip(first_index.field_properties,
+                                                                             first_index.field_codecs)))
+        index.init_index()
+        storage.copy_layout(target_storage)
+        storage.init_db()
+        first_id = 0
+        terms_number = 0
+    doc_id_bases = np.cumsum([first_id] + [shard_index.next_document_id() for shard_index in shard_indexes])
+    segment_names = [index.new_segment_name() for _ in shard_dirs]
+    postings = pool.map(export_shard, [(shard_dir, output_dir, segment_name, term_map, doc_id_base)
+                                       for shard_dir, segment_name, term_map, doc_id_base
+                                       in zip(shard_dirs, segment_names, term_maps, doc_id_bases)])
+    pool.close()
+    pool.join()
+    index.segments_meta += [{"name": name, "postings": number} for name, number in zip(segment_names, postings)]
+    index.documents_number = int(doc_id_bases[-1])
+    index.next_document = int(doc_id_bases[-1])
+    index.terms_number += sum(shard_index.terms_number for shard_index in shard_indexes)
+    index.dump_meta()
+    index.update_stats()
+
+    storage.open_db()
+    for shard_dir, doc_id_base in zip(shard_dirs, doc_id_bases):
+        shard_storage = LdbStorage(shard_dir)
+        shard_storage.load_meta()
+        shard_storage.open_db()
+        for doc_id, document in shard_storage.iter_documents():
+            storage.add_document(doc_id_base + doc_id, document)
+        shard_storage.close_db()
+    new_terms = [(term_id, term) for term, (term_id, _) in lexicon.term_dict.iteritems() if term_id >= terms_number]
+    storage.add_terms(lexicon, [term for _, term in sorted(new_terms)])
+    storage.close_db()
+
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+    logging.info("Merged %d shards into %s." % (len(shard_dirs), output_dir))
+    return index
+
+
+def build_shard(task):
+    """
+
+    Indexes part of input file into a new shard. Runs in worker process, returns shard directory.
+
+    """
+    builder, shard_path, input_path, start, end = task
+    os.makedirs(shard_path)
+    logging.info("Indexing bytes %d..%d of %s into %s" % (start, end, input_path, shard_path))
+    builder.build_index(shard_path, FileRange(input_path, start, end, read_header(input_path, builder.header_lines)))
+    return shard_path
+
+
+class ShardedIndexBuilder(object):
+
+    def __init__(self, output_path, field_name, index_format=INDEX_FORMAT.LDB, codec=CODEC.RAW, bulk_mode=False,
+                 doc_block=0, doc_compression=COMPRESSION.ZLIB, doc_format=DOC_FORMAT.LDB, jobs=1, single=True,
+                 append=False):
+        """
+
+        Builds index, storage and lexicon of input documents in <output_path>, in a single process or, if
+        <jobs> > 1, in parallel shards, which are merged into a single index if <single> is True or kept as
+        shards manifest otherwise (see merge_shards). In <append> mode documents are added to the index or
+        shards which already exist in <output_path>: their format, codec and storage layout are kept, the
+        given ones are used for new index only. Subclasses define how documents are parsed and indexed.
+
+        """
+        self.output_path = output_path
+        self.field_name = field_name                    # name of document id field of index
+        self.index_format = index_format
+        self.codec = codec
+        self.bulk_mode = bulk_mode
+        self.doc_block = doc_block                      # documents are compressed in blocks if it is given
+        self.doc_compression = doc_compression
+        self.doc_format = doc_format
+        self.jobs = jobs
+        self.single = single
+        self.record_prefixes = ()                       # lines starting records, input is split only at them
+        self.header_lines = 0                           # number of lines of file header expected by parser
+        self.append = append and (os.path.exists(os.path.join(output_path, InvertedIndex.META_FILE)) or
+                                  ShardManifest.exists(output_path))
+        self.sharded = self.append and ShardManifest.exists(output_path)
+        self.existing_path = None                       # index (or first shard) documents are appended to
+        if self.append:
+            if self.sharded:
+                self.existing_path = ShardManifest(output_path).load().shard_paths()[0]
+            else:
+                self.existing_path = output_path
+            existing_index = InvertedIndex(self.existing_path)
+            existing_index.load_meta()
+            self.index_format = existing_index.index_format
+            self.codec = existing_index.field_codecs[0].name
+            logging.info("Appending to existing index (format %s, codec %s)." % (self.index_format, self.codec))
+
+    @abc.abstractmethod
+    def make_stream(self, input_fl):
+        """
+
+        Returns stream of raw documents read from file object <input_fl>.
+
+        """
+        return NotImplementedError("ShardedIndexBuilder is abstract class")
+
+    @abc.abstractmethod
+    def make_parser(self):
+        return NotImplementedError("ShardedIndexBuilder is abstract class")
+
+    @abc.abstractmethod
+    def make_indexer(self, lexicon):
+        return NotImplementedError("ShardedIndexBuilder is abstract class")
+
+    def init_storage(self, storage):
+        """
+
+        Sets layout of new storage which is not appended to existing one.
+
+        """
+        if self.doc_block > 0:
+            storage.doc_compression_block = self.doc_block
+            storage.compression = self.doc_compression
+        storage.doc_format = self.doc_format
+
+    def build_index(self, output_path, input_fl, append=False):
+
+        logging.info("Initializing lexicon.")
+        lexicon = DictLexicon(output_path)
+        if append:
+            lexicon.load()
+
+        logging.info("Initializing storage.")
+        storage = LdbStorage(output_path)
+        if append:
+            storage.load_meta()
+        else:
+            # Shards appended to existing storage get its layout.
+            if self.existing_path is not None:
+                existing_storage = LdbStorage(self.existing_path)
+                existing_storage.load_meta()
+                storage.copy_layout(existing_storage)
+            else:
+                self.init_storage(storage)
+            storage.init_db()
+        storage.open_db()
+
+        logging.info("Initializing index.")
+        if append:
+            index = InvertedIndex(output_path, bulk_mode=self.bulk_mode)
+        else:
+            index = InvertedIndex(output_path,
+                                  field_properties=[(self.field_name, np.int32)],
+                                  index_format=self.index_format,
+                                  bulk_mode=self.bulk_mode,
+                                  field_codecs={self.field_name: self.codec})
+            index.init_index()
+        index.open()
+
+        logging.info("Initializing parser.")
+        stream = self.make_stream(input_fl)
+        parser = self.make_parser()
+        indexer = self.make_indexer(lexicon)
+
+        logging.info("Initializing indexing pipeline.")
+        indexing_pipeline = IndexingPipeline(lexicon, index, storage)
+        if append:
+            indexing_pipeline.continue_ids(parser)
+        indexing_pipeline.index_stream(stream, parser, indexer)
+
+        logging.info("Closing index.")
+        index.close()
+
+        logging.info("Closing storage.")
+        storage.close_db()
+
+        logging.info("Dumping lexicon.")
+        lexicon.dump()
+
+    def build(self, input_path):
+        """
+
+        Indexes <input_path>, which is a glob pattern of input files if documents are indexed in shards.
+
+        """
+        if not self.append:
+            if os.path.exists(self.output_path):
+                shutil.rmtree(self.output_path)
+            os.makedirs(self.output_path)
+
+        if self.jobs <= 1 and not self.sharded:
+            logging.info("Start indexing file: %s" % input_path)
+            logging.info("Input size: %.2fMB" % (float(os.path.getsize(input_path)) / (1024 ** 2)))
+            with open(input_path, "rb") as input_fl:
+                self.build_index(self.output_path, input_fl, self.append)
+            return
+
+        input_paths = sorted(glob.glob(input_path))
+        first_shard = next_shard_number(self.output_path)
+        shard_tasks = [(self, os.path.join(self.output_path, SHARD_DIR % (first_shard + i))) + part
+                       for i, part in enumerate(plan_parts(input_paths, self.jobs, self.record_prefixes))]
+        logging.info("Start indexing %d files in %d shards using %d processes." % (len(input_paths),
+                                                                                 len(shard_tasks),
+                                                                                 self.jobs))
+        pool = multiprocessing.Pool(self.jobs)
+        shard_paths = pool.map(build_shard, shard_tasks)
+        pool.close()
+        pool.join()
+
+        logging.info("Merging shards.")
+        merge_shards(self.output_path,
+                     shard_paths,
+                     single=self.single and not self.sharded,
+                     jobs=self.jobs,
+                     append=self.append)
+
+
+class ShardedStorage(object):
+
+    def __init__(self, manifest, storages=None):
+        """
+
+        Read-only view of document storages of all shards from <manifest>. Takes global document ids and
+        routes every request to the storage of the shard holding this document. If <storages> are given,
+        they are used as storages of shards (e.g. the same column of every shard).
+
+        """
+        self.manifest = manifest
+        self.doc_id_bases = manifest.doc_id_bases()
+        if storages is None:
+            storages = [LdbStorage(shard_path) for shard_path in manifest.shard_paths()]
+        self.storages = storages
+        self.columns = []
+
+    def open_db(self):
+        for storage in self.storages:
+            storage.load_meta()
+            storage.open_db()
+        self.columns = self.storages[0].columns if len(self.storages) > 0 else []
+
+    def column(self, name):
+        return ShardedStorage(self.manifest, [storage.column(name) for storage in self.storages])
+
+    def close_db(self):
+        for storage in self.storages:
+            storage.release_db()
+
+    def get_document(self, document_id):
+        shard_number = np.searchsorted(self.doc_id_bases, document_id, side="right") - 1
+        return self.storages[shard_number].get_document(document_id - self.doc_id_bases[shard_number])
+
+    def get_documents(self, document_ids, key_order=False):
+        """
+
+        Iterates over (document_id, document) pairs like LdbStorage.get_documents. Every batch of ids is
+        split between shards and read from each shard in its key order. If <key_order> is True, documents
+        are returned grouped by shard.
+
+        """
+        document_ids = np.asarray(list(document_ids), dtype=np.int64)
+        batch_size = len(document_ids) if key_order else LdbStorage.READ_BATCH_SZ
+        for start in xrange(0, len(document_ids), max(batch_size, 1)):
+            batch = document_ids[start:(start + batch_size)]
+            shard_numbers = np.searchsorted(self.doc_id_bases, batch, side="right") - 1
+            documents = []
+            for shard_number in np.unique(shard_numbers):
+                doc_id_base = self.doc_id_bases[shard_number]
+                local_ids = batch[shard_numbers == shard_number] - doc_id_base
+                documents.extend((int(doc_id_base + local_id), document)
+                                 for local_id, document
+                                 in self.storages[shard_number].get_documents(local_ids, key_order=True))
+            if key_order:
+                for document_id, document in documents:
+                    yield document_id, document
+            else:
+                documents = dict(documents)
+                for document_id in batch:
+                    yield int(document_id), documents[int(document_id)]
@@ -3,10 +3,29 @@
 
 import os
 import json
+import mmap
 import leveldb
 import logging
+import itertools
 import numpy as np
 
+from sear.cache import LruCache
+from sear.keys import KEY_FORMAT
+from sear.keys import encode_id
+from sear.keys import decode_id
+from sear.keys import rekey_ldb
+from sear.segment import map_array
+
+
+def decode_offsets(offsets):
+    """
+
+    Returns document end offsets of MMAP offsets array, in which missing documents have complement (~) of
+    their end offset.
+
+    """
+    return np.where(offsets < 0, ~offsets, offsets)
+
 
 class COMPRESSION:
 
@@ -17,13 +36,29 @@ class COMPRESSION:
     LZ4H = "LZ4H"
 
 
+class DOC_FORMAT:
+
+    LDB = "LDB"
+    MMAP = "MMAP"
+
+
 class LdbStorage(object):
     TERMS_FL = "terms.ldb"
     DOCS_FL = "docs.ldb"
+    DOCS_DATA_FL = "docs.dat"
+    DOCS_OFFSETS_FL = "docs.off"
+    COLUMN_DIR = "column.%s"
     META_FL = "storage.json"
 
     TERM_BUFF_SZ = 4096 * 128
     DOCS_BUFF_SZ = 4096 * 1024
+    READ_BATCH_SZ = 4096                                # number of documents sorted and read at once
+    MAX_SCAN_GAP = 16                                   # max number of keys skipped before seeking
+    DOC_BLOCK_PREFIX = "b"
+    DOC_BLOCK_KEY = DOC_BLOCK_PREFIX + "%d"
+    BLOCK_CACHE_SZ = 16 * 1024 * 1024
+    DOC_CACHE_SZ = 64 * 1024 * 1024
+    TERM_CACHE_SZ = 8 * 1024 * 1024
 
     def __init__(self, root_dir, terms_fl=None, docs_fl=None):
 
@@ -31,6 +66,8 @@ class LdbStorage(object):
         self.terms_fl = terms_fl if terms_fl is not None else os.path.join(self.root, self.TERMS_FL)
         self.docs_fl = docs_fl if docs_fl is not None else os.path.join(self.root, self.DOCS_FL)
         self.meta_fl = os.path.join(self.root, self.META_FL)
+        self.docs_data_fl = os.path.join(self.root, self.DOCS_DATA_FL)
+        self.docs_offsets_fl = os.path.join(self.root, self.DOCS_OFFSETS_FL)
 
         self.opened = False
 
@@ -51,19 +88,26 @@ class LdbStorage(object):
         self.doc_flush_buffer = None                    # string array used to cache documents before flushing to disk
         self.term_flush_buffer = None                   # string array used to cache terms before flushing to disk
 
-        self.term_cache = None                          # term read cache
-        self.doc_cache = None                           # term read cache
+        self.term_cache = None                          # term read cache, enabled by <cache_terms>
+        self.doc_cache = None                           # document read cache, enabled by <cache_documents>
 
         self.compression = COMPRESSION.NONE             #
         self.doc_compression_block = 0                  #
         self.term_compression_block = 0                 #
         self.compression_level = 9                      #
+        self.key_format = KEY_FORMAT.TEXT               # storages without it in meta have text keys, new are binary
+        self.doc_format = DOC_FORMAT.LDB                # where documents are stored, see DOC_FORMAT
+        self.columns = []                               # names of document columns, empty if documents are whole
+        self.column_storages = []                       # storage of every column
 
         self.compress = None                            # compression func,  will be assigned in <open> method
         self.decompress = None                          # decompression func, will be assigned in <open> method
 
         self.terms_ldb = None                           # LDB instance to store terms
         self.docs_ldb = None                            # LDB instance to store docs
+        self.docs_data = None                           # memory mapped documents data file (MMAP format)
+        self.doc_offsets = None                         # memory mapped int64 array of document end offsets
+        self.block_cache = LruCache(self.BLOCK_CACHE_SZ, name="Document blocks cache")
 
         if self.doc_compression_block > 0 and self.max_doc_flush_buffer_size % self.doc_compression_block != 0:
             raise Exception("Buffer size should be N times compression block")
@@ -82,6 +126,9 @@ class LdbStorage(object):
             "doc_compression_block":        self.doc_compression_block,
             "term_compression_block":       self.term_compression_block,
             "compression_level":            self.compression_level,
+            "key_format":                   self.key_format,
+            "doc_format":                   self.doc_format,
+            "columns":                      self.columns,
         }, indent=8)
 
     def dump_meta(self):
@@ -102,6 +149,13 @@ class LdbStorage(object):
         self.doc_compression_block = meta["doc_compression_block"]
         self.term_compression_block = meta["doc_compression_block"]
         self.compression_level = meta["compression_level"]
+        self.key_format = meta.get("key_format", KEY_FORMAT.TEXT)
+        self.doc_format = meta.get("doc_format", DOC_FORMAT.LDB)
+        if meta.get("columns", []) != self.columns:
+            self.columns = []
+            self.column_storages = []
+            for column_name in meta.get("columns", []):
+                self.add_column(column_name)
 
     def load_meta(self):
         logging.info("Storage: loading meta.")
@@ -109,15 +163,82 @@ class LdbStorage(object):
         meta_json = meta_file.read()
         meta_file.close()
         self.loads_meta(meta_json)
+        for column_storage in self.column_storages:
+            column_storage.load_meta()
 
     def init_db(self):
         if not os.path.exists(self.root):
             os.mkdir(self.root)
+        self.key_format = KEY_FORMAT.BINARY
         self.dump_meta()
+        for column_storage in self.column_storages:
+            column_storage.init_db()
+
+    def add_column(self, name, compression=COMPRESSION.NONE, doc_compression_block=0, doc_format=DOC_FORMAT.LDB):
+        """
+
+        Adds document column kept in its own storage with its own compression and document format, so
+        columns can be read separately. Documents of storage with columns are lists of column values.
+        Columns should be added before init_db.
+
+        """
+        column_storage = LdbStorage(os.path.join(self.root, self.COLUMN_DIR % name))
+        column_storage.compression = compression
+        column_storage.doc_compression_block = doc_compression_block
+        column_storage.doc_format = doc_format
+        self.columns.append(name)
+        self.column_storages.append(column_storage)
+        return column_storage
+
+    def column(self, name):
+        return self.column_storages[self.columns.index(name)]
+
+    def copy_layout(self, storage):
+        """
+
+        Makes documents of this storage laid out as in <storage>: the same compression, blocks, document
+        format and columns. Should be called before init_db.
+
+        """
+        self.compression = storage.compression
+        self.compression_level = storage.compression_level
+        self.doc_compression_block = storage.doc_compression_block
+        self.doc_format = storage.doc_format
+        self.columns = []
+        self.column_storages = []
+        for name, column_storage in zip(storage.columns, storage.column_storages):
+            self.add_column(name,
+                            column_storage.compression,
+                            column_storage.doc_compression_block,
+                            column_storage.doc_format)
+
+    def document_value(self, document):
+        """
+
+        Returns value which is stored for <document>: its string, or list of its column values if storage
+        has columns.
+
+        """
+        if len(self.columns) > 0:
+            return document.tocolumns(self.columns)
+        return document.tostring()
 
     def open_db(self):
         self.terms_ldb = leveldb.LevelDB(self.terms_fl)
-        self.docs_ldb = leveldb.LevelDB(self.docs_fl)
+        if len(self.columns) > 0:
+            for column_storage in self.column_storages:
+                column_storage.open_db()
+        elif self.doc_format == DOC_FORMAT.MMAP:
+            if self.doc_compression_block > 0:
+                raise Exception("Document blocks are not supported by %s document format." % self.doc_format)
+            if not os.path.exists(self.docs_offsets_fl):
+                open(self.docs_data_fl, "wb").close()
+                np.zeros(1, dtype=np.int64).tofile(self.docs_offsets_fl)
+            self.map_documents()
+        elif self.doc_format == DOC_FORMAT.LDB:
+            self.docs_ldb = leveldb.LevelDB(self.docs_fl)
+        else:
+            raise Exception("Wrong document format %r" % self.doc_format)
 
         self.doc_buffer_size = 0
         self.term_buffer_size = 0
@@ -149,13 +270,33 @@ class LdbStorage(object):
             self.decompress = lambda string: lz4.decompress(string)
         else:
             raise Exception("Wrong compression type %r" % self.compression)
+        self.block_cache.clear()
+        if self.doc_cache is not None:
+            self.doc_cache.clear()
+        if self.term_cache is not None:
+            self.term_cache.clear()
 
     def close_db(self):
         logging.info("Storage: closing database.")
         self.flush_term_buffers()
         self.flush_doc_buffers()
+        for column_storage in self.column_storages:
+            column_storage.close_db()
+        self.release_db()
+
+    def release_db(self):
+        """
+
+        Closes storage which was opened for reading only: releases databases, mapped files and buffers
+        of storage and its columns without flushing buffers and writing meta.
+
+        """
+        for column_storage in self.column_storages:
+            column_storage.release_db()
         self.terms_ldb = None
         self.docs_ldb = None
+        self.docs_data = None
+        self.doc_offsets = None
         self.term_flush_buffer = None
         self.doc_flush_buffer = None
         self.doc_buffer_size = None
@@ -171,22 +312,217 @@ class LdbStorage(object):
         for i in xrange(0, self.term_buffer_size):
             term_id = self.term_id_flush_buffer[i]
             term = self.term_flush_buffer[i]
-            batch.Put(str(term_id), term)
+            batch.Put(self.id_key(term_id), term)
         self.terms_number += self.term_buffer_size
         self.terms_ldb.Write(batch, sync=False)
         self.term_buffer_size = 0
+        if self.term_cache is not None:
+            self.term_cache.clear()
         self.dump_meta()
 
+    def id_key(self, number):
+        """
+
+        Returns database key of document or term id. Ids are non-negative, KeyError is raised for negative
+        ones, which can not be stored.
+
+        """
+        if number < 0:
+            raise KeyError(str(number))
+        if self.key_format == KEY_FORMAT.BINARY:
+            return encode_id(int(number))
+        return str(number)
+
+    def block_key(self, block_id):
+        if block_id < 0:
+            raise KeyError(str(block_id))
+        if self.key_format == KEY_FORMAT.BINARY:
+            return encode_id(int(block_id))
+        return self.DOC_BLOCK_KEY % block_id
+
+    def key_id(self, key):
+        """
+
+        Returns document, term or block id from database key.
+
+        """
+        if self.key_format == KEY_FORMAT.BINARY:
+            return decode_id(key)
+        if key.startswith(self.DOC_BLOCK_PREFIX):
+            return int(key[len(self.DOC_BLOCK_PREFIX):])
+        return int(key)
+
+    def migrate_keys(self):
+        """
+
+        Rewrites databases of closed storage which has text keys to binary keys, so documents are stored in
+        id order. Returns False if storage already has binary keys.
+
+        """
+        if self.terms_ldb is not None:
+            raise Exception("Storage should be closed in order to migrate keys.")
+        if self.key_format == KEY_FORMAT.BINARY:
+            return False
+        rekey = lambda key: encode_id(self.key_id(key))
+        rekey_ldb(self.terms_fl, rekey)
+        if len(self.columns) > 0:
+            for column_storage in self.column_storages:
+                column_storage.migrate_keys()
+        elif self.doc_format == DOC_FORMAT.LDB:
+            rekey_ldb(self.docs_fl, rekey)
+        self.key_format = KEY_FORMAT.BINARY
+        self.dump_meta()
+        return True
+
+    def encode_block(self, documents):
+        """
+
+        Packs list of doc_compression_block documents (None for missing ones) into a compressed block:
+
+            int32 [length of every document, -1 if missing] + concatenated documents
+
+        """
+        lengths = np.array([-1 if document is None else len(document) for document in documents], dtype=np.int32)
+        return self.compress(lengths.tostring() + "".join(document for document in documents if document is not None))
+
+    def decode_block(self, block_blob):
+        """
+
+        Returns (starts, lengths, data) of decompressed block, document <i> of block is
+        data[starts[i]:starts[i] + lengths[i]] or missing if lengths[i] is -1.
+
+        """
+        data = self.decompress(block_blob)
+        header_size = self.doc_compression_block * 4
+        lengths = np.frombuffer(data[:header_size], dtype=np.int32)
+        starts = header_size + np.concatenate(([0], np.cumsum(np.maximum(lengths, 0))[:-1]))
+        return starts, lengths, data
+
+    def block_documents(self, block):
+        starts, lengths, data = block
+        return [None if lengths[i] < 0 else data[starts[i]:(starts[i] + lengths[i])] for i in xrange(len(lengths))]
+
+    def read_blocks(self, block_ids):
+        """
+
+        Returns dict mapping block id to decoded block (see decode_block) or None if block does not exist.
+        Blocks are taken from decoded blocks cache, the others are read in key order.
+
+        """
+        blocks = dict()
+        keys = []
+        for block_id in set(block_ids):
+            block = self.block_cache.get(block_id)
+            if block is not None:
+                blocks[block_id] = block
+            else:
+                keys.append(self.block_key(block_id))
+        for key, block_blob in self.iter_keys(self.docs_ldb, sorted(keys)):
+            block_id = self.key_id(key)
+            if block_blob is None:
+                blocks[block_id] = None
+                continue
+            block = self.decode_block(block_blob)
+            self.block_cache.put(block_id, block, len(block[2]) + block[0].nbytes + block[1].nbytes)
+            blocks[block_id] = block
+        return blocks
+
+    def flush_doc_blocks(self, batch):
+        """
+
+        Puts buffered documents to blocks of doc_compression_block consecutive ids. Blocks which are not
+        completely covered by the buffer (e.g. first block when appending) are merged with stored ones.
+
+        """
+        if self.doc_buffer_size == 0:
+            return
+        block_size = self.doc_compression_block
+        doc_ids = self.doc_id_flush_buffer[:self.doc_buffer_size]
+        block_ids = doc_ids // block_size
+        order = np.argsort(block_ids, kind="mergesort")
+        block_ids = block_ids[order]
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(block_ids)) + 1, [len(block_ids)]))
+        for b in xrange(len(bounds) - 1):
+            block_id = int(block_ids[bounds[b]])
+            rows = order[bounds[b]:bounds[b + 1]]
+            documents = [None] * block_size
+            if len(rows) < block_size:
+                stored = self.read_blocks([block_id])[block_id]
+                if stored is not None:
+                    documents = self.block_documents(stored)
+            for row in rows:
+                documents[doc_ids[row] - block_id * block_size] = self.doc_flush_buffer[row]
+            batch.Put(self.block_key(block_id), self.encode_block(documents))
+        self.block_cache.clear()
+
+    def map_documents(self):
+        """
+
+        Maps documents data and offsets files of MMAP document format. Mapped pages are read only, so they
+        are shared by all processes which read the same storage.
+
+        """
+        self.doc_offsets = map_array(self.docs_offsets_fl, np.int64)
+        if os.path.getsize(self.docs_data_fl) == 0:
+            self.docs_data = ""
+        else:
+            with open(self.docs_data_fl, "rb") as data_file:
+                self.docs_data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def flush_doc_files(self):
+        """
+
+        Appends buffered documents to data file and their end offsets to offsets file of MMAP document
+        format. Documents should be added in increasing id order, skipped ids get complement of end offset
+        of the previous document, which marks them as missing.
+
+        """
+        if self.doc_buffer_size == 0:
+            return
+        doc_ids = self.doc_id_flush_buffer[:self.doc_buffer_size]
+        next_id = len(self.doc_offsets) - 1
+        if doc_ids[0] < next_id or np.any(np.diff(doc_ids) <= 0):
+            raise Exception("Documents of %s format should be added in increasing id order." % self.doc_format)
+        documents = self.doc_flush_buffer[:self.doc_buffer_size]
+        data_size = int(decode_offsets(self.doc_offsets[-1]))
+        ends = data_size + np.cumsum([len(document) for document in documents])
+        positions = doc_ids - next_id
+        last_doc = np.searchsorted(positions, np.arange(positions[-1] + 1), side="right") - 1
+        new_offsets = np.where(last_doc >= 0, ends[np.maximum(last_doc, 0)], data_size).astype(np.int64)
+        missing = np.ones(len(new_offsets), dtype=bool)
+        missing[positions] = False
+        new_offsets[missing] = ~new_offsets[missing]
+        with open(self.docs_data_fl, "r+b") as data_file:
+            # Drops tail of interrupted flush, which has no offsets.
+            data_file.truncate(data_size)
+            data_file.seek(data_size)
+            data_file.write("".join(documents))
+        with open(self.docs_offsets_fl, "ab") as offsets_file:
+            new_offsets.tofile(offsets_file)
+        self.map_documents()
+
     def flush_doc_buffers(self):
         logging.info("Storage: flushing documents buffer [%d items]." % self.doc_buffer_size)
-        batch = leveldb.WriteBatch()
-        for i in xrange(0, self.doc_buffer_size):
-            doc_id = self.doc_id_flush_buffer[i]
-            doc = self.doc_flush_buffer[i]
-            batch.Put(str(doc_id), doc)
+        if len(self.columns) > 0:
+            for column_storage in self.column_storages:
+                column_storage.flush_doc_buffers()
+            self.documents_number = self.column_storages[0].documents_number
+        elif self.doc_format == DOC_FORMAT.MMAP:
+            self.flush_doc_files()
+        else:
+            batch = leveldb.WriteBatch()
+            if self.doc_compression_block > 0:
+                self.flush_doc_blocks(batch)
+            else:
+                for i in xrange(0, self.doc_buffer_size):
+                    doc_id = self.doc_id_flush_buffer[i]
+                    doc = self.doc_flush_buffer[i]
+                    batch.Put(self.id_key(doc_id), doc)
+            self.docs_ldb.Write(batch, sync=False)
         self.documents_number += self.doc_buffer_size
-        self.docs_ldb.Write(batch, sync=False)
         self.doc_buffer_size = 0
+        if self.doc_cache is not None:
+            self.doc_cache.clear()
         self.dump_meta()
 
     def add_terms(self, lexicon, terms):
@@ -199,24 +535,283 @@ class LdbStorage(object):
                 self.flush_term_buffers()
 
     def add_document(self, doc_id, doc_blob):
+        if len(self.columns) > 0:
+            if not isinstance(doc_blob, list) or len(doc_blob) != len(self.columns):
+                raise Exception("Document %d should be a list of %d column values." % (doc_id, len(self.columns)))
+            for column_storage, column_value in zip(self.column_storages, doc_blob):
+                column_storage.add_document(doc_id, column_value)
+            return
+        if isinstance(doc_blob, list):
+            raise Exception("Storage has no columns, document %d should be a string." % doc_id)
         self.doc_id_flush_buffer[self.doc_buffer_size] = doc_id
         self.doc_flush_buffer[self.doc_buffer_size] = doc_blob
         self.doc_buffer_size += 1
         if self.doc_buffer_size == self.max_doc_flush_buffer_size:
             self.flush_doc_buffers()
 
-    def cache_terms(self):
-        pass
-
-    def cache_documents(self):
-        pass
+    def cache_terms(self, max_bytes=None, term_ids=None):
+        """
+
+        Enables LRU cache of read terms bounded by <max_bytes> (TERM_CACHE_SZ by default). Terms of
+        <term_ids> are preloaded into the cache, storage should be opened in this case.
+
+        """
+        self.term_cache = LruCache(max_bytes if max_bytes is not None else self.TERM_CACHE_SZ, name="Terms cache")
+        if term_ids is not None:
+            keys = sorted(set(self.id_key(term_id) for term_id in term_ids if term_id >= 0))
+            for key, term in self.iter_keys(self.terms_ldb, keys):
+                if term is not None:
+                    self.term_cache.put(self.key_id(key), term, len(term))
+            logging.info("Storage: preloaded %d terms." % len(self.term_cache))
+
+    def cache_documents(self, max_bytes=None, document_ids=None):
+        """
+
+        Enables LRU cache of read documents bounded by <max_bytes> (DOC_CACHE_SZ by default). Cache keeps
+        decompressed documents, so documents which are read again touch neither the database nor the
+        block cache. Documents of <document_ids> are preloaded into the cache, storage should be opened
+        in this case. Storage with columns enables the cache of every column.
+
+        """
+        if len(self.columns) > 0:
+            for column_storage in self.column_storages:
+                column_storage.cache_documents(max_bytes, document_ids)
+            return
+        self.doc_cache = LruCache(max_bytes if max_bytes is not None else self.DOC_CACHE_SZ, name="Documents cache")
+        if document_ids is not None:
+            for document_id, document in self.read_documents(document_ids, key_order=True):
+                if document is not None:
+                    self.doc_cache.put(document_id, document, len(document))
+            logging.info("Storage: preloaded %d documents." % len(self.doc_cache))
+
+    def log_stats(self):
+        if self.doc_compression_block > 0:
+            self.block_cache.log_stats()
+        if self.doc_cache is not None:
+            self.doc_cache.log_stats()
+        if self.term_cache is not None:
+            self.term_cache.log_stats()
+        for column_storage in self.column_storages:
+            column_storage.log_stats()
+
+    def document_key(self, document_id):
+        """
+
+        Returns sort key of document id which follows order of documents in database. Negative ids, which
+        are never stored, come first.
+
+        """
+        if self.doc_format == DOC_FORMAT.MMAP:
+            return document_id
+        if self.doc_compression_block > 0:
+            return self.block_key(document_id // self.doc_compression_block) if document_id >= 0 else "", document_id
+        return self.id_key(document_id) if document_id >= 0 else ""
 
     def get_document(self, document_id):
-        if self.docs_ldb is None:
+        if self.terms_ldb is None:
             return Exception("Storage should be opened in order to retrieve documents.")
-        return self.docs_ldb.Get(str(document_id))
-
-    def get_term(self):
-        pass
+        if len(self.columns) > 0:
+            return [column_storage.get_document(document_id) for column_storage in self.column_storages]
+        if self.doc_cache is None:
+            return self.read_document(document_id)
+        document_id = int(document_id)
+        document = self.doc_cache.get(document_id)
+        if document is None:
+            document = self.read_document(document_id)
+            self.doc_cache.put(document_id, document, len(document))
+        return document
+
+    def mapped_document(self, document_id):
+        """
+
+        Returns document of MMAP document format or None if it is missing (its end offset is negative): one
+        lookup in offsets array and a slice of data file.
+
+        """
+        if 0 <= document_id < len(self.doc_offsets) - 1:
+            start, end = int(decode_offsets(self.doc_offsets[document_id])), int(self.doc_offsets[document_id + 1])
+            if end >= 0:
+                return self.docs_data[start:end]
+        return None
+
+    def read_document(self, document_id):
+        if self.doc_format == DOC_FORMAT.MMAP:
+            document = self.mapped_document(int(document_id))
+            if document is None:
+                raise KeyError(str(document_id))
+            return document
+        if self.doc_compression_block > 0:
+            block_id, position = divmod(int(document_id), self.doc_compression_block)
+            block = self.read_blocks([block_id])[block_id]
+            if block is None or block[1][position] < 0:
+                raise KeyError(str(document_id))
+            starts, lengths, data = block
+            return data[starts[position]:(starts[position] + lengths[position])]
+        return self.docs_ldb.Get(self.id_key(document_id))
+
+    def iter_documents(self):
+        """
+
+        Iterates over (document_id, document) pairs of all stored documents in key order.
+
+        """
+        if len(self.columns) > 0:
+            for column_documents in itertools.izip(*[column_storage.iter_documents()
+                                                     for column_storage in self.column_storages]):
+                document_id = column_documents[0][0]
+                if any(column_document_id != document_id for column_document_id, _ in column_documents):
+                    raise Exception("Columns of document %d are out of order." % document_id)
+                yield document_id, [column_document for _, column_document in column_documents]
+        elif self.doc_format == DOC_FORMAT.MMAP:
+            ends = decode_offsets(self.doc_offsets)
+            for document_id in np.flatnonzero(self.doc_offsets[1:] >= 0):
+                yield int(document_id), self.docs_data[ends[document_id]:ends[document_id + 1]]
+        elif self.doc_compression_block > 0:
+            for key, block_blob in self.docs_ldb.RangeIter():
+                block_id = self.key_id(key)
+                for position, document in enumerate(self.block_documents(self.decode_block(block_blob))):
+                    if document is not None:
+                        yield block_id * self.doc_compression_block + position, document
+        else:
+            for key, document in self.docs_ldb.RangeIter():
+                yield self.key_id(key), document
+
+    def iter_keys(self, ldb, keys):
+        """
+
+        Iterates over (key, value) pairs of sorted unique <keys> in key order, value is None if key is not
+        in <ldb>. Keys are read with range iterators, which go on sequentially while the next requested key
+        is at most MAX_SCAN_GAP keys ahead, otherwise the iterator seeks to it.
+
+        """
+        i = 0
+        while i < len(keys):
+            skipped = 0
+            for key, value in ldb.RangeIter(key_from=keys[i]):
+                while i < len(keys) and keys[i] < key:
+                    yield keys[i], None
+                    i += 1
+                if i == len(keys):
+                    break
+                if key == keys[i]:
+                    yield key, value
+                    i += 1
+                    skipped = 0
+                    if i == len(keys):
+                        break
+                else:
+                    skipped += 1
+                    if skipped > self.MAX_SCAN_GAP:
+                        break
+            else:
+                while i < len(keys):
+                    yield keys[i], None
+                    i += 1
+
+    def get_documents(self, document_ids, key_order=False):
+        """
+
+        Iterates over (document_id, document) pairs of given documents, document is None if it is not in
+        storage. Ids are sorted by storage key and read mostly sequentially (see iter_keys). If <key_order>
+        is True, documents are returned in key order, otherwise in requested order: ids are read in
+        batches of READ_BATCH_SZ, so only one batch of documents is kept in memory. If documents cache
+        is enabled, only documents which are not in the cache are read. Documents of storage with columns
+        are read column by column, document is None if any of its columns is missing.
+
+        """
+        if self.terms_ldb is None:
+            raise Exception("Storage should be opened in order to retrieve documents.")
+        if len(self.columns) > 0:
+            document_ids = [int(document_id) for document_id in document_ids]
+            if key_order:
+                document_ids = sorted(set(document_ids))
+            for column_documents in itertools.izip(*[column_storage.get_documents(document_ids)
+                                                     for column_storage in self.column_storages]):
+                values = [column_document for _, column_document in column_documents]
+                yield column_documents[0][0], None if any(value is None for value in values) else values
+            return
+        if self.doc_cache is None:
+            for document_id, document in self.read_documents(document_ids, key_order):
+                yield document_id, document
+            return
+        document_ids = [int(document_id) for document_id in document_ids]
+        if key_order:
+            document_ids = sorted(set(document_ids), key=self.document_key)
+        for start in xrange(0, len(document_ids), self.READ_BATCH_SZ):
+            batch = document_ids[start:(start + self.READ_BATCH_SZ)]
+            documents = dict()
+            for document_id in batch:
+                document = self.doc_cache.get(document_id)
+                if document is not None:
+                    documents[document_id] = document
+            missing = [document_id for document_id in batch if document_id not in documents]
+            for document_id, document in self.read_documents(missing, key_order=True):
+                if document is not None:
+                    self.doc_cache.put(document_id, document, len(document))
+                documents[document_id] = document
+            for document_id in batch:
+                yield document_id, documents[document_id]
+
+    def read_documents(self, document_ids, key_order=False):
+        """
+
+        Implementation of get_documents which does not use documents cache.
+
+        """
+        if self.doc_format == DOC_FORMAT.MMAP:
+            document_ids = [int(document_id) for document_id in document_ids]
+            if key_order:
+                document_ids = sorted(set(document_ids))
+            for document_id in document_ids:
+                yield document_id, self.mapped_document(document_id)
+            return
+        if self.doc_compression_block > 0:
+            for document_id, document in self.get_block_documents(document_ids, key_order):
+                yield document_id, document
+            return
+        document_ids = [int(document_id) for document_id in document_ids]
+        if key_order:
+            document_ids = sorted(set(document_ids), key=self.document_key)
+        for start in xrange(0, len(document_ids), self.READ_BATCH_SZ):
+            batch = document_ids[start:(start + self.READ_BATCH_SZ)]
+            keys = sorted(set(self.id_key(document_id) for document_id in batch if document_id >= 0))
+            documents = dict((self.key_id(key), document) for key, document in self.iter_keys(self.docs_ldb, keys))
+            for document_id in batch:
+                yield document_id, documents.get(document_id)
+
+    def get_block_documents(self, document_ids, key_order=False):
+        """
+
+        Implementation of get_documents for storage with document blocks: blocks of every batch of ids are
+        read once in key order. With <key_order> documents are returned by blocks in key order.
+
+        """
+        document_ids = [int(document_id) for document_id in document_ids]
+        if key_order:
+            document_ids = sorted(set(document_ids), key=self.document_key)
+        for start in xrange(0, len(document_ids), self.READ_BATCH_SZ):
+            batch = document_ids[start:(start + self.READ_BATCH_SZ)]
+            blocks = self.read_blocks([document_id // self.doc_compression_block
+                                       for document_id in batch if document_id >= 0])
+            for document_id in batch:
+                block_id, position = divmod(document_id, self.doc_compression_block)
+                block = blocks.get(block_id)
+                if block is None or block[1][position] < 0:
+                    yield document_id, None
+                else:
+                    starts, lengths, data = block
+                    yield document_id, data[starts[position]:(starts[position] + lengths[position])]
+
+    def get_term(self, term_id):
+        if self.terms_ldb is None:
+            raise Exception("Storage should be opened in order to retrieve terms.")
+        if self.term_cache is None:
+            return self.terms_ldb.Get(self.id_key(term_id))
+        term_id = int(term_id)
+        term = self.term_cache.get(term_id)
+        if term is None:
+            term = self.terms_ldb.Get(self.id_key(term_id))
+            self.term_cache.put(term_id, term, len(term))
+        return term
 
 
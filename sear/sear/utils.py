@@ -43,6 +43,18 @@ class IndexingPipeline(object):
         self.lexicon = lexicon
         self.storage = storage
 
+    def continue_ids(self, stream_parser):
+        """
+
+        Makes <stream_parser> assign ids following ids of documents which are already in index and storage,
+        so new documents can be appended to them. Returns the first new id.
+
+        """
+        next_id = max(self.index.next_document_id(), self.storage.documents_number)
+        stream_parser.init_id_counter(next_id)
+        logging.info("Appending documents starting from id %d." % next_id)
+        return next_id
+
     def index_stream(self, document_stream, stream_parser, item_indexer):
         """
 
@@ -76,7 +88,7 @@ class IndexingPipeline(object):
             index_record = item_indexer.index_item(document)
 
             try:
-                raw_document = document.tostring()
+                raw_document = self.storage.document_value(document)
                 self.index.add_to_index(document.id, index_record)
                 self.storage.add_terms(self.lexicon, new_terms)
                 self.storage.add_document(document.id, raw_document)
@@ -85,7 +97,10 @@ class IndexingPipeline(object):
                 logging.error("Error while serializing document. %r" % traceback.format_exc())
                 continue
 
-            total_bytes += len(raw_document) + 1
+            if isinstance(raw_document, list):
+                total_bytes += sum(len(column_value) for column_value in raw_document) + 1
+            else:
+                total_bytes += len(raw_document) + 1
             total_terms = len(self.lexicon)
 
             if document_i % 10000 == 0:
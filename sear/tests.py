@@ -0,0 +1,735 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+
+import os
+import shutil
+import threading
+import tempfile
+import unittest
+import numpy as np
+
+import sear.codec
+import sear.fetcher
+import sear.index
+import sear.shard
+import sear.searcher
+import sear.storage
+import sear.lexicon
+import sear.utils
+import sear.keys
+import sear.segment
+
+TESTS_NUM = 100
+FIELDS = [("document_id", np.int32), ("arg_index", np.int32), ("rel_type", np.int32), ("frequency", np.int32)]
+
+
+class VectorsRecord(sear.index.IndexRecord):
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def property_vectors(self):
+        return [np.array(vector, dtype=np.int32) for vector in self.vectors]
+
+
+class LineDocument(sear.index.Document):
+
+    def __init__(self, doc_id, line):
+        super(LineDocument, self).__init__(doc_id)
+        self.line = line
+
+    def tostring(self):
+        return self.line
+
+    def fromstring(self, string):
+        self.line = string
+
+    def terms(self):
+        return self.line.split()
+
+
+class LineParser(sear.utils.StreamParser):
+
+    def parse_raw(self, line):
+        document = LineDocument(self.new_id(), line.strip())
+        if document.line.startswith("!"):
+            raise Exception("Broken document %d." % document.id)
+        return document
+
+
+class LineIndexer(sear.index.DocumentIndexer):
+
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+
+    def index_item(self, document):
+        return VectorsRecord([[self.lexicon.get_id(term)] for term in set(document.terms())])
+
+
+class LineIndexBuilder(sear.shard.ShardedIndexBuilder):
+
+    def __init__(self, output_path, **kwargs):
+        super(LineIndexBuilder, self).__init__(output_path, "document_id", **kwargs)
+        self.record_prefixes = ("", )
+
+    def make_stream(self, input_fl):
+        return input_fl
+
+    def make_parser(self):
+        return LineParser()
+
+    def make_indexer(self, lexicon):
+        return LineIndexer(lexicon)
+
+
+def random_documents(rng, documents_number, terms_number):
+    """
+
+    Returns list of documents, every document is a list of (term_id, arg_index, rel_type, frequency).
+
+    """
+    documents = []
+    for _ in xrange(documents_number):
+        frequency = rng.randint(1, 1000)
+        documents.append([(rng.randint(0, terms_number), i, rng.randint(0, 6), frequency)
+                          for i in xrange(rng.randint(1, 5))])
+    return documents
+
+
+def expected_fields(documents, term_id):
+    rows = [(document_id, arg_index, rel_type, frequency)
+            for document_id, vectors in enumerate(documents) if vectors is not None
+            for t, arg_index, rel_type, frequency in vectors
+            if t == term_id]
+    return [np.array([row[i] for row in rows], dtype=np.int64) for i in xrange(len(FIELDS))]
+
+
+def build_index(root, documents, cache_size=None, **kwargs):
+    index = sear.index.InvertedIndex(root, field_properties=FIELDS, **kwargs)
+    if cache_size is not None:
+        index.CACHE_SZ = cache_size
+    index.init_index()
+    index.open()
+    for document_id, vectors in enumerate(documents):
+        if vectors is not None:
+            index.add_to_index(document_id, VectorsRecord(vectors))
+    index.dump_and_merge()
+    return index
+
+
+def build_shard(root, documents, terms_number, columns=()):
+    """
+
+    Writes index, storage and lexicon of documents to <root> as indexer scripts do. Every shard lexicon has
+    all terms, document <i> is stored as "document <i>" or as a list of its column values, None documents
+    are skipped as parser skips broken ones.
+
+    """
+    os.makedirs(root)
+    lexicon = sear.lexicon.DictLexicon(root)
+    lexicon.count_terms(["term %d" % term_id for term_id in xrange(terms_number)])
+    lexicon.dump()
+    lexicon.ldb = None
+    build_index(root, documents).close()
+    storage = sear.storage.LdbStorage(root)
+    for column in columns:
+        storage.add_column(column)
+    storage.init_db()
+    storage.open_db()
+    for document_id in xrange(len(documents)):
+        if documents[document_id] is None:
+            continue
+        document = "document %d" % document_id
+        storage.add_document(document_id, [document + column for column in columns] if columns else document)
+    storage.close_db()
+
+
+class TestCodecs(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def arrays(self):
+        yield np.zeros(0, dtype=np.int64)
+        yield np.array([42], dtype=np.int64)
+        yield np.array([0, np.iinfo(np.int64).max], dtype=np.int64)
+        yield np.array([np.iinfo(np.int64).min, -1, 0], dtype=np.int64)
+        yield np.zeros(300, dtype=np.int64) + 7
+        for _ in xrange(TESTS_NUM):
+            size = self.rng.randint(1, 600)
+            yield np.sort(self.rng.randint(-(1 << self.rng.randint(1, 62)), 1 << self.rng.randint(1, 62), size))
+
+    def round_trip(self, codec, array, block_size):
+        blob, block_sizes = codec.encode_blocks(array, block_size)
+        block_offsets = np.concatenate(([0], np.cumsum(block_sizes)))
+        block_rows = np.diff(np.append(np.arange(0, len(array), block_size), len(array)))
+        self.assertEqual(len(block_sizes), len(block_rows))
+        self.assertTrue(np.array_equal(codec.decode_blocks(blob, np.int64, block_offsets, block_rows), array))
+        return blob, block_sizes
+
+    def test_round_trip(self):
+        for codec_name in sear.codec.CODECS:
+            codec = sear.codec.get_codec(codec_name)
+            for array in self.arrays():
+                self.assertTrue(np.array_equal(codec.decode(codec.encode(array), np.int64), array))
+                for block_size in (1, 3, sear.codec.ForCodec.BLOCK_SZ):
+                    self.round_trip(codec, array, block_size)
+
+    def test_unsorted_round_trip(self):
+        for codec_name in (sear.codec.CODEC.RAW, sear.codec.CODEC.DELTA_VARINT, sear.codec.CODEC.FOR,
+                           sear.codec.CODEC.BITMAP):
+            codec = sear.codec.get_codec(codec_name)
+            for _ in xrange(TESTS_NUM):
+                self.round_trip(codec, self.rng.randint(-1000, 1000, self.rng.randint(1, 600)), 128)
+
+    def test_blocks_are_single_encodings(self):
+        for codec_name in sear.codec.CODECS:
+            codec = sear.codec.get_codec(codec_name)
+            for array in self.arrays():
+                blob, block_sizes = self.round_trip(codec, array, 64)
+                single_blob, single_sizes = sear.codec.Codec.encode_blocks(codec, array, 64)
+                self.assertEqual(blob, single_blob)
+                self.assertTrue(np.array_equal(block_sizes, single_sizes))
+
+    def test_selected_blocks(self):
+        for codec_name in sear.codec.CODECS:
+            codec = sear.codec.get_codec(codec_name)
+            array = np.sort(self.rng.randint(0, 1 << 20, 1000))
+            blob, block_sizes = codec.encode_blocks(array, 128)
+            block_offsets = np.concatenate(([0], np.cumsum(block_sizes)))
+            data = np.frombuffer(blob, dtype=np.uint8)
+            selected = np.array([1, 4, 7])
+            parts = [data[block_offsets[i]:block_offsets[i + 1]] for i in selected]
+            offsets = np.concatenate(([0], np.cumsum([len(part) for part in parts])))
+            rows = np.minimum(128, len(array) - selected * 128)
+            decoded = codec.decode_blocks(np.concatenate(parts), np.int64, offsets, rows)
+            self.assertTrue(np.array_equal(decoded, np.concatenate([array[i * 128:(i + 1) * 128] for i in selected])))
+
+    def test_elias_fano_unsorted(self):
+        codec = sear.codec.EliasFanoCodec()
+        self.assertRaises(Exception, codec.encode, np.array([3, 1, 2]))
+        self.assertRaises(Exception, codec.encode_blocks, np.array([1, 3, 2, 4]), 128)
+        # Every block is encoded on its own, so values may decrease between blocks.
+        self.round_trip(codec, np.array([3, 4, 1, 2]), 2)
+
+    def test_read_bits(self):
+        for _ in xrange(TESTS_NUM):
+            widths = self.rng.randint(0, 65, self.rng.randint(1, 50))
+            values = self.rng.randint(0, 1 << 32, len(widths)).astype(np.uint64) << np.uint64(32)
+            values |= self.rng.randint(0, 1 << 32, len(widths)).astype(np.uint64)
+            values = np.array([int(value) & ((1 << int(w)) - 1) for value, w in zip(values, widths)], dtype=np.uint64)
+            packed = sear.codec.pack_bits(values, widths)
+            starts = np.cumsum(widths) - widths
+            self.assertTrue(np.array_equal(sear.codec.read_bits(packed, starts, widths), values))
+
+
+class TestSegments(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_formats_after_compaction(self):
+        documents = random_documents(self.rng, 3000, 50)
+        for codec_name in sear.codec.CODECS:
+            # Frequencies are not sorted, Elias-Fano can encode only document ids.
+            field_codecs = {"document_id": codec_name, "frequency": codec_name}
+            if codec_name == sear.codec.CODEC.ELIAS_FANO:
+                field_codecs["frequency"] = sear.codec.CODEC.FOR
+            indexes = []
+            for index_format in (sear.index.INDEX_FORMAT.LDB, sear.index.INDEX_FORMAT.MMAP):
+                root = "%s/%s.%s" % (self.root, codec_name, index_format)
+                index = build_index(root, documents, 500, index_format=index_format, field_codecs=field_codecs)
+                index.wait_compaction()
+                index.compact(full=True)
+                self.assertEqual(len(index.segments_meta), 1)
+                indexes.append(index)
+            for term_id in xrange(51):
+                expected = expected_fields(documents, term_id)
+                for index in indexes:
+                    fields = index.load_plist(term_id).fields
+                    for field, expected_field in zip(fields, expected):
+                        self.assertTrue(np.array_equal(field, expected_field))
+            for index in indexes:
+                index.load()
+                for term_id in xrange(51):
+                    fields = index.get_plists([term_id])[term_id].fields
+                    self.assertTrue(np.array_equal(fields[0], expected_fields(documents, term_id)[0]))
+                index.close()
+
+    def test_compaction_during_background_compaction(self):
+        documents = random_documents(self.rng, 3000, 20)
+        index = build_index(self.root, documents, 300)
+        index.compact(full=True)
+        index.wait_compaction()
+        self.assertEqual(len(index.segments_meta), 1)
+        for term_id in xrange(21):
+            fields = index.load_plist(term_id).fields
+            self.assertTrue(np.array_equal(fields[0], expected_fields(documents, term_id)[0]))
+        index.close()
+
+    def test_partition_fields(self):
+        for field_name, message in (("unknown", "Unknown partition field"), ("document_id", "Document id field")):
+            index = sear.index.InvertedIndex(os.path.join(self.root, field_name), field_properties=FIELDS,
+                                             partition_fields=[field_name])
+            self.assertRaisesRegexp(Exception, message, index.init_index)
+
+    def test_bitmaps(self):
+        documents = random_documents(self.rng, 2000, 20)
+        index = build_index(self.root, documents)
+        for term_id in xrange(21):
+            bitmap = index.load_bitmap(term_id)
+            self.assertEqual(len(bitmap), (len(documents) + 7) // 8)
+            self.assertTrue(np.array_equal(np.flatnonzero(np.unpackbits(bitmap)),
+                                           np.unique(expected_fields(documents, term_id)[0])))
+        index.close()
+
+
+class TestSearcher(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(3)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_top_k_ties(self):
+        # Few distinct frequencies, so many documents have equal scores and are ordered by id. The best
+        # document of term 0 is in its last block, documents of the first blocks tie with the second best.
+        documents = [[(term_id, arg_index, rel_type, frequency % 3)
+                      for term_id, arg_index, rel_type, frequency in vectors]
+                     for vectors in random_documents(self.rng, 5000, 10)]
+        for document_id, vectors in enumerate(documents):
+            vectors.append((0, len(vectors), 0, 3 if document_id == 4990 else 2))
+        index = build_index(self.root, documents, 1000, plist_cache_bytes=0)
+        index.wait_compaction()
+        searcher = sear.searcher.Searcher(index, "document_id", 0)
+        for term_id in xrange(10):
+            fields = expected_fields(documents, term_id)
+            document_ids, scores = sear.searcher.best_scores(fields[0], fields[3])
+            order = np.lexsort((document_ids, -scores))
+            for k in (1, 10, 200, 5000):
+                values, found_scores = searcher.top_k([(term_id, [])], k, "frequency")
+                self.assertTrue(np.array_equal(values, document_ids[order][:k]))
+                self.assertTrue(np.array_equal(found_scores, scores[order][:k]))
+        index.close()
+
+    def test_impact_blocks_release_lock(self):
+        index = build_index(self.root, random_documents(self.rng, 3000, 5), 1000, plist_cache_bytes=0)
+        index.wait_compaction()
+        self.assertTrue(len(index.segments_meta) > 1)
+        batches = index.impact_blocks(1, 3)
+        batches.next()
+        compaction = threading.Thread(target=index.compact, kwargs={"full": True})
+        compaction.start()
+        compaction.join(10)
+        self.assertFalse(compaction.is_alive())
+        self.assertEqual(len(index.segments_meta), 1)
+        # Compacted segments are gone, the rest of postings is read from the new one.
+        self.assertTrue(len(list(batches)) > 0)
+        index.close()
+
+
+class TestStorage(unittest.TestCase):
+
+    LAYOUTS = [
+        dict(),
+        dict(compression=sear.storage.COMPRESSION.ZLIB, doc_compression_block=8),
+        dict(doc_format=sear.storage.DOC_FORMAT.MMAP),
+    ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(3)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def random_documents(self, documents_number):
+        """
+
+        Returns dict mapping id to document for about a half of ids below <documents_number>, some of
+        documents are empty.
+
+        """
+        return dict((document_id, "" if self.rng.randint(0, 5) == 0 else "document %d " % document_id)
+                    for document_id in xrange(documents_number) if self.rng.randint(0, 2))
+
+    def build_storage(self, name, documents, key_format=sear.keys.KEY_FORMAT.BINARY, **layout):
+        storage = sear.storage.LdbStorage(os.path.join(self.root, name))
+        for attribute, value in layout.items():
+            setattr(storage, attribute, value)
+        storage.init_db()
+        storage.key_format = key_format
+        storage.open_db()
+        for document_id in sorted(documents):
+            storage.add_document(document_id, documents[document_id])
+        storage.close_db()
+        storage.load_meta()
+        storage.open_db()
+        return storage
+
+    def test_get_documents(self):
+        documents = self.random_documents(300)
+        for i, layout in enumerate(self.LAYOUTS):
+            storage = self.build_storage("storage.%d" % i, documents, **layout)
+            storage.READ_BATCH_SZ = 16
+            for cached in (False, True):
+                if cached:
+                    storage.cache_documents(max_bytes=2048, document_ids=range(0, 300, 7))
+                for _ in xrange(10):
+                    document_ids = list(self.rng.randint(-5, 320, self.rng.randint(0, 100)))
+                    document_ids += document_ids[:10]
+                    expected = [(document_id, documents.get(document_id)) for document_id in document_ids]
+                    self.assertEqual(list(storage.get_documents(document_ids)), expected)
+                    key_ordered = list(storage.get_documents(document_ids, key_order=True))
+                    self.assertEqual(sorted(key_ordered), sorted(set(expected)))
+                    keys = [storage.document_key(document_id) for document_id, _ in key_ordered]
+                    self.assertEqual(keys, sorted(keys))
+                    for document_id, document in expected:
+                        if document is None:
+                            self.assertRaises(KeyError, storage.get_document, document_id)
+                        else:
+                            self.assertEqual(storage.get_document(document_id), document)
+                self.assertEqual(list(storage.iter_documents()), sorted(documents.items()))
+            storage.close_db()
+
+    def test_mapped_documents(self):
+        documents = self.random_documents(300)
+        documents[299] = ""
+        storage = self.build_storage("storage", documents, doc_format=sear.storage.DOC_FORMAT.MMAP,
+                                     max_doc_flush_buffer_size=16)
+        self.assertEqual(len(storage.doc_offsets), 301)
+        for document_id in xrange(-5, 320):
+            self.assertEqual(storage.mapped_document(document_id), documents.get(document_id))
+        self.assertEqual(list(storage.iter_documents()), sorted(documents.items()))
+        document_ids = range(-5, 320) * 2
+        self.assertEqual(list(storage.get_documents(document_ids)),
+                         [(document_id, documents.get(document_id)) for document_id in document_ids])
+        storage.close_db()
+
+    def test_fetcher_order(self):
+        documents = self.random_documents(300)
+        for i, layout in enumerate(self.LAYOUTS):
+            storage = self.build_storage("storage.%d" % i, documents, **layout)
+            for jobs in (0, 2):
+                fetcher = sear.fetcher.DocumentFetcher(storage, lambda document: "<%s>" % document, jobs,
+                                                       lookahead=12, batch_size=5)
+                for _ in xrange(10):
+                    document_ids = list(self.rng.randint(-5, 320, self.rng.randint(0, 200)))
+                    document_ids += document_ids[:20]
+                    expected = [(document_id, None if document_id not in documents else "<%s>" % documents[document_id])
+                                for document_id in document_ids]
+                    self.assertEqual(list(fetcher.fetch(iter(document_ids))), expected)
+                fetcher.close()
+            storage.close_db()
+
+    def test_fetcher_errors(self):
+        documents = dict((document_id, str(document_id)) for document_id in xrange(100))
+
+        def decode(document):
+            if document == "42":
+                raise ValueError(document)
+            return int(document)
+
+        storage = self.build_storage("storage", documents)
+        for jobs in (0, 2):
+            fetcher = sear.fetcher.DocumentFetcher(storage, decode, jobs, lookahead=12, batch_size=5)
+            fetched = []
+            self.assertRaises(ValueError, fetched.extend, (document for _, document in fetcher.fetch(xrange(100))))
+            # Batches before the failed one are consumed in order, the error is raised in place of its batch.
+            self.assertEqual(fetched, range(40))
+            fetcher.close()
+        storage.close_db()
+
+    def test_columns(self):
+        documents = dict((document_id, ["lf %d" % document_id, "" if document_id % 3 else "terms", "text " * 5])
+                         for document_id in self.random_documents(300))
+        storage = sear.storage.LdbStorage(os.path.join(self.root, "storage"))
+        storage.add_column("lf", doc_format=sear.storage.DOC_FORMAT.MMAP)
+        storage.add_column("terms", sear.storage.COMPRESSION.ZLIB, 8)
+        storage.add_column("text", sear.storage.COMPRESSION.ZLIB)
+        storage.init_db()
+        storage.open_db()
+        for document_id in sorted(documents):
+            storage.add_document(document_id, documents[document_id])
+        storage.close_db()
+        storage = sear.storage.LdbStorage(storage.root)
+        storage.load_meta()
+        self.assertEqual(storage.columns, ["lf", "terms", "text"])
+        self.assertEqual(storage.column("terms").doc_compression_block, 8)
+        storage.open_db()
+        for cached in (False, True):
+            if cached:
+                storage.cache_documents(max_bytes=2048)
+            document_ids = list(self.rng.randint(-5, 320, 200)) * 2
+            expected = [(document_id, documents.get(document_id)) for document_id in document_ids]
+            self.assertEqual(list(storage.get_documents(document_ids)), expected)
+            self.assertEqual(list(storage.get_documents(document_ids, key_order=True)),
+                             [(document_id, documents.get(document_id)) for document_id in sorted(set(document_ids))])
+            lf_column = storage.column("lf")
+            self.assertEqual(list(lf_column.get_documents(document_ids)),
+                             [(document_id, document and document[0]) for document_id, document in expected])
+            for document_id in documents:
+                self.assertEqual(storage.get_document(document_id), documents[document_id])
+            self.assertEqual(list(storage.iter_documents()), sorted(documents.items()))
+        storage.close_db()
+
+    def test_new_storage_keys(self):
+        storage = sear.storage.LdbStorage(os.path.join(self.root, "storage"))
+        self.assertEqual(storage.key_format, sear.keys.KEY_FORMAT.TEXT)
+        storage.init_db()
+        storage = sear.storage.LdbStorage(os.path.join(self.root, "storage"))
+        storage.load_meta()
+        self.assertEqual(storage.key_format, sear.keys.KEY_FORMAT.BINARY)
+        self.assertRaises(KeyError, storage.id_key, -1)
+
+    def test_migrate_keys(self):
+        documents = self.random_documents(300)
+        for i, layout in enumerate(self.LAYOUTS[:2]):
+            storage = self.build_storage("storage.%d" % i, documents, sear.keys.KEY_FORMAT.TEXT, **layout)
+            text_documents = list(storage.get_documents(range(-5, 320)))
+            self.assertEqual(text_documents, [(document_id, documents.get(document_id))
+                                              for document_id in xrange(-5, 320)])
+            storage.close_db()
+            storage = sear.storage.LdbStorage(storage.root)
+            storage.load_meta()
+            self.assertEqual(storage.key_format, sear.keys.KEY_FORMAT.TEXT)
+            self.assertTrue(storage.migrate_keys())
+            self.assertFalse(storage.migrate_keys())
+            storage = sear.storage.LdbStorage(storage.root)
+            storage.load_meta()
+            self.assertEqual(storage.key_format, sear.keys.KEY_FORMAT.BINARY)
+            storage.open_db()
+            self.assertEqual(list(storage.get_documents(range(-5, 320))), text_documents)
+            self.assertEqual(list(storage.iter_documents()), sorted(documents.items()))
+            storage.close_db()
+
+    def test_migrate_index_keys(self):
+        documents = random_documents(self.rng, 1000, 30)
+        index = build_index(os.path.join(self.root, "index"), documents)
+        index.close()
+        to_text = lambda key: None if key == sear.segment.LdbSegment.FORMAT_KEY else \
+            sear.segment.LdbSegment.make_key(sear.keys.KEY_FORMAT.TEXT,
+                                             *sear.segment.LdbSegment.parse_key(sear.keys.KEY_FORMAT.BINARY, key))
+        for segment_meta in index.segments_meta:
+            sear.keys.rekey_ldb(os.path.join(index.root, segment_meta["name"]), to_text)
+        index = sear.index.InvertedIndex(index.root)
+        self.assertTrue(index.migrate_keys() > 0)
+        self.assertEqual(index.migrate_keys(), 0)
+        index.open()
+        for term_id in xrange(31):
+            fields = index.load_plist(term_id).fields
+            for field, expected_field in zip(fields, expected_fields(documents, term_id)):
+                self.assertTrue(np.array_equal(field, expected_field))
+        index.close()
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def build_shards(self, shards_number, documents_number, terms_number, columns=()):
+        shards = [random_documents(self.rng, documents_number, terms_number) for _ in xrange(shards_number)]
+        shard_dirs = []
+        for i, documents in enumerate(shards):
+            shard_dirs.append(os.path.join(self.root, "output", sear.shard.SHARD_DIR % i))
+            build_shard(shard_dirs[-1], documents, terms_number, columns)
+        return shards, shard_dirs
+
+    def test_merge(self):
+        shards, shard_dirs = self.build_shards(3, 500, 20)
+        sear.shard.merge_shards(os.path.join(self.root, "output"), shard_dirs, jobs=2)
+        documents = sum(shards, [])
+        index = sear.index.InvertedIndex(os.path.join(self.root, "output"))
+        index.open()
+        for term_id in xrange(21):
+            fields = index.load_plist(term_id).fields
+            for field, expected_field in zip(fields, expected_fields(documents, term_id)):
+                self.assertTrue(np.array_equal(field, expected_field))
+        index.close()
+        storage = sear.storage.LdbStorage(os.path.join(self.root, "output"))
+        storage.load_meta()
+        storage.open_db()
+        self.assertEqual([document for _, document in storage.iter_documents()],
+                         ["document %d" % (i % 500) for i in xrange(len(documents))])
+        storage.close_db()
+
+    def test_skipped_ids(self):
+        shards = [random_documents(self.rng, 100, 10) for _ in xrange(3)]
+        shards[0][50] = None
+        shards[1][-2] = None
+        expected_documents = [(i, None if document is None else "document %d" % (i % 100))
+                              for i, document in enumerate(sum(shards, []))]
+        for single in (True, False):
+            root = os.path.join(self.root, "single" if single else "manifest")
+            shard_dirs = [os.path.join(root, sear.shard.SHARD_DIR % i) for i in xrange(3)]
+            for shard_dir, documents in zip(shard_dirs, shards):
+                build_shard(shard_dir, documents, 10)
+            merged = sear.shard.merge_shards(root, shard_dirs, single=single)
+            if single:
+                storage = sear.storage.LdbStorage(root)
+                storage.load_meta()
+                self.assertEqual(merged.next_document_id(), 300)
+                merged.open()
+                for term_id in xrange(11):
+                    fields = merged.load_plist(term_id).fields
+                    for field, expected_field in zip(fields, expected_fields(sum(shards, []), term_id)):
+                        self.assertTrue(np.array_equal(field, expected_field))
+                merged.close()
+            else:
+                storage = sear.shard.ShardedStorage(merged)
+                self.assertEqual(list(merged.doc_id_bases()), [0, 100, 200])
+            storage.open_db()
+            self.assertEqual(list(storage.get_documents(range(300))), expected_documents)
+            storage.close_db()
+
+    def test_builder(self):
+        lines = ["%s%s\n" % ("!" if self.rng.randint(0, 10) == 0 else "",
+                              " ".join("w%d" % self.rng.randint(0, 30) for _ in xrange(self.rng.randint(1, 6))))
+                 for _ in xrange(500)]
+        for name, part in (("all", lines), ("first", lines[:250]), ("second", lines[250:])):
+            with open(os.path.join(self.root, name + ".txt"), "w") as input_file:
+                input_file.writelines(part)
+        expected = [line.strip() for line in lines if not line.startswith("!")]
+
+        def read(output_path):
+            manifest = sear.shard.ShardManifest(output_path)
+            if sear.shard.ShardManifest.exists(output_path):
+                manifest.load()
+                storage = sear.shard.ShardedStorage(manifest)
+                storage.open_db()
+                documents = [document for _, document in storage.get_documents(range(manifest.documents_number))]
+                storage.close_db()
+                return [document for document in documents if document is not None], None
+            storage = sear.storage.LdbStorage(output_path)
+            storage.load_meta()
+            storage.open_db()
+            documents = dict(storage.iter_documents())
+            storage.close_db()
+            lexicon = sear.lexicon.DictLexicon(output_path)
+            lexicon.load()
+            index = sear.index.InvertedIndex(output_path)
+            index.open()
+            postings = dict((term, sorted(documents[document_id]
+                                          for document_id in index.load_plist(term_id).fields[0]))
+                            for term, (term_id, _) in lexicon.term_dict.iteritems())
+            index.close()
+            lexicon.ldb = None
+            return [document for _, document in sorted(documents.items())], postings
+
+        input_path = os.path.join(self.root, "all.txt")
+        LineIndexBuilder(os.path.join(self.root, "single")).build(input_path)
+        documents, postings = read(os.path.join(self.root, "single"))
+        self.assertEqual(documents, expected)
+        self.assertEqual(postings["w1"], sorted(line for line in expected if "w1" in line.split()))
+        LineIndexBuilder(os.path.join(self.root, "merged"), jobs=3).build(input_path)
+        self.assertEqual(read(os.path.join(self.root, "merged")), (documents, postings))
+        LineIndexBuilder(os.path.join(self.root, "shards"), jobs=3, single=False).build(input_path)
+        self.assertEqual(read(os.path.join(self.root, "shards"))[0], documents)
+        for name, jobs, single in (("appended", 1, True), ("appended_merged", 2, True), ("appended_shards", 2, False)):
+            output_path = os.path.join(self.root, name)
+            LineIndexBuilder(output_path, jobs=jobs, single=single).build(os.path.join(self.root, "first.txt"))
+            LineIndexBuilder(output_path, jobs=jobs, append=True).build(os.path.join(self.root, "second.txt"))
+            appended_documents, appended_postings = read(output_path)
+            self.assertEqual(appended_documents, documents)
+            if appended_postings is not None:
+                self.assertEqual(appended_postings, postings)
+
+    def test_sharded_storage_close(self):
+        _, shard_dirs = self.build_shards(2, 50, 5, ("lf", "text"))
+        manifest = sear.shard.merge_shards(os.path.join(self.root, "output"), shard_dirs, single=False)
+        meta_paths = [os.path.join(path, sear.storage.LdbStorage.META_FL) for path in manifest.shard_paths()]
+        meta = [open(meta_path).read() for meta_path in meta_paths]
+        storage = sear.shard.ShardedStorage(manifest)
+        storage.open_db()
+        text_storage = storage.column("text")
+        self.assertEqual(text_storage.get_document(60), "document 10text")
+        text_storage.close_db()
+        self.assertTrue(all(column_storage.docs_ldb is None for column_storage in text_storage.storages))
+        storage.close_db()
+        # Databases of shards and their columns are released, so they can be opened again.
+        for shard_path, meta_path, shard_meta in zip(manifest.shard_paths(), meta_paths, meta):
+            self.assertEqual(open(meta_path).read(), shard_meta)
+            shard_storage = sear.storage.LdbStorage(shard_path)
+            shard_storage.load_meta()
+            shard_storage.open_db()
+            self.assertEqual(shard_storage.get_document(10), ["document 10lf", "document 10text"])
+            shard_storage.release_db()
+
+    def test_merge_rejects_other_columns(self):
+        documents = random_documents(self.rng, 100, 5)
+        shard_dirs = [os.path.join(self.root, "output", sear.shard.SHARD_DIR % i) for i in xrange(2)]
+        build_shard(shard_dirs[0], documents, 5, ("lf", "text"))
+        build_shard(shard_dirs[1], documents, 5)
+        self.assertRaises(Exception, sear.shard.merge_shards, os.path.join(self.root, "output"), shard_dirs)
+        column_storage = sear.storage.LdbStorage(shard_dirs[0])
+        column_storage.load_meta()
+        storage = sear.storage.LdbStorage(os.path.join(self.root, "copy"))
+        storage.copy_layout(column_storage)
+        self.assertEqual(storage.columns, ["lf", "text"])
+        storage.init_db()
+        storage.open_db()
+        self.assertRaises(Exception, storage.add_document, 0, "document")
+        storage.add_document(0, ["lf", "text"])
+        storage.close_db()
+        plain_storage = sear.storage.LdbStorage(shard_dirs[1])
+        plain_storage.load_meta()
+        plain_storage.open_db()
+        self.assertRaises(Exception, plain_storage.add_document, 100, ["lf", "text"])
+        plain_storage.close_db()
+
+    def test_sharded_search(self):
+        shards, shard_dirs = self.build_shards(3, 400, 30)
+        manifest = sear.shard.merge_shards(os.path.join(self.root, "output"), shard_dirs, single=False, jobs=2)
+        index = build_index(os.path.join(self.root, "single"), sum(shards, []))
+        searcher = sear.searcher.Searcher(index, "document_id")
+        sharded_searcher = sear.searcher.ShardedSearcher(manifest, "document_id", jobs=2)
+        queries = []
+        for _ in xrange(20):
+            queries.append([(self.rng.randint(0, 31), []) for _ in xrange(self.rng.randint(1, 12))])
+            queries.append([(self.rng.randint(0, 31), [("rel_type", "==", self.rng.randint(0, 6))])
+                            for _ in xrange(self.rng.randint(1, 3))])
+        for query in queries:
+            self.assertTrue(np.array_equal(searcher.find(query), sharded_searcher.find(query)))
+            for ret_field in (None, "rel_type", "frequency"):
+                values, masks = searcher.find_or(query, ret_field)
+                sharded_values, sharded_masks = sharded_searcher.find_or(query, ret_field)
+                self.assertTrue(np.array_equal(values, sharded_values))
+                self.assertTrue(np.array_equal(masks, sharded_masks))
+            values, scores = searcher.top_k(query, 10, "frequency")
+            sharded_values, sharded_scores = sharded_searcher.top_k(query, 10, "frequency")
+            self.assertTrue(np.array_equal(values, sharded_values))
+            self.assertTrue(np.array_equal(scores, sharded_scores))
+        frequencies = [searcher.document_frequency(term_id) for term_id in xrange(31)]
+        self.assertEqual([sharded_searcher.document_frequency(term_id) for term_id in xrange(31)], frequencies)
+        # Shards without statistics tables are asked for frequencies.
+        os.remove(os.path.join(manifest.shard_paths()[1], sear.index.InvertedIndex.STATS_FILE))
+        sharded_searcher.term_stats = None
+        self.assertEqual([sharded_searcher.document_frequency(term_id) for term_id in xrange(31)], frequencies)
+        sharded_searcher.close()
+        index.close()
+
+    def test_broken_shard(self):
+        _, shard_dirs = self.build_shards(2, 100, 5)
+        manifest = sear.shard.merge_shards(os.path.join(self.root, "output"), shard_dirs, single=False)
+        with open(os.path.join(manifest.shard_paths()[1], sear.index.InvertedIndex.META_FILE), "w") as meta_file:
+            meta_file.write("{")
+        sharded_searcher = sear.searcher.ShardedSearcher(manifest, "document_id", jobs=2)
+        self.assertRaises(Exception, sharded_searcher.find, [(1, [])])
+        sharded_searcher.close()
+
+
+if __name__ == "__main__":
+        unittest.main()